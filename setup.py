@@ -12,8 +12,7 @@ install_requires=[
     "TurboGears2 >= 2.3.2",
     "tgext.pluggable",
     "formencode",
-    "tgscheduler",
-    "paypalrestsdk"
+    "requests"
 ]
 
 here = os.path.abspath(os.path.dirname(__file__))
@@ -33,6 +32,7 @@ setup(
     keywords='turbogears2.application',
     packages=find_packages(exclude=['ez_setup']),
     install_requires=install_requires,
+    extras_require={'xlsx': ['XlsxWriter']},
     include_package_data=True,
     package_data={'tgext.ecommerce': ['i18n/*/LC_MESSAGES/*.mo',
                                  'templates/*/*',
@@ -1,16 +1,16 @@
 # -*- coding: utf-8 -*-
 """The tgext.ecommerce package"""
 import tg
-from tgscheduler.scheduler import scheduler
 from lib.shop import ShopManager
 from tg import hooks, config
+from tg.support.converters import asbool
 from tgext.ecommerce.lib.payments.paypal import configure_paypal
 
 
 def plugme(app_config, options):
     app_config['_pluggable_ecommerce_config'] = options
     hooks.register('before_config', setup_global_objects)
-    hooks.register('after_config', setup_clean_cart_scheduler)
+    hooks.register('after_config', setup_job_runner)
     hooks.register('after_config', init_paypal)
 
 
@@ -22,14 +22,24 @@ def setup_global_objects(app):
     return app
 
 
-def setup_clean_cart_scheduler(app):
-    from lib.async_jobs import clean_expired_carts
-    if scheduler._scheduler_instance is None:
-        scheduler.start_scheduler()
-    scheduler.add_interval_task(clean_expired_carts, 60)
+def setup_job_runner(app):
+    from lib.async_jobs import register_jobs
+    from lib.job_queue import job_workers
+    from lib.scheduler import job_runner
+    register_jobs(job_runner)
+    if asbool(config.get('scheduler.enabled', True)):
+        job_runner.start()
+    if job_workers.workers:
+        job_workers.start()
     return app
 
 
 def init_paypal(app):
-    configure_paypal(tg.config['paypal_mode'], tg.config['paypal_client_id'], tg.config['paypal_client_secret'])
+    options = dict(timeout=(float(tg.config.get('paypal_connect_timeout', 3.05)),
+                            float(tg.config.get('paypal_read_timeout', 15))),
+                   retries=int(tg.config.get('paypal_retries', 3)),
+                   pool_size=int(tg.config.get('paypal_pool_size', 10)),
+                   base_url=tg.config.get('paypal_base_url'))
+    configure_paypal(tg.config['paypal_mode'], tg.config['paypal_client_id'], tg.config['paypal_client_secret'],
+                     **options)
     return app
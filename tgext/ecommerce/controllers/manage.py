@@ -1,17 +1,28 @@
 # coding=utf-8
 from __future__ import unicode_literals
-from datetime import date, datetime
-from itertools import groupby
+from datetime import date, datetime, timedelta
 from bson import ObjectId
-from tg import TGController, expose, validate, lurl, redirect, request, tmpl_context, config, flash, predicates
-from tg.i18n import lazy_ugettext as l_
+from tg import TGController, expose, validate, lurl, redirect, request, response, tmpl_context, config, flash, \
+    predicates, abort
+try:
+    from tg.controllers import CUSTOM_CONTENT_TYPE
+except ImportError:
+    # TurboGears 2.4 keeps the content type set on the response
+    CUSTOM_CONTENT_TYPE = None
+from tg.i18n import ugettext as _, lazy_ugettext as l_
 import tw2.core as twc
 import tw2.forms as twf
 from tw2.forms.widgets import BaseLayout
 from tgext.ecommerce.lib import get_edit_order_form
+from tgext.ecommerce.lib.exceptions import UnsupportedExportFormatException
+from tgext.ecommerce.lib.order import OrderManager
+from tgext.ecommerce.lib.utils import search_query
+from tgext.ecommerce.lib.users import user_names
 from tgext.ecommerce.model import Order
 
 
+EXPORT_CONTENT_TYPES = {'csv': 'text/csv',
+                        'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'}
 FILTER_FIELDS = [('status_changes.changed_at', l_('date')), ('status', l_('status')), ('user', l_('user'))]
 
 
@@ -73,34 +84,85 @@ class ManageController(TGController):
     def _before(self, *args, **kw):
         tmpl_context.manage_pages = True
 
+    def _orders_query(self, field=None, filt=None):
+        if field is None:
+            return {}
+        if field == 'user':
+            return search_query(filt)
+        if field == 'status_changes.changed_at':
+            day_start = datetime(filt.year, filt.month, filt.day)
+            day_end = datetime(filt.year, filt.month, filt.day, 23, 59, 59)
+            return {field: {'$gte': day_start, '$lte': day_end}}
+        return {field: filt}
+
+    def _orders_listing(self, page, field=None, filt=None):
+        try:
+            page = max(1, int(page))
+        except (TypeError, ValueError):
+            page = 1
+        listing = OrderManager.get_listing(self._orders_query(field, filt), page,
+                                           int(config.get('orders.items_per_page', 50)))
+        user_names.resolve_many(set(o.billed_by for _, _, orders in listing.days for o in orders if o.get('billed_by')))
+        return listing
+
+    def _orders_page(self, listing, action, value):
+        return dict(orders=listing.days, page=listing.page, pages=listing.pages, total=listing.total,
+                    form=OrderFilterForm, value=value, action=self.mount_point+'/submit_orders',
+                    page_url=self.mount_point+'/'+action,
+                    page_params=dict((k, v) for k, v in request.params.items() if k != 'page'),
+                    bill_issue=self.mount_point+'/bill_issue/%s',
+                    notes=self.mount_point+'/notes/%s', message=self.mount_point+'/message/%s',
+                    edit=self.mount_point+'/edit?order_id=%s', all_the_vats=Order.all_the_vats())
+
     @expose('tgext.ecommerce.templates.orders')
-    def orders(self, **kw):
-        orders = Order.query.find().sort('creation_date', -1).limit(250)
-        grouped_orders = groupby(orders, lambda o: o.creation_date.strftime('%d/%m/%Y'))
-        all_the_vats = Order.all_the_vats()
-        return dict(orders=grouped_orders, form=OrderFilterForm, value=kw, action=self.mount_point+'/submit_orders',
-                    bill_issue=self.mount_point+'/bill_issue/%s', notes=self.mount_point+'/notes/%s',
-                    message=self.mount_point+'/message/%s',
-                    edit=self.mount_point+'/edit?order_id=%s', all_the_vats=all_the_vats)
+    def orders(self, page=1, **kw):
+        listing = self._orders_listing(page)
+        return self._orders_page(listing, 'orders', kw)
 
     @expose('tgext.ecommerce.templates.orders')
     @validate(OrderFilterForm, error_handler=orders)
     def submit_orders(self, **kw):
-        if kw['field'] == 'user':
-            orders = Order.query.find({kw['field']: {'$regex': kw['filt'], '$options': 'i'}})
-        elif kw['field'] == 'status_changes.changed_at':
-            date_ = kw['filt']
-            day_start = datetime(date_.year, date_.month, date_.day)
-            day_end = datetime(date_.year, date_.month, date_.day, 23, 59, 59)
-            orders = Order.query.find({kw['field']: {'$gte': day_start, '$lte': day_end}})
-        else:
-            orders = Order.query.find({kw['field']: kw['filt']})
-        orders = orders.sort('status_changes.changed_at', -1).limit(250)
-        grouped_orders = groupby(orders, lambda o: o.status_changes[-1].changed_at.strftime('%d/%m/%Y'))
-        all_the_vats = Order.all_the_vats()
-        return dict(orders=grouped_orders, form=OrderFilterForm, value=kw, action=self.mount_point+'/submit_orders',
-                    bill_issue=self.mount_point+'/bill_issue/%s', notes=self.mount_point+'/notes/%s',
-                    all_the_vats=all_the_vats)
+        listing = self._orders_listing(request.GET.get('page', 1), kw['field'], kw['filt'])
+        return self._orders_page(listing, 'submit_orders', kw)
+
+    @expose('json')
+    def orders_json(self, page=1, field=None, filt=None):
+        """Same listing of :meth:`orders` and :meth:`submit_orders` for client side rendering"""
+        if field is not None:
+            if field not in [f[0] for f in FILTER_FIELDS] or not filt:
+                return dict(errors=_('Invalid filter'))
+            try:
+                filt = MaybeDateValidator().to_python({'field': field, 'filt': filt})['filt']
+            except twc.ValidationError as e:
+                return dict(errors=unicode(e))
+        listing = self._orders_listing(page, field, filt)
+        days = [dict(date=date.isoformat(), count=count, orders=[order.list_columns() for order in orders])
+                for date, count, orders in listing.days]
+        return dict(days=days, page=listing.page, pages=listing.pages, total=listing.total,
+                    vat_rates=Order.all_the_vats())
+
+    @expose(content_type=CUSTOM_CONTENT_TYPE)
+    def export_orders(self, format='csv', date_from=None, date_to=None, status=None):
+        """Streams the accounting export of the orders created between date_from and date_to (dd/mm/yyyy)"""
+        query = {}
+        try:
+            if date_from:
+                query.setdefault('creation_date', {})['$gte'] = datetime.strptime(date_from, '%d/%m/%Y')
+            if date_to:
+                query.setdefault('creation_date', {})['$lt'] = datetime.strptime(date_to, '%d/%m/%Y') + timedelta(days=1)
+        except ValueError:
+            abort(400, _('Date format must be dd/mm/yyyy'))
+        if status:
+            query['status'] = status
+
+        try:
+            content = OrderManager.export(format, query)
+        except UnsupportedExportFormatException as e:
+            abort(400, unicode(e))
+
+        response.content_type = EXPORT_CONTENT_TYPES[format]
+        response.headers['Content-Disposition'] = str('attachment; filename="orders.%s"' % format)
+        return content
 
     @expose()
     def bill_issue(self, order_id):
@@ -1,9 +1,8 @@
-from tg import config
-from tgext.ecommerce.lib.utils import preferred_language
+from tgext.ecommerce.lib.utils import localized
 
 
 def i_entity_value(entity, key):
-    return entity.get(key).get(preferred_language(), entity.get(key).get(config.lang))
+    return localized(entity.get(key))
 
 def format_price(price):
     return ('%0.3f' % price)[0:-1]
\ No newline at end of file
@@ -1,11 +1,25 @@
+from collections import Counter
 from contextlib import contextmanager
 from datetime import datetime, timedelta
-from itertools import chain
+from functools import partial
+from itertools import chain, islice
 import logging
+from multiprocessing.pool import ThreadPool
 import os
-from ming.odm import mapper
-from pymongo.errors import DuplicateKeyError
-from tgext.ecommerce.model import DBSession, Cart, Product, Setting
+import uuid
+from bson import SON
+import tg
+from ming import ASCENDING, DESCENDING
+from tg.util import Bunch
+from tgext.ecommerce.lib.cart import cart_lock
+from tgext.ecommerce.lib.exceptions import LeaseLostException
+from tgext.ecommerce.lib.job_queue import job_queue
+from tgext.ecommerce.lib.order import OrderManager
+from tgext.ecommerce.lib.payments.gateway import PaymentGateway, get_gateway
+from tgext.ecommerce.lib.product import ProductManager
+from tgext.ecommerce.lib.report import ReportManager
+from tgext.ecommerce.model import DBSession, Cart, Order, Product
+from tgext.ecommerce.model.models import CartTtlExt
 
 log = logging.getLogger('tgext.ecommerce')
 
@@ -20,18 +34,20 @@ def clean_expired_cart(expired_cart):
     log.warn('Expiring Cart %s for user %s', expired_cart._id, expired_cart.user_id)
 
     for sku, item in expired_cart.items.iteritems():
-        DBSession.update(Product, {'configurations.sku': sku},
-                         {'$inc': {'configurations.$.qty': item['qty']}})
+        ProductManager.restock(sku, item['qty'])
 
     expired_cart.delete()
 
 
-def clean_expired_carts(clear_all=False):
+def clean_expired_carts(clear_all=False, lease=None, batch_size=1000):
+    """Gives back the items of the expired carts, or of every cart with ``clear_all``.
+
+    :param lease: the lease under which all the carts are cleared, its fence is checked
+                  every batch and the cleanup stops as soon as it's lost
+    """
     with cleanup_session(DBSession):
         if clear_all:
-            expired_carts = Cart.query.find().all()
-            for c in expired_carts:
-                clean_expired_cart(c)
+            clear_all_carts(lease, batch_size)
         else:
             now = datetime.utcnow()
             shifted_expire = now + timedelta(minutes=5)
@@ -44,41 +60,372 @@ def clean_expired_carts(clear_all=False):
                 clean_expired_cart(expired_cart)
 
 
+def next_cart_expiration():
+    """When the first of the current carts expires, ``None`` without carts"""
+    first = list(DBSession.impl.db.carts.find({}, fields=['expires_at']).sort('expires_at', ASCENDING).limit(1))
+    return first[0]['expires_at'] if first else None
+
+
+def clear_all_carts(lease=None, batch_size=1000, flush_skus=5000):
+    """Removes every cart giving back its items, streaming the carts in batches.
+
+    The quantities are merged per sku and given back with bulk writes once
+    ``flush_skus`` different skus piled up and at the end. Progress is saved in the
+    ``carts_clear_checkpoint`` setting after each batch, so an interrupted run
+    resumes from the last removed cart with the quantities not yet given back.
+
+    Every flush is recorded in the checkpoint with its id before being applied,
+    and each sku is restocked only once per flush id, so a flush interrupted
+    halfway is completed on resume without giving back anything twice.
+
+    It must run while the carts are locked, as it removes the carts up to the
+    checkpoint without looking at them again.
+    """
+    carts = DBSession.impl.db.carts
+    settings = DBSession.impl.db.ecommerce_settings
+
+    def save_checkpoint(last_id, pending, flushing=None):
+        settings.update({'setting': 'carts_clear_checkpoint'},
+                        {'$set': {'value': {'last_id': last_id, 'pending': pending.items(),
+                                            'fence': lease and lease.fence, 'flushing': flushing}}},
+                        upsert=True)
+
+    def flush(last_id, pending, flush_id=None):
+        flushing = {'id': flush_id or uuid.uuid4().hex, 'quantities': pending.items()}
+        save_checkpoint(last_id, Counter(), flushing)
+        ProductManager.restock_many(pending, flush_id=flushing['id'])
+        save_checkpoint(last_id, Counter())
+
+    checkpoint = settings.find_one({'setting': 'carts_clear_checkpoint'})
+    if checkpoint is not None:
+        value = checkpoint['value']
+        if lease is not None:
+            lease.ensure_held()
+            if value.get('fence') is not None and value['fence'] > lease.fence:
+                raise LeaseLostException('Carts clear checkpoint saved with fence %s, newer than %s' %
+                                         (value['fence'], lease.fence))
+        last_id, pending = value['last_id'], Counter(dict(value['pending']))
+        log.warn('Resuming carts clear after %s with %s skus to restock', last_id, len(pending))
+        flushing = value.get('flushing')
+        if flushing:
+            log.warn('Completing interrupted restock %s', flushing['id'])
+            flush(last_id, Counter(dict(flushing['quantities'])), flushing['id'])
+    else:
+        last_id, pending = None, Counter()
+
+    query = {} if last_id is None else {'_id': {'$gt': last_id}}
+    cursor = carts.find(query, fields=['items']).sort('_id', ASCENDING).batch_size(batch_size)
+    removed = 0
+    while True:
+        batch = list(islice(cursor, batch_size))
+        if not batch:
+            break
+        if lease is not None:
+            lease.ensure_held()
+
+        for cart in batch:
+            for sku, item in cart.get('items', {}).iteritems():
+                pending[sku] += item['qty']
+        last_id = batch[-1]['_id']
+        save_checkpoint(last_id, pending)
+        carts.remove({'_id': {'$lte': last_id}})
+        removed += len(batch)
+
+        if len(pending) >= flush_skus:
+            flush(last_id, pending)
+            pending = Counter()
+        log.warn('Cleared %s carts', removed)
+
+    if lease is not None:
+        lease.ensure_held()
+    flush(last_id, pending)
+    settings.remove({'setting': 'carts_clear_checkpoint'})
+    return removed
+
+
+def verify_category_counters():
+    with cleanup_session(DBSession):
+        ProductManager.verify_category_counters()
+
+
+@job_queue.task(max_attempts=5)
+def increase_sold(order_id):
+    """Increases the sold counters with the items of a checked out order, only once per order"""
+    order = None
+    for collection in (DBSession.impl.db.orders, DBSession.impl.db.orders_archive):
+        order = collection.find_and_modify({'_id': order_id, 'sold_counted': {'$ne': True}},
+                                           {'$set': {'sold_counted': True}},
+                                           fields=['items.sku', 'items.qty'])
+        if order is not None:
+            break
+    if order is None:
+        # Already counted, or the order is gone
+        return
+
+    sold = Counter()
+    for item in order['items']:
+        sold[item['sku']] += item['qty']
+    Product.increase_sold_many(dict(sold))
+
+
+def refresh_bestsellers():
+    with cleanup_session(DBSession):
+        return ProductManager.refresh_bestsellers()
+
+
+def register_jobs(runner):
+    """Registers the periodic jobs of the shop on a :class:`JobRunner`"""
+    config = tg.config
+    runner.register('clean_expired_carts', clean_expired_carts, int(config.get('carts.clean_interval', 60)),
+                    jitter=0, deadline=next_cart_expiration)
+    # Carts expiring before the next cleanup bring it forward
+    CartTtlExt.expiration_listeners[:] = [partial(runner.wake, 'clean_expired_carts')]
+    runner.register('verify_category_counters', verify_category_counters,
+                    int(config.get('category_counters.verify_interval', 3600)))
+    runner.register('reconcile_payments', reconcile_payments, int(config.get('payments.reconcile_interval', 300)))
+    runner.register('refresh_bestsellers', refresh_bestsellers, int(config.get('bestsellers.refresh_interval', 600)))
+    if config.get('sales_rollups.rebuild_interval'):
+        # Not scheduled by default, it can only correct the days no longer taking orders
+        runner.register('rebuild_sales_rollups', rebuild_sales_rollups, int(config['sales_rollups.rebuild_interval']))
+    runner.register('archive_orders', archive_orders, int(config.get('orders.archive_interval', 86400)))
+    return runner
+
+
+def backfill_vat_rates_breakdown(batch_size=500):
+    """Stores the per VAT rate breakdown on the orders created before it was precomputed"""
+    orders = DBSession.impl.db.orders
+    fields = ['items.rate', 'items.gross_price', 'items.qty', 'applied_discount', 'gross_total', 'currencies']
+    updated = 0
+    while True:
+        batch = list(orders.find({'vat_rates_breakdown': {'$exists': False}}, fields=fields).limit(batch_size))
+        if not batch:
+            break
+
+        bulk = orders.initialize_unordered_bulk_op()
+        for order in batch:
+            breakdown = Order.compute_vat_rates_breakdown(order.get('items', []), order.get('applied_discount', 0),
+                                                          order.get('gross_total'), order.get('currencies'))
+            bulk.find({'_id': order['_id']}).update_one(
+                {'$set': {'vat_rates_breakdown': Order.vat_rates_breakdown_from(breakdown)}}
+            )
+        bulk.execute()
+        updated += len(batch)
+        log.warn('Stored VAT rates breakdown of %s orders', updated)
+    return updated
+
+
+def backfill_order_search_terms(batch_size=500):
+    """Stores the customer search terms on the orders created before they were indexed"""
+    orders = DBSession.impl.db.orders
+    updated = 0
+    while True:
+        batch = list(orders.find({'search_terms': {'$exists': False}},
+                                 fields=['user', 'payer_info']).limit(batch_size))
+        if not batch:
+            break
+
+        bulk = orders.initialize_unordered_bulk_op()
+        for order in batch:
+            order = Bunch(_id=order['_id'], user=order.get('user'), payer_info=order.get('payer_info'))
+            bulk.find({'_id': order._id}).update_one({'$set': {'search_terms': Order.search_terms_of(order)}})
+        bulk.execute()
+        updated += len(batch)
+        log.warn('Stored search terms of %s orders', updated)
+    return updated
+
+
+def backfill_order_summaries(batch_size=500):
+    """Stores the history summary on the orders created before it was introduced"""
+    orders = DBSession.impl.db.orders
+    updated = 0
+    while True:
+        batch = list(orders.find({'summary': {'$exists': False}},
+                                 fields=['items.qty', 'items.details.product_photos']).limit(batch_size))
+        if not batch:
+            break
+
+        bulk = orders.initialize_unordered_bulk_op()
+        for order in batch:
+            order = Bunch(_id=order['_id'], items=order.get('items', []))
+            bulk.find({'_id': order._id}).update_one({'$set': {'summary': Order.summary_of(order)}})
+        bulk.execute()
+        updated += len(batch)
+        log.warn('Stored summary of %s orders', updated)
+    return updated
+
+
+def rebuild_sales_rollups(start=None, end=None, workers=4):
+    """Corrects the daily sales rollups, by default the ones of the last week up to yesterday"""
+    if end is None:
+        end = datetime.utcnow()
+    if start is None:
+        start = end - timedelta(days=7)
+    rebuilt = ReportManager.rebuild(start, end, workers=workers)
+    log.warn('Rebuilt %s sales rollups from %s to %s', rebuilt, start, end)
+    return rebuilt
+
+
+def archive_orders(older_than_days=None, batch_size=500):
+    """Moves the orders older than ``older_than_days`` days to the orders_archive collection.
+
+    Each batch is first copied to the archive and then removed, so an interrupted
+    run can be started again without losing or duplicating orders. Orders are only
+    removed while they still match the copied document, those changed in between
+    are copied again by the next batch.
+    """
+    if older_than_days is None:
+        older_than_days = int(tg.config.get('orders.archive_after_days', 730))
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+
+    db = DBSession.impl.db
+    compressor = tg.config.get('orders.archive_compressor', 'zlib')
+    if compressor and 'orders_archive' not in db.collection_names():
+        db.create_collection('orders_archive',
+                             storageEngine={'wiredTiger': {'configString': 'block_compressor=%s' % compressor}})
+    db.orders_archive.ensure_index([('user_id', ASCENDING), ('creation_date', DESCENDING)])
+
+    archived = 0
+    while True:
+        # Ordered documents, as embedded documents only match with the same key order
+        batch = list(db.orders.find({'creation_date': {'$lt': cutoff}}, as_class=SON)
+                     .sort('creation_date', ASCENDING).limit(batch_size))
+        if not batch:
+            break
+
+        bulk = db.orders_archive.initialize_unordered_bulk_op()
+        for order in batch:
+            bulk.find({'_id': order['_id']}).upsert().replace_one(order)
+        bulk.execute()
+
+        bulk = db.orders.initialize_unordered_bulk_op()
+        for order in batch:
+            bulk.find(order).remove_one()
+        removed = bulk.execute()['nRemoved']
+        if not removed:
+            log.error('Unable to archive orders %s, they keep changing', [order['_id'] for order in batch])
+            break
+
+        archived += removed
+        log.warn('Archived %s orders older than %s', archived, cutoff)
+    return archived
+
+
+def reconcile_payments(batch_size=100, workers=None, older_than=None):
+    """Settles or releases the carts whose payment was started but never completed.
+
+    Carts with a payment started more than ``older_than`` seconds ago are checked
+    against their gateway, a batch at a time, from a bounded pool of threads.
+    Completed payments become orders, failed ones give back their items and remove
+    the cart, pending ones are left alone until the cart expires.
+
+    :returns: the number of settled and released carts
+    """
+    if workers is None:
+        workers = int(tg.config.get('payments.reconcile_workers', 8))
+    if older_than is None:
+        older_than = int(tg.config.get('payments.reconcile_after', 900))
+    cutoff = datetime.utcnow() - timedelta(seconds=older_than)
+
+    carts = DBSession.impl.db.carts
+    reconciled = Counter()
+    pool = ThreadPool(workers)
+    try:
+        with cleanup_session(DBSession):
+            last_id = None
+            while True:
+                query = {'order_info.payment.date': {'$lte': cutoff}}
+                if last_id is not None:
+                    query['_id'] = {'$gt': last_id}
+                batch = list(carts.find(query, fields=['items', 'order_info.payment'])
+                             .sort('_id', ASCENDING).limit(batch_size))
+                if not batch:
+                    break
+                last_id = batch[-1]['_id']
+
+                results = pool.map(_reconcile_payment, batch)
+                completed = dict((cart['_id'], result) for cart, result in zip(batch, results)
+                                 if result.state == PaymentGateway.COMPLETED)
+                failed = [cart for cart, result in zip(batch, results) if result.state == PaymentGateway.FAILED]
+                reconciled['settled'] += _settle_carts(completed)
+                reconciled['released'] += _release_carts(failed)
+    finally:
+        pool.close()
+
+    log.warn('Reconciled payments: %s carts settled, %s released', reconciled['settled'], reconciled['released'])
+    return reconciled['settled'] + reconciled['released']
+
+
+def _reconcile_payment(cart):
+    payment = cart['order_info']['payment']
+    try:
+        return get_gateway(payment['backend']).reconcile(payment)
+    except Exception:
+        log.exception('Unable to reconcile payment %s of cart %s', payment.get('id'), cart['_id'])
+        return Bunch(state=PaymentGateway.PENDING, payer_info={})
+
+
+def _settle_carts(completed):
+    settled = 0
+    for cart in Cart.query.find({'_id': {'$in': list(completed)}}):
+        payment = completed[cart._id]
+        OrderManager.create(cart, payment_date=datetime.utcnow(), payer_info=payment.payer_info,
+                            payment_type=cart.order_info.payment.get('backend'))
+        settled += 1
+    return settled
+
+
+def _release_carts(failed):
+    if not failed:
+        return 0
+
+    carts = DBSession.impl.db.carts
+    quantities = Counter()
+    released = 0
+    for cart in failed:
+        # Carts whose customer started a new payment in the meanwhile are kept,
+        # and only the carts removed here are restocked, not those someone else removed
+        removed = carts.find_and_modify({'_id': cart['_id'],
+                                         'order_info.payment.id': cart['order_info']['payment']['id']},
+                                        remove=True, fields=['items'])
+        if removed is None:
+            continue
+        for sku, item in removed.get('items', {}).iteritems():
+            quantities[sku] += item['qty']
+        released += 1
+    ProductManager.restock_many(quantities)
+    return released
+
+
+def migrate_order_indexes():
+    """Builds in background the order indexes added over time and drops the superseded ones"""
+    db = DBSession.impl.db
+    for collection in (db.orders, db.orders_archive):
+        collection.ensure_index([('items.sku', ASCENDING), ('creation_date', DESCENDING)], background=True)
+        collection.ensure_index([('user_id', ASCENDING), ('creation_date', DESCENDING)], background=True)
+        if 'user_id_1' in collection.index_information():
+            collection.drop_index('user_id_1')
+
+
 def cart_locked_by_me():
-    locked_by_me = Setting.query.find({'setting': 'cart_locked', 'value': os.getpid()}).first()
-    return locked_by_me is not None
+    return cart_lock.is_mine()
 
 
 def lock_carts():
-    settings_collection = mapper(Setting).collection
+    """Locks all the carts and clears them, giving back their items.
 
-    # Ensure there is the lock row
-    try:
-        DBSession.impl.insert(settings_collection({'setting': 'cart_locked', 'value': 0}))
-    except DuplicateKeyError:
-        pass
-
-    # Try to get the lock
-    mypid = os.getpid()
-    locked = DBSession.impl.update_partial(settings_collection,
-                                           {'setting': 'cart_locked',
-                                            'value': 0},
-                                           {'$set': {'value': mypid}})
-
-    if locked.get('updatedExisting', False):
-        log.warn('Cart Locked by %s...' % mypid)
-        clean_expired_carts(clear_all=True)
-    else:
-        log.warn('Cart already locked!')
+    The lock is a lease kept alive by this process until :func:`unlock_carts`,
+    if the process dies it lapses after ``cart_locked.lease_ttl`` seconds.
+    """
+    if not cart_lock.acquire():
+        log.warn('Cart already locked by %s', cart_lock.holder())
+        return False
+
+    cart_lock.keep_alive()
+    log.warn('Cart Locked by %s with fence %s...', os.getpid(), cart_lock.fence)
+    clean_expired_carts(clear_all=True, lease=cart_lock)
+    return True
 
 
 def unlock_carts():
-    mypid = os.getpid()
-    settings_collection = mapper(Setting).collection
-    locked = DBSession.impl.update_partial(settings_collection,
-                                           {'setting': 'cart_locked',
-                                            'value': mypid},
-                                           {'$set': {'value': 0}})
-
-    if locked.get('updatedExisting', False):
-        log.warn('Cart Unlocked by %s...' % mypid)
\ No newline at end of file
+    if cart_lock.release():
+        log.warn('Cart Unlocked by %s...', os.getpid())
\ No newline at end of file
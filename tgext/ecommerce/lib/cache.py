@@ -0,0 +1,375 @@
+# coding=utf-8
+from __future__ import unicode_literals
+import calendar
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from bson import ObjectId
+import tg
+from ming import ASCENDING
+from pymongo.errors import CollectionInvalid, DuplicateKeyError, OperationFailure
+
+log = logging.getLogger('tgext.ecommerce')
+
+NOVALUE = object()
+
+
+class ShopCache(object):
+    """Cache of the shop, a process local LRU in front of the ``ecommerce_cache`` collection.
+
+    Every entry carries tags like ``product:<id>``, ``category:<id>`` or ``vat_rates``
+    and :meth:`invalidate` drops all the entries with a tag, both from the
+    shared collection and from the local caches of every process: invalidations
+    are published in the ``ecommerce_cache_events`` capped collection, that each
+    process follows with a tailable cursor polled at most every ``cache.poll_interval``
+    seconds when the cache is used.
+
+    Expired entries are kept ``cache.grace`` more seconds, so that
+    :meth:`get_or_create` can serve them while a single caller recomputes them.
+
+    Shared entries are stored as they are, so their values must be
+    BSON serializable, other values can still be cached with ``shared=False``.
+    """
+    def __init__(self, size=None, ttl=None, poll_interval=None, grace=None, lock_timeout=None):
+        self._size = size
+        self._ttl = ttl
+        self._poll_interval = poll_interval
+        self._grace = grace
+        self._lock_timeout = lock_timeout
+        self._local = OrderedDict()
+        self._flights = {}
+        self._lock = threading.RLock()
+        self._subscribers = {}
+        self._origin = uuid.uuid4().hex
+        self._cursor = None
+        self._polled_at = 0
+        self._poll_lock = threading.RLock()
+        self._prepared = False
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = int(tg.config.get('cache.local_size', 1024))
+        return self._size
+
+    @property
+    def ttl(self):
+        if self._ttl is None:
+            self._ttl = int(tg.config.get('cache.ttl', 600))
+        return self._ttl
+
+    @property
+    def poll_interval(self):
+        if self._poll_interval is None:
+            self._poll_interval = float(tg.config.get('cache.poll_interval', 1))
+        return self._poll_interval
+
+    @property
+    def grace(self):
+        if self._grace is None:
+            self._grace = int(tg.config.get('cache.grace', 60))
+        return self._grace
+
+    @property
+    def lock_timeout(self):
+        if self._lock_timeout is None:
+            self._lock_timeout = int(tg.config.get('cache.lock_timeout', 30))
+        return self._lock_timeout
+
+    @property
+    def _db(self):
+        # Imported here as the models use the cache to publish invalidations
+        from tgext.ecommerce.model import DBSession
+        return DBSession.impl.db
+
+    @property
+    def _entries(self):
+        return self._db.ecommerce_cache
+
+    @property
+    def _events(self):
+        return self._db.ecommerce_cache_events
+
+    def _prepare(self):
+        if self._prepared:
+            return
+        with self._poll_lock:
+            if self._prepared:
+                return
+            try:
+                self._db.create_collection('ecommerce_cache_events', capped=True,
+                                           size=int(tg.config.get('cache.events_size', 1024 * 1024)))
+            except CollectionInvalid:
+                pass
+            self._entries.ensure_index([('tags', ASCENDING)])
+            if 'expires_at_1' in self._entries.index_information():
+                # Expired entries are now kept to be served stale
+                self._entries.drop_index('expires_at_1')
+            self._entries.ensure_index([('stale_until', ASCENDING)], expireAfterSeconds=0)
+            self._events.ensure_index([('tags', ASCENDING), ('_id', ASCENDING)])
+            if self._events.find_one() is None:
+                # Tailable cursors on an empty collection die at once
+                self._events.insert({'tags': [], 'origin': None})
+            self._follow()
+            self._prepared = True
+
+    def _follow(self):
+        self._cursor = self._events.find(tailable=True)
+        for _ in self._cursor:
+            # Skips the invalidations that came before
+            pass
+
+    def subscribe(self, tag, callback):
+        """Calls ``callback(tag)`` whenever ``tag`` gets invalidated by any process"""
+        self._subscribers.setdefault(tag, []).append(callback)
+
+    def get(self, key):
+        """The cached value, :data:`NOVALUE` when missing or expired"""
+        entry = self._entry(key)
+        if entry is None or entry[1] <= time.time():
+            return NOVALUE
+        return entry[0]
+
+    def set(self, key, value, tags=(), ttl=None, shared=True, grace=None, delta=0):
+        """Stores a value for ``ttl`` seconds, kept ``grace`` more seconds to be served stale
+
+        :param delta: seconds it took to compute the value, makes early refreshes more likely
+        """
+        self._prepare()
+        ttl = ttl or self.ttl
+        grace = self.grace if grace is None else grace
+        tags = list(tags)
+        now = time.time()
+        self._remember(key, (value, now + ttl, now + ttl + grace, frozenset(tags), delta))
+        if shared:
+            expires_at = datetime.utcnow() + timedelta(seconds=ttl)
+            self._entries.update({'_id': key},
+                                 {'$set': {'value': value, 'tags': tags, 'delta': delta, 'expires_at': expires_at,
+                                           'stale_until': expires_at + timedelta(seconds=grace)},
+                                  '$unset': {'refresh_until': True}},
+                                 upsert=True)
+
+    def get_or_create(self, key, createfunc, tags=(), ttl=None, shared=True, grace=None, beta=1.0):
+        """The cached value, computed by ``createfunc`` and stored when missing or expired.
+
+        Only one caller at a time computes a key, in the whole cluster for shared
+        entries: on a miss the others wait for its value, while on an expired entry
+        they keep getting the stale one. Entries are also refreshed before they
+        expire with a probability growing as the expiry gets closer and the longer
+        the value takes to compute, scaled by ``beta`` (0 disables it).
+
+        :param tags: the tags of the entry, or a callable returning them for the computed
+                     value, values it returns ``None`` for are not stored.
+
+        A value computed while one of its tags got invalidated is returned
+        but not stored, as it might come from data read before the change.
+        """
+        entry = self._entry(key)
+        if entry is not None:
+            value, expires_at, _, _, delta = entry
+            if time.time() - delta * beta * math.log(1 - random.random()) < expires_at:
+                return value
+            if not self._claim(key, shared):
+                # Someone else is already refreshing it
+                return value
+            try:
+                return self._compute(key, createfunc, tags, ttl, shared, grace, claimed=True)
+            except Exception:
+                log.exception('Unable to refresh cache entry %s, serving the previous value', key)
+                return value
+
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            if self._claim(key, shared):
+                return self._compute(key, createfunc, tags, ttl, shared, grace, claimed=True)
+            entry = self._wait(key, shared, deadline)
+            if entry is not None:
+                return entry[0]
+            # The other caller gave up without storing it, one of the waiters takes over
+        return self._compute(key, createfunc, tags, ttl, shared, grace, claimed=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._local.pop(key, None)
+        self._entries.remove({'_id': key})
+
+    def invalidate(self, *tags):
+        """Drops every entry with any of the given tags, in all the processes"""
+        tags = list(set(tags))
+        if not tags:
+            return
+        self._prepare()
+        self._entries.remove({'tags': {'$in': tags}})
+        self._events.insert({'tags': tags, 'origin': self._origin})
+        self._drop_local(tags)
+
+    def poll(self):
+        """Applies the invalidations published by the other processes, at most every ``poll_interval``"""
+        if time.time() - self._polled_at < self.poll_interval:
+            return
+        with self._poll_lock:
+            if time.time() - self._polled_at < self.poll_interval:
+                return
+            self._polled_at = time.time()
+            self._prepare()
+
+            try:
+                for event in self._cursor:
+                    if event['origin'] != self._origin:
+                        self._drop_local(event['tags'])
+            except OperationFailure:
+                self._cursor = None
+            if self._cursor is None or not self._cursor.alive:
+                # The events since the last poll were overwritten, anything might be stale
+                log.warn('Cache invalidations lost, clearing the local cache')
+                self.clear_local()
+                self._follow()
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+        for tag, callbacks in self._subscribers.items():
+            self._notify(tag, callbacks)
+
+    def _entry(self, key):
+        """The local or shared entry of ``key``, fresh if possible, stale ones included"""
+        self.poll()
+        now = time.time()
+        stale = None
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._local[key] = self._local.pop(key)
+                    return entry
+                if entry[2] > now:
+                    stale = entry
+                else:
+                    del self._local[key]
+
+        shared = self._entries.find_one({'_id': key, 'stale_until': {'$gt': datetime.utcnow()},
+                                         'expires_at': {'$exists': True}})
+        if shared is None or (stale is not None and _epoch(shared['expires_at']) <= stale[1]):
+            return stale
+        entry = (shared['value'], _epoch(shared['expires_at']), _epoch(shared['stale_until']),
+                 frozenset(shared['tags']), shared.get('delta', 0))
+        self._remember(key, entry)
+        return entry
+
+    def _claim(self, key, shared):
+        """Takes the right to compute ``key``, returns ``False`` when someone else has it"""
+        with self._lock:
+            if key in self._flights:
+                return False
+            self._flights[key] = threading.Event()
+        if not shared:
+            return True
+
+        now = datetime.utcnow()
+        until = now + timedelta(seconds=self.lock_timeout)
+        try:
+            self._entries.update({'_id': key, '$or': [{'refresh_until': None}, {'refresh_until': {'$lte': now}}]},
+                                 {'$set': {'refresh_until': until},
+                                  '$setOnInsert': {'tags': [], 'stale_until': until}},
+                                 upsert=True)
+        except DuplicateKeyError:
+            self._land(key)
+            return False
+        return True
+
+    def _land(self, key):
+        with self._lock:
+            flight = self._flights.pop(key, None)
+        if flight is not None:
+            flight.set()
+
+    def _wait(self, key, shared, deadline):
+        """Waits for someone else to compute ``key``.
+
+        ``None`` when they gave up without storing it or didn't in time,
+        checking with a growing pause whether they are still at it.
+        """
+        pause = 0.01
+        while time.time() < deadline:
+            with self._lock:
+                flight = self._flights.get(key)
+            if flight is not None:
+                # Computed in this process, either it's there now or it failed
+                flight.wait(deadline - time.time())
+                return self._entry(key)
+            entry = self._entry(key)
+            if entry is not None or not shared:
+                return entry
+            if self._entries.find_one({'_id': key, 'refresh_until': {'$gt': datetime.utcnow()}},
+                                      fields=['_id']) is None:
+                return None
+            time.sleep(max(0, min(pause, deadline - time.time())))
+            pause = min(pause * 2, 1)
+        return None
+
+    def _compute(self, key, createfunc, tags, ttl, shared, grace, claimed):
+        try:
+            # Tolerates the clocks of the other hosts being a second behind
+            since = ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=1))
+            before = self._invalidations(since) if tags else set()
+            started = time.time()
+            value = createfunc()
+            delta = time.time() - started
+
+            value_tags = tags(value) if callable(tags) else list(tags)
+            if value_tags is not None and not (self._invalidations(since, value_tags) - before):
+                self.set(key, value, value_tags, ttl, shared, grace, delta)
+            elif claimed and shared:
+                self._entries.update({'_id': key}, {'$unset': {'refresh_until': True}})
+            return value
+        except Exception:
+            if claimed and shared:
+                self._entries.update({'_id': key}, {'$unset': {'refresh_until': True}})
+            raise
+        finally:
+            if claimed:
+                self._land(key)
+
+    def _invalidations(self, since, tags=None):
+        self._prepare()
+        query = {'_id': {'$gt': since}}
+        if tags is not None:
+            if not tags:
+                return set()
+            query['tags'] = {'$in': tags}
+        return set(event['_id'] for event in self._events.find(query, fields=['_id']))
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._local.pop(key, None)
+            self._local[key] = entry
+            while len(self._local) > self.size:
+                self._local.popitem(last=False)
+
+    def _drop_local(self, tags):
+        tags = set(tags)
+        with self._lock:
+            for key in [key for key, entry in self._local.iteritems() if entry[3] & tags]:
+                del self._local[key]
+        for tag in tags:
+            self._notify(tag, self._subscribers.get(tag, ()))
+
+    @staticmethod
+    def _notify(tag, callbacks):
+        for callback in callbacks:
+            try:
+                callback(tag)
+            except Exception:
+                log.exception('Cache invalidation subscriber of %s failed', tag)
+
+
+def _epoch(moment):
+    return calendar.timegm(moment.utctimetuple()) + moment.microsecond / 1e6
+
+
+shop_cache = ShopCache()
@@ -2,16 +2,19 @@
 from __future__ import unicode_literals
 from functools import wraps
 from tgext.ecommerce.lib.exceptions import CartLockedException, CartException
+from tgext.ecommerce.lib.lease import MongoLease
 from tgext.ecommerce.lib.product import ProductManager
 from tgext.ecommerce.lib.utils import NoDefault, with_currency
-from tgext.ecommerce.model import models, Setting
+from tgext.ecommerce.model import models
+
+
+cart_lock = MongoLease('cart_locked')
 
 
 def check_cart_lock(f):
     @wraps(f)
     def wrapper(*args, **kw):
-        locked = Setting.query.find({'setting': 'cart_locked'}).first()
-        if locked is not None and locked.value:
+        if cart_lock.holder() is not None:
             raise CartLockedException('The cart is locked')
         return f(*args, **kw)
     return wrapper
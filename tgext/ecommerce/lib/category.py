@@ -1,8 +1,12 @@
 # coding=utf-8
 from __future__ import unicode_literals
+from collections import deque
 from bson import ObjectId
 import tg
+from tgext.ecommerce.lib.cache import shop_cache
+from tgext.ecommerce.lib.category_tree import get_category_tree
 from tgext.ecommerce.lib.exceptions import CategoryAssignedToProductException, CategoryAcestorExistingException
+from tgext.ecommerce.lib.product import ProductManager
 from tgext.ecommerce.lib.utils import slugify, internationalise as i_, NoDefault, slugify_category
 from tgext.ecommerce.model import models
 
@@ -50,8 +54,15 @@ class CategoryManager(object):
     def get_all(cls): #get_categories
         return models.Category.query.find()
 
+    @classmethod
+    def tree(cls):
+        """Cached :class:`CategoryTree` of all the categories, rebuilt after any category change"""
+        return get_category_tree()
+
     @classmethod
     def edit(cls, _id, name, parent, **details):
+        _id = ObjectId(_id)
+        previous = get_category_tree().get(_id)
         slug = slugify_category(name, models)
         ancestors = []
         parent_id = None
@@ -59,20 +70,51 @@ class CategoryManager(object):
             ancestors = [ancestor for ancestor in parent.ancestors]
             ancestors.append(dict(_id=parent._id, details=parent.details, name=parent.name, slug=parent.slug))
             parent_id = parent._id
-        models.Category.query.update({'_id': ObjectId(_id)},
+        models.Category.query.update({'_id': _id},
                                      {'$set': {'name': i_(name),
                                                'slug': slug,
                                                'parent': parent_id,
                                                'details': details,
                                                'ancestors': ancestors}})
 
-        for cat in models.Category.query.find({'ancestors._id': ObjectId(_id)}):
-            parent = models.Category.query.find({'_id': cat.parent}).first()
-            if parent:
-                ancestors = [ancestor for ancestor in parent.ancestors]
-                ancestors.append(dict(_id=parent._id,details=parent.details, name=parent.name, slug=parent.slug))
-                models.Category.query.update({'_id':cat._id}, {'$set': {'ancestors': ancestors}})
+        ancestors.append(dict(_id=_id, details=details, name=i_(name), slug=slug))
+        cls._rewrite_subtree_ancestors(_id, ancestors)
+        shop_cache.invalidate('categories', 'category:%s' % _id)
 
+        if previous is None or previous.get('parent') != parent_id:
+            ProductManager.rebuild_categories_path({'categories_path': _id})
+
+    @classmethod
+    def _rewrite_subtree_ancestors(cls, root_id, root_ancestors):
+        """Rebuilds the ancestors of every descendant of ``root_id`` with a single bulk write.
+
+        New ancestors are computed in memory walking the subtree breadth first,
+        so each category is always rebuilt from its already updated parent.
+
+        :param root_id: the id of the category whose subtree changed
+        :param root_ancestors: the ancestors of the direct children of ``root_id``
+        """
+        collection = models.DBSession.impl.db.categories
+        children = {}
+        for descendant in collection.find({'ancestors._id': root_id},
+                                          fields=['parent', 'details', 'name', 'slug']):
+            children.setdefault(descendant['parent'], []).append(descendant)
+
+        if not children:
+            return
+
+        bulk = collection.initialize_unordered_bulk_op()
+        updates = 0
+        pending = deque([(root_id, root_ancestors)])
+        while pending:
+            parent_id, ancestors = pending.popleft()
+            for child in children.pop(parent_id, []):
+                updates += 1
+                bulk.find({'_id': child['_id']}).update_one({'$set': {'ancestors': ancestors}})
+                pending.append((child['_id'], ancestors + [dict(_id=child['_id'], details=child.get('details', {}),
+                                                                name=child['name'], slug=child.get('slug'))]))
+        if updates:
+            bulk.execute()
 
     @classmethod
     def delete(cls, _id): #delete_category
@@ -83,6 +125,8 @@ class CategoryManager(object):
         models.Category.query.get(_id=ObjectId(_id)).delete()
         models.Product.query.update({'category_id': ObjectId(_id), 'active': False},
                                     {'$set': {'category_id': None}})
+        models.DBSession.flush()
+        ProductManager.rebuild_categories_path({'categories_path': ObjectId(_id)})
 
 
     @classmethod
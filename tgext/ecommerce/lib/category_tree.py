@@ -0,0 +1,116 @@
+# coding=utf-8
+from __future__ import unicode_literals
+import threading
+from bson import ObjectId
+from tgext.ecommerce.lib.cache import shop_cache
+from tgext.ecommerce.lib.utils import localized
+from tgext.ecommerce.model import DBSession
+
+
+class CategoryTree(object):
+    """Immutable snapshot of the whole categories hierarchy.
+
+    Every lookup is a dictionary access, descendants are precomputed
+    per node when the snapshot is built.
+    """
+    def __init__(self, categories):
+        self._nodes = {}
+        self._children = {}
+        self._roots = []
+
+        for category in categories:
+            self._nodes[category['_id']] = category
+
+        ordered = sorted(self._nodes.itervalues(), key=lambda c: c.get('sort_weight', 0))
+        for category in ordered:
+            parent = category.get('parent')
+            if parent is not None and parent in self._nodes:
+                self._children.setdefault(parent, []).append(category['_id'])
+            else:
+                self._roots.append(category['_id'])
+
+        self._path = {}
+        self._descendants = {}
+        for root in self._roots:
+            self._visit(root, [])
+
+    def _visit(self, _id, path):
+        path = path + [_id]
+        self._path[_id] = tuple(path)
+        descendants = set()
+        for child in self._children.get(_id, []):
+            descendants.add(child)
+            descendants.update(self._visit(child, path))
+        self._descendants[_id] = frozenset(descendants)
+        return descendants
+
+    def __contains__(self, _id):
+        return ObjectId(_id) in self._nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def get(self, _id):
+        """Raw category document, ``None`` when the category doesn't exist"""
+        return self._nodes.get(ObjectId(_id))
+
+    def roots(self):
+        return list(self._roots)
+
+    def children(self, _id):
+        return list(self._children.get(ObjectId(_id), []))
+
+    def descendants(self, _id):
+        return self._descendants.get(ObjectId(_id), frozenset())
+
+    def subtree(self, _id):
+        """Ids of the category and all its descendants"""
+        _id = ObjectId(_id)
+        if _id not in self._nodes:
+            return frozenset()
+        return self._descendants[_id] | frozenset([_id])
+
+    def path(self, _id):
+        """Ids from the root category down to the given one (included)"""
+        return list(self._path.get(ObjectId(_id), ()))
+
+    def depth(self, _id):
+        return len(self._path.get(ObjectId(_id), ())) - 1
+
+    def name(self, _id, language=None):
+        category = self.get(_id)
+        if category is None:
+            return None
+        return localized(category['name'], language)
+
+    def breadcrumb(self, _id, language=None):
+        return [(ancestor, self.name(ancestor, language)) for ancestor in self.path(_id)]
+
+
+_tree = None
+_tree_lock = threading.Lock()
+
+
+def get_category_tree():
+    """Process wide category tree, built from the categories collection on first access
+    and dropped whenever any process changes the categories
+    """
+    global _tree
+    shop_cache.poll()
+    tree = _tree
+    if tree is None:
+        with _tree_lock:
+            if _tree is None:
+                categories = DBSession.impl.db.categories.find({}, fields=['name', 'slug', 'parent', 'sort_weight'])
+                _tree = CategoryTree(categories)
+            tree = _tree
+    return tree
+
+
+def invalidate_category_tree(tag=None):
+    global _tree
+    with _tree_lock:
+        _tree = None
+
+
+shop_cache.subscribe('categories', invalidate_category_tree)
@@ -31,4 +31,19 @@ class CartException(EcommerceException):
 
 
 class CartLockedException(CartException):
-    pass
\ No newline at end of file
+    pass
+
+class OrderException(EcommerceException):
+    pass
+
+
+class UnsupportedExportFormatException(OrderException):
+    pass
+
+
+class PaymentGatewayException(EcommerceException):
+    pass
+
+
+class LeaseLostException(EcommerceException):
+    pass
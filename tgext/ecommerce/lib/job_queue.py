@@ -0,0 +1,217 @@
+# coding=utf-8
+from __future__ import unicode_literals
+from datetime import datetime, timedelta
+import logging
+import os
+import random
+import socket
+import threading
+import uuid
+import tg
+from ming import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+from tgext.ecommerce.lib.utils import language_override
+from tgext.ecommerce.model import DBSession
+
+log = logging.getLogger('tgext.ecommerce')
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+class Task(object):
+    def __init__(self, name, func, max_attempts, priority, visibility_timeout):
+        self.name = name
+        self.func = func
+        self.max_attempts = max_attempts
+        self.priority = priority
+        self.visibility_timeout = visibility_timeout
+
+
+class JobQueue(object):
+    """Durable queue of background jobs stored in the ``ecommerce_jobs`` collection.
+
+    Jobs are claimed atomically by a single worker and stay invisible to the
+    others for the ``visibility_timeout`` of their task: if the worker dies
+    they become visible again and are retried, so tasks must tolerate
+    running more than once. Failed jobs are retried with exponential backoff
+    up to ``max_attempts`` times, higher ``priority`` jobs are claimed first.
+    """
+    def __init__(self):
+        self.tasks = {}
+
+    @property
+    def _jobs(self):
+        return DBSession.impl.db.ecommerce_jobs
+
+    @property
+    def visibility_timeout(self):
+        return int(tg.config.get('job_queue.visibility_timeout', 300))
+
+    def task(self, name=None, max_attempts=3, priority=0, visibility_timeout=None):
+        """Decorator registering a function that can be enqueued by name
+
+        :param visibility_timeout: seconds a claimed job is hidden from the other workers,
+                                   ``job_queue.visibility_timeout`` by default
+        """
+        def register(func):
+            task_name = name or func.__name__
+            self.tasks[task_name] = Task(task_name, func, max_attempts, priority, visibility_timeout)
+            return func
+        return register
+
+    def ensure_indexes(self):
+        self._jobs.ensure_index([('status', ASCENDING), ('priority', DESCENDING), ('visible_at', ASCENDING)])
+        self._jobs.ensure_index([('key', ASCENDING)], unique=True, sparse=True)
+        self._jobs.ensure_index([('finished_at', ASCENDING)],
+                                expireAfterSeconds=int(tg.config.get('job_queue.keep_finished', 7 * 24 * 3600)))
+
+    def enqueue(self, task, args=(), kwargs=None, priority=None, delay=0, max_attempts=None, key=None,
+                language=None):
+        """Adds a job for ``task``, a task name or a registered function.
+
+        :param key: makes enqueuing idempotent, a job with the same key is only added once
+        :param language: the job runs with it as preferred language, the default one otherwise
+        :returns: the id of the job
+        """
+        name = task if isinstance(task, basestring) else task.__name__
+        registered = self.tasks.get(name)
+        job = {'task': name,
+               'args': list(args),
+               'kwargs': kwargs or {},
+               'priority': priority if priority is not None else (registered.priority if registered else 0),
+               'max_attempts': max_attempts or (registered.max_attempts if registered else 3),
+               'status': QUEUED,
+               'attempts': 0,
+               'created_at': datetime.utcnow(),
+               'visible_at': datetime.utcnow() + timedelta(seconds=delay),
+               'language': language}
+        if key is None:
+            return self._jobs.insert(job)
+
+        job['key'] = key
+        try:
+            result = self._jobs.update({'key': key}, {'$setOnInsert': job}, upsert=True)
+        except DuplicateKeyError:
+            result = {}
+        return result.get('upserted') or self._jobs.find_one({'key': key}, fields=['_id'])['_id']
+
+    def claim(self, worker_id):
+        """Takes the next visible job, ``None`` when there is nothing to do"""
+        now = datetime.utcnow()
+        job = self._jobs.find_and_modify(
+            {'status': {'$in': [QUEUED, RUNNING]}, 'visible_at': {'$lte': now}},
+            {'$set': {'status': RUNNING, 'claimed_by': worker_id, 'claimed_at': now,
+                      'visible_at': now + timedelta(seconds=self.visibility_timeout)},
+             '$inc': {'attempts': 1}},
+            sort=[('priority', DESCENDING), ('visible_at', ASCENDING)],
+            new=True
+        )
+        task = job and self.tasks.get(job['task'])
+        if task is not None and task.visibility_timeout is not None:
+            self._jobs.update({'_id': job['_id'], 'attempts': job['attempts']},
+                              {'$set': {'visible_at': now + timedelta(seconds=task.visibility_timeout)}})
+        return job
+
+    def execute(self, job):
+        """Runs a claimed job and records its outcome, returns whether it succeeded"""
+        # Only the worker holding the current attempt can record it
+        claim = {'_id': job['_id'], 'attempts': job['attempts'], 'status': RUNNING}
+        task = self.tasks.get(job['task'])
+        try:
+            if task is None:
+                raise LookupError('Unknown task %s' % job['task'])
+            with language_override(job.get('language') or tg.config.lang):
+                task.func(*job['args'], **dict((str(k), v) for k, v in job['kwargs'].iteritems()))
+        except Exception as e:
+            log.exception('Job %s (%s) failed, attempt %s', job['_id'], job['task'], job['attempts'])
+            error = '%s: %s' % (e.__class__.__name__, e)
+            if job['attempts'] >= job['max_attempts']:
+                self._jobs.update(claim, {'$set': {'status': FAILED, 'last_error': error,
+                                                   'finished_at': datetime.utcnow()}})
+            else:
+                backoff = min(3600, 2 ** job['attempts'] * random.uniform(5, 10))
+                self._jobs.update(claim, {'$set': {'status': QUEUED, 'last_error': error,
+                                                   'visible_at': datetime.utcnow() + timedelta(seconds=backoff)}})
+            return False
+
+        self._jobs.update(claim, {'$set': {'status': DONE, 'finished_at': datetime.utcnow()}})
+        return True
+
+    def work(self, worker_id):
+        """Claims and runs a single job, returns ``False`` when the queue was empty"""
+        job = self.claim(worker_id)
+        if job is None:
+            return False
+        self.execute(job)
+        return True
+
+    def counts(self):
+        """Number of jobs in each status"""
+        result = self._jobs.aggregate([{'$group': {'_id': '$status', 'count': {'$sum': 1}}}])
+        return dict((row['_id'], row['count']) for row in result['result'])
+
+
+class JobWorkers(object):
+    """Pool of threads running the jobs of a :class:`JobQueue`, polling it when idle"""
+    def __init__(self, queue, workers=None, poll_interval=None):
+        self.queue = queue
+        self._workers = workers
+        self._poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads = []
+
+    @property
+    def workers(self):
+        if self._workers is None:
+            self._workers = int(tg.config.get('job_queue.workers', 2))
+        return self._workers
+
+    @property
+    def poll_interval(self):
+        if self._poll_interval is None:
+            self._poll_interval = float(tg.config.get('job_queue.poll_interval', 1))
+        return self._poll_interval
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        self.queue.ensure_indexes()
+        for i in range(self.workers):
+            worker_id = '%s:%s:%s:%s' % (socket.gethostname(), os.getpid(), i, uuid.uuid4().hex[:8])
+            thread = threading.Thread(target=self._loop, args=(worker_id, ), name='ecommerce-jobs-%s' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def run_forever(self):
+        """Runs the workers until interrupted, for a dedicated worker process"""
+        self.start()
+        try:
+            while not self._stop.wait(3600):
+                pass
+        except KeyboardInterrupt:
+            self.stop()
+
+    def _loop(self, worker_id):
+        while not self._stop.is_set():
+            try:
+                worked = self.queue.work(worker_id)
+            except Exception:
+                log.exception('Job worker %s failed', worker_id)
+                worked = False
+            finally:
+                DBSession.flush_all()
+                DBSession.close_all()
+            if not worked:
+                self._stop.wait(self.poll_interval)
+
+
+job_queue = JobQueue()
+job_workers = JobWorkers(job_queue)
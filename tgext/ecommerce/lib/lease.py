@@ -0,0 +1,139 @@
+# coding=utf-8
+from __future__ import unicode_literals
+from datetime import datetime, timedelta
+import logging
+import os
+import socket
+import threading
+import uuid
+import tg
+from pymongo.errors import DuplicateKeyError
+from tgext.ecommerce.lib.exceptions import LeaseLostException
+from tgext.ecommerce.model import DBSession
+
+log = logging.getLogger('tgext.ecommerce')
+
+_FREE = datetime.utcfromtimestamp(0)
+
+
+class MongoLease(object):
+    """Lock on a named resource shared by all the processes of every host, stored in the settings.
+
+    The holder is identified by host, pid and a random token and owns the lock
+    only until the lease expires, so it has to :meth:`renew` it (or :meth:`keep_alive`)
+    while working. When the holder dies the lease lapses and anyone can take it over.
+
+    Every acquisition increments the ``fence``: long running work checks it
+    through :meth:`ensure_held` and stops as soon as someone else took over.
+    """
+    def __init__(self, name, ttl=None):
+        self.name = name
+        self._ttl = ttl
+        self.token = uuid.uuid4().hex
+        self.fence = None
+        self._keep_alive = None
+
+    @property
+    def ttl(self):
+        if self._ttl is None:
+            self._ttl = int(tg.config.get('%s.lease_ttl' % self.name, 60))
+        return self._ttl
+
+    @property
+    def _settings(self):
+        return DBSession.impl.db.ecommerce_settings
+
+    def _ensure_setting(self):
+        try:
+            self._settings.insert({'setting': self.name, 'value': self._free_value()})
+        except DuplicateKeyError:
+            # Locks written before leases existed held a pid and never expired
+            self._settings.update({'setting': self.name, 'value': {'$not': {'$type': 3}}},
+                                  {'$set': {'value': self._free_value()}})
+
+    @staticmethod
+    def _free_value():
+        return {'host': None, 'pid': None, 'token': None, 'expires_at': _FREE, 'fence': 0}
+
+    def acquire(self):
+        """Takes the lease if it's free or expired, returns whether it was taken"""
+        self._ensure_setting()
+        now = datetime.utcnow()
+        acquired = self._settings.find_and_modify(
+            {'setting': self.name, '$or': [{'value.token': None}, {'value.expires_at': {'$lte': now}}]},
+            {'$set': {'value.host': socket.gethostname(), 'value.pid': os.getpid(), 'value.token': self.token,
+                      'value.expires_at': now + timedelta(seconds=self.ttl)},
+             '$inc': {'value.fence': 1}},
+            new=True
+        )
+        if acquired is None:
+            return False
+
+        self.fence = acquired['value']['fence']
+        log.warn('Lease %s taken by %s:%s with fence %s', self.name, acquired['value']['host'],
+                 acquired['value']['pid'], self.fence)
+        return True
+
+    def renew(self):
+        """Extends the lease, returns ``False`` when it's no longer ours"""
+        renewed = self._settings.update({'setting': self.name, 'value.token': self.token, 'value.fence': self.fence,
+                                         'value.expires_at': {'$gt': datetime.utcnow()}},
+                                        {'$set': {'value.expires_at': datetime.utcnow() +
+                                                                      timedelta(seconds=self.ttl)}})
+        return renewed.get('updatedExisting', False)
+
+    def release(self):
+        """Gives back the lease, returns ``False`` when it was not ours"""
+        self._stop_keep_alive()
+        free = self._free_value()
+        free.pop('fence')
+        released = self._settings.update({'setting': self.name, 'value.token': self.token},
+                                         {'$set': dict(('value.%s' % k, v) for k, v in free.iteritems())})
+        self.fence = None
+        return released.get('updatedExisting', False)
+
+    def holder(self):
+        """The value of the lease while it's held by anyone, ``None`` when it's free"""
+        setting = self._settings.find_one({'setting': self.name})
+        value = setting and setting['value']
+        if not isinstance(value, dict):
+            return None
+        if value.get('token') is None or value['expires_at'] <= datetime.utcnow():
+            return None
+        return value
+
+    def is_mine(self):
+        holder = self.holder()
+        return holder is not None and holder['token'] == self.token and holder['fence'] == self.fence
+
+    def ensure_held(self):
+        """Fencing check for long running work done under the lease.
+
+        :raises LeaseLostException: when the lease expired or was taken over
+        """
+        if not self.is_mine():
+            raise LeaseLostException('Lease %s with fence %s is no longer held' % (self.name, self.fence))
+
+    def keep_alive(self):
+        """Renews the lease from a background thread until it's released or lost"""
+        self._stop_keep_alive()
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.ttl / 3.0):
+                try:
+                    if not self.renew():
+                        log.error('Lease %s with fence %s was lost', self.name, self.fence)
+                        return
+                except Exception:
+                    log.exception('Unable to renew lease %s', self.name)
+
+        thread = threading.Thread(target=renew, name='lease-%s' % self.name)
+        thread.daemon = True
+        thread.start()
+        self._keep_alive = stop
+
+    def _stop_keep_alive(self):
+        if self._keep_alive is not None:
+            self._keep_alive.set()
+            self._keep_alive = None
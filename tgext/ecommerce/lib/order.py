@@ -1,15 +1,37 @@
 # coding=utf-8
 from __future__ import unicode_literals
 from bson import ObjectId
+import csv
+from itertools import chain, imap, islice
 import datetime
-from tgext.ecommerce.model import models, Product
+from io import BytesIO
+import math
+import os
+import tempfile
+import tg
+from ming import ASCENDING
+from ming.odm import mapper
+from tg.util import Bunch
+from tgext.ecommerce.lib.exceptions import UnsupportedExportFormatException
+from tgext.ecommerce.lib.job_queue import job_queue
+from tgext.ecommerce.lib.report import ReportManager
+from tgext.ecommerce.model import models
 from tgext.ecommerce.lib.utils import apply_vat, with_currency
 
 
 class OrderManager(object):
     @classmethod
     def create(cls, cart, payment_date=None, payer_info=None, status='created', payment_type=None, **details): #create_order
+        """Turns a cart into an order.
 
+        The cart id is the idempotency key of the checkout: the order is written
+        with an upsert keyed on it together with the follow up steps still to apply
+        (the queued sold counters, sales rollups and VAT rates), each step is removed
+        from ``checkout.pending`` as it gets applied and the cart removal is a no-op
+        when it's already gone. So calling it again for the same cart after a failure
+        or timeout completes what was left without duplicating anything.
+        Each step is a single round trip whatever the number of items.
+        """
         if payer_info is None:
             payer_info = {}
 
@@ -17,45 +39,123 @@ class OrderManager(object):
             payment_type = ''
 
         items = []
+        sold = {}
         for cart_item in cart.items.values():
             items.append(dict(name=cart_item.get('name'), variety=cart_item.get('variety'),
-                              category_name=cart_item.get('category_name', {}), qty=cart_item.get('qty'),
+                              category_name=cart_item.get('category_name', {}),
+                              category_id=cart_item.get('category_id'), qty=cart_item.get('qty'),
                               sku=cart_item.get('sku'), net_price=cart_item.get('price'), vat=cart_item.get('vat'),
                               rate=cart_item.get('rate'), gross_price=cart_item.get('price') + cart_item.get('vat'),
                               base_vat=cart_item.get('base_vat'), base_rate=cart_item.base_rate,
                               details=dict(cart_item.get('product_details').items()+cart_item.get('details').items())))
-            Product.increase_sold(cart_item.get('sku'), qty=cart_item.get('qty'))
-
-        order = models.Order(_id=cart._id,
-                             user_id=cart.user_id,
-                             payment_date=payment_date,
-                             creation_date=datetime.datetime.utcnow(),
-                             shipment_info=cart.order_info.shipment_info,
-                             bill=cart.order_info.bill,
-                             bill_info=cart.order_info.bill_info or {},
-                             payer_info=payer_info,
-                             items=items,
-                             payment_type=payment_type,
-                             net_total=cart.subtotal,
-                             tax=cart.tax,
-                             gross_total=cart.total,
-                             shipping_charges=cart.order_info.shipping_charges,
-                             total=cart.total+cart.order_info.shipping_charges,
-                             due=cart.order_info.due,
-                             discounts=cart.order_info.discounts,
-                             applied_discount= - cart.order_info.applied_discount,
-                             status=status,
-                             notes=cart.order_info.notes,
-                             message=cart.order_info.message,
-                             details=details,
-                             currencies=cart.order_info.currencies)
-        cart.delete()
-        models.DBSession.flush()
-        return order
+            sold[cart_item.get('sku')] = sold.get(cart_item.get('sku'), 0) + cart_item.get('qty')
+
+        vat_rates_breakdown = models.Order.compute_vat_rates_breakdown(items, - cart.order_info.applied_discount,
+                                                                       cart.total, cart.order_info.currencies)
+
+        order = Bunch(_id=cart._id,
+                      user_id=cart.user_id,
+                      payment_date=payment_date,
+                      creation_date=datetime.datetime.utcnow(),
+                      shipment_info=cart.order_info.shipment_info,
+                      bill=cart.order_info.bill,
+                      bill_info=cart.order_info.bill_info or {},
+                      payer_info=payer_info,
+                      items=items,
+                      payment_type=payment_type,
+                      payment=dict(cart.order_info.payment or {}),
+                      net_total=cart.subtotal,
+                      tax=cart.tax,
+                      gross_total=cart.total,
+                      shipping_charges=cart.order_info.shipping_charges,
+                      total=cart.total+cart.order_info.shipping_charges,
+                      due=cart.order_info.due,
+                      discounts=cart.order_info.discounts,
+                      applied_discount= - cart.order_info.applied_discount,
+                      vat_rates_breakdown=models.Order.vat_rates_breakdown_from(vat_rates_breakdown),
+                      status=status,
+                      status_changes=[],
+                      notes=cart.order_info.notes,
+                      message=cart.order_info.message,
+                      details=details,
+                      currencies=cart.order_info.currencies,
+                      checkout={'completed': False, 'attempts': 0})
+        models.OrderStatusExt.prepare(order)
+        document = mapper(models.Order).collection.make(order)
+        _id = document.pop('_id')
+        document.pop('checkout')
+        document['checkout.completed'] = False
+        document['checkout.pending'] = list(cls.CHECKOUT_STEPS)
+
+        orders = models.DBSession.impl.db.orders
+        stored = orders.find_and_modify({'_id': _id}, {'$setOnInsert': document, '$inc': {'checkout.attempts': 1}},
+                                        upsert=True, new=True, fields=cls.CHECKOUT_FIELDS)
+        cls._complete_checkout(stored)
+
+        models.DBSession.impl.db.carts.remove({'_id': cart._id})
+        models.DBSession.expunge(cart)
+        return models.Order.query.get(_id=_id)
+
+    CHECKOUT_STEPS = ('sold', 'rollup', 'vat')
+    CHECKOUT_FIELDS = ['checkout', 'creation_date', 'status_changes', 'items.sku', 'items.qty', 'items.rate',
+                       'items.category_id', 'items.net_price', 'items.vat', 'items.gross_price',
+                       'shipping_charges', 'applied_discount']
+
+    @classmethod
+    def _complete_checkout(cls, order):
+        """Applies the follow up steps of a checkout still pending on ``order``.
+
+        Sold counters and VAT rates are idempotent, so they are just applied again
+        when a failure left them pending. Rollups are not: the step is moved from
+        ``pending`` to ``checkout.rollup_started`` before applying them and, if the
+        checkout died in between, the rollups of the order day are rebuilt from the orders.
+        The checkout stays incomplete until that rebuild succeeds.
+        """
+        orders = models.DBSession.impl.db.orders
+        _id = order['_id']
+        checkout = order['checkout']
+        pending = checkout.get('pending', [])
+
+        if 'sold' in pending:
+            # Bestseller counters can lag behind, keep them out of the checkout
+            job_queue.enqueue('increase_sold', args=[_id], key='increase_sold:%s' % _id)
+            orders.update({'_id': _id}, {'$pull': {'checkout.pending': 'sold'}})
+
+        if 'vat' in pending:
+            models.Order.register_vat_rates([item['rate'] for item in order['items']])
+            orders.update({'_id': _id}, {'$pull': {'checkout.pending': 'vat'}})
+
+        now = datetime.datetime.utcnow()
+        if 'rollup' in pending:
+            claimed = orders.update({'_id': _id, 'checkout.pending': 'rollup'},
+                                    {'$pull': {'checkout.pending': 'rollup'}, '$set': {'checkout.rollup_started': now}})
+            if claimed.get('updatedExisting', False):
+                status = order['status_changes'][0]['status']
+                models.SalesRollup.apply(models.SalesRollup.contributions(
+                    order['creation_date'], status, order['items'],
+                    order.get('shipping_charges'), order.get('applied_discount')
+                ))
+                orders.update({'_id': _id}, {'$unset': {'checkout.rollup_started': True}})
+        elif checkout.get('rollup_started') is not None:
+            timeout = datetime.timedelta(seconds=int(tg.config.get('orders.checkout_step_timeout', 60)))
+            if checkout['rollup_started'] < now - timeout:
+                # Unknown if the rollups were applied, the rebuild of the day fixes them
+                # and clears the marker, unless the day is too busy to be rebuilt now
+                day = models.SalesRollup.day_of(order['creation_date'])
+                ReportManager.rebuild(day, day + datetime.timedelta(days=1), workers=1)
+
+        orders.update({'_id': _id, 'checkout.pending': {'$size': 0}, 'checkout.rollup_started': None},
+                      {'$set': {'checkout.completed': True}})
 
     @classmethod
     def get(self, _id): #get_order
-        return models.Order.query.get(_id=ObjectId(_id))
+        """Retrieves an order, archived orders are returned as read-only :class:`OrderView`"""
+        order = models.Order.query.get(_id=ObjectId(_id))
+        if order is None:
+            archived = models.DBSession.impl.db.orders_archive.find_one({'_id': ObjectId(_id)})
+            if archived is not None:
+                order = models.OrderView(archived)
+        return order
 
     @classmethod
     def get_many(cls, query=dict(), fields=None): #get_products
@@ -65,10 +165,279 @@ class OrderManager(object):
         q = models.Order.query.find(query, **q_kwargs)
         return q
 
+    EXPORT_FIELDS = ['creation_date', 'status', 'user', 'payment_type', 'items.sku', 'items.name', 'items.qty',
+                     'items.rate', 'items.net_price', 'items.vat', 'items.gross_price', 'applied_discount',
+                     'gross_total', 'currencies', 'vat_rates_breakdown']
+    EXPORT_COLUMNS = ['order', 'date', 'status', 'customer', 'payment_type', 'sku', 'product', 'qty', 'vat_rate',
+                      'net_price', 'vat', 'gross_price', 'line_net', 'line_vat', 'line_gross',
+                      'rate_total', 'rate_net', 'rate_vat']
+
+    @classmethod
+    def export(cls, format='csv', query=None, batch_size=1000):
+        """Streams every order line, with the VAT split of its rate, as a CSV or XLSX file.
+
+        Orders are read in batches from projected raw cursors, so memory usage
+        doesn't depend on the number of exported orders. Archived orders come
+        first, being older than the live ones.
+
+        :returns: an iterator over chunks of the file content
+        """
+        if format not in ('csv', 'xlsx'):
+            raise UnsupportedExportFormatException('Unsupported export format: %s' % format)
+        if format == 'xlsx':
+            try:
+                import xlsxwriter
+            except ImportError:
+                raise UnsupportedExportFormatException('XLSX exports require XlsxWriter')
+
+        db = models.DBSession.impl.db
+        orders = chain(db.orders_archive.find(query or {}, fields=cls.EXPORT_FIELDS)
+                                        .sort('creation_date', 1).batch_size(batch_size),
+                       db.orders.find(query or {}, fields=cls.EXPORT_FIELDS)
+                                .sort('creation_date', 1).batch_size(batch_size))
+        rows = cls._export_rows(orders)
+        if format == 'csv':
+            return cls._export_csv(rows, batch_size)
+        return cls._export_xlsx(rows)
+
+    @classmethod
+    def _export_rows(cls, orders):
+        fmt = lambda cents: '%s%d.%02d' % ('-' if cents < 0 else '', abs(cents) // 100, abs(cents) % 100)
+        for order in orders:
+            breakdown = dict((b['rate'], b['amount']) for b in order.get('vat_rates_breakdown') or [])
+            if not breakdown:
+                breakdown = models.Order.compute_vat_rates_breakdown(order.get('items', []),
+                                                                     order.get('applied_discount', 0),
+                                                                     order.get('gross_total'),
+                                                                     order.get('currencies'))
+            for item in order.get('items', []):
+                rate = item.get('rate') or 0.0
+                rate_total = breakdown.get(item.get('rate'), 0)
+                rate_net = int(round(rate_total / (1 + rate)))
+                net, vat = with_currency.float2cur(item['net_price']), with_currency.float2cur(item['vat'])
+                gross = with_currency.float2cur(item['gross_price'])
+                name = item.get('name') or {}
+                yield [str(order['_id']), order['creation_date'].strftime('%Y-%m-%d %H:%M:%S'),
+                       order.get('status'), order.get('user') or '', order.get('payment_type') or '',
+                       item.get('sku'), name.get(tg.config.lang, '') if isinstance(name, dict) else name,
+                       item['qty'], rate, fmt(net), fmt(vat), fmt(gross),
+                       fmt(net * item['qty']), fmt(vat * item['qty']), fmt(gross * item['qty']),
+                       fmt(rate_total), fmt(rate_net), fmt(rate_total - rate_net)]
+
+    @classmethod
+    def _export_csv(cls, rows, batch_size):
+        encode = lambda row: [v.encode('utf-8') if isinstance(v, unicode) else v for v in row]
+        buffer = BytesIO()
+        writer = csv.writer(buffer)
+        writer.writerow(encode(cls.EXPORT_COLUMNS))
+        for i, row in enumerate(rows, 1):
+            writer.writerow(encode(row))
+            if i % batch_size == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    @classmethod
+    def _export_xlsx(cls, rows, chunk_size=64 * 1024):
+        import xlsxwriter
+
+        fd, path = tempfile.mkstemp(suffix='.xlsx')
+        os.close(fd)
+        try:
+            workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+            worksheet = workbook.add_worksheet()
+            worksheet.write_row(0, 0, cls.EXPORT_COLUMNS)
+            for i, row in enumerate(rows, 1):
+                worksheet.write_row(i, 0, row)
+            workbook.close()
+
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    yield chunk
+        finally:
+            os.remove(path)
+
+    @classmethod
+    def get_listing(cls, query=None, page=1, items_per_page=50):
+        """A page of orders, newest first, grouped by creation day.
+
+        Paging, projection and grouping are all performed by a single aggregation,
+        orders are returned as :class:`OrderView` with only the listing columns.
+
+        :returns: a Bunch with ``days``, a list of ``(date, count, orders)``, ``page``, ``pages`` and ``total``
+        """
+        if query is None:
+            query = {}
+        projection = dict((field, 1) for field in models.OrderView.LIST_FIELDS)
+        day = {'year': {'$year': '$creation_date'},
+               'month': {'$month': '$creation_date'},
+               'day': {'$dayOfMonth': '$creation_date'}}
+        result = models.DBSession.impl.db.orders.aggregate([
+            {'$match': query},
+            {'$sort': {'creation_date': -1}},
+            {'$skip': (page - 1) * items_per_page},
+            {'$limit': items_per_page},
+            {'$project': projection},
+            {'$group': {'_id': day, 'count': {'$sum': 1}, 'orders': {'$push': '$$ROOT'}}},
+            {'$sort': {'_id.year': -1, '_id.month': -1, '_id.day': -1}}
+        ])
+
+        days = []
+        for group in result['result']:
+            date = datetime.date(group['_id']['year'], group['_id']['month'], group['_id']['day'])
+            days.append((date, group['count'], [models.OrderView(order) for order in group['orders']]))
+
+        total = models.DBSession.impl.db.orders.find(query).count()
+        return Bunch(days=days, page=page, total=total,
+                     pages=max(1, int(math.ceil(total / float(items_per_page)))))
+
     @classmethod
-    def get_user_orders(self, user_id):
-        """Retrieves all the past orders of a given user
+    def find_by_sku(cls, sku, date_range=None, status=None, page=1, items_per_page=50, count_only=False):
+        """Orders containing the given SKU, newest first, read through the ``(items.sku, creation_date)`` index.
+
+        Only the customer, date, status and the matching line of each order are loaded.
+        Archived orders are included, after the live ones.
+
+        :param date_range: a ``(start, end)`` tuple, either end can be ``None`` for an open range
+        :param status: a status or a list of statuses to include, all of them by default
+        :param count_only: only count the matching orders without loading them
+        :returns: the count when ``count_only``, otherwise a Bunch with ``orders``,
+                  a list of :class:`OrderView`, ``page``, ``pages`` and ``total``
+        """
+        query = {'items.sku': sku}
+        if date_range is not None:
+            start, end = date_range
+            creation_date = {}
+            if start is not None:
+                creation_date['$gte'] = start
+            if end is not None:
+                creation_date['$lt'] = end
+            if creation_date:
+                query['creation_date'] = creation_date
+        if status is not None:
+            query['status'] = status if isinstance(status, basestring) else {'$in': list(status)}
+
+        if count_only:
+            db = models.DBSession.impl.db
+            return db.orders.find(query).count() + db.orders_archive.find(query).count()
+        return cls._page_with_archive(query, models.OrderView.SKU_FIELDS, page, items_per_page)
+
+    @classmethod
+    def get_user_orders(cls, user_id):
+        """Retrieves all the past orders of a given user, archived ones included
+
+        Live orders are :class:`Order` instances, archived ones :class:`OrderView`.
 
         :param user_id: the user id string to filter for
+        :returns: an :class:`OrdersWithArchive`, supporting ``sort``, ``skip`` and ``limit``
+        """
+        return OrdersWithArchive(models.Order.query.find({'user_id': user_id}),
+                                 models.DBSession.impl.db.orders_archive.find({'user_id': user_id}))
+
+    @classmethod
+    def get_user_history(cls, user_id, page=1, items_per_page=20):
+        """A page of the order history of a user, newest first.
+
+        Orders only carry the summary columns (date, status, total, item count and thumbnail)
+        and are read through the ``(user_id, creation_date)`` index. Archived orders are all
+        older than the live ones, so they simply continue the live pages.
+
+        :returns: a Bunch with ``orders``, a list of :class:`OrderView`, ``page``, ``pages`` and ``total``
         """
-        return models.Order.query.find({'user_id': user_id})
+        return cls._page_with_archive({'user_id': user_id}, models.OrderView.HISTORY_FIELDS, page, items_per_page)
+
+    @classmethod
+    def _page_with_archive(cls, query, fields, page, items_per_page):
+        """A page of the live orders matching ``query`` newest first, continued by the archived ones"""
+        db = models.DBSession.impl.db
+        skip = (page - 1) * items_per_page
+        live_total = db.orders.find(query).count()
+        archived_total = db.orders_archive.find(query).count()
+
+        orders = []
+        if skip < live_total:
+            orders.extend(db.orders.find(query, fields=fields)
+                                   .sort('creation_date', -1).skip(skip).limit(items_per_page))
+        missing = items_per_page - len(orders)
+        if missing > 0 and archived_total:
+            orders.extend(db.orders_archive.find(query, fields=fields)
+                                           .sort('creation_date', -1)
+                                           .skip(max(0, skip - live_total)).limit(missing))
+
+        total = live_total + archived_total
+        return Bunch(orders=[models.OrderView(order) for order in orders], page=page, total=total,
+                     pages=max(1, int(math.ceil(total / float(items_per_page)))))
+
+
+class OrdersWithArchive(object):
+    """Results of a query over the orders and the matching archived orders.
+
+    Unsorted results are the live orders followed by the archived ones. Sorting
+    applies to both cursors and merges their results, ``skip`` and ``limit``
+    apply to the merged results.
+    """
+    def __init__(self, orders, archived):
+        self.orders = orders
+        self.archived = archived
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=ASCENDING):
+        if not isinstance(key_or_list, list):
+            key_or_list = [(key_or_list, direction)]
+        self.orders = self.orders.sort(key_or_list)
+        self.archived = self.archived.sort(key_or_list)
+        self._sort = key_or_list
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def __iter__(self):
+        end = None
+        if self._limit:
+            end = self._skip + self._limit
+            self.orders = self.orders.limit(end)
+            self.archived = self.archived.limit(end)
+        orders, archived = iter(self.orders), imap(models.OrderView, self.archived)
+        merged = self._merged(orders, archived) if self._sort else chain(orders, archived)
+        return islice(merged, self._skip, end)
+
+    def _merged(self, orders, archived):
+        def before(a, b):
+            for field, direction in self._sort:
+                x, y = getattr(a, field, None), getattr(b, field, None)
+                if x != y:
+                    return (x < y) == (direction == ASCENDING)
+            return True
+
+        a, b = next(orders, None), next(archived, None)
+        while a is not None and b is not None:
+            if before(a, b):
+                yield a
+                a = next(orders, None)
+            else:
+                yield b
+                b = next(archived, None)
+        if a is not None:
+            yield a
+        if b is not None:
+            yield b
+        for order in chain(orders, archived):
+            yield order
+
+    def count(self):
+        return self.orders.count() + self.archived.count()
+
+    def all(self):
+        return list(self)
+
+    def first(self):
+        return next(iter(self), None)
@@ -0,0 +1,183 @@
+# coding=utf-8
+"""Local stand-in for the PayPal REST payments API, for tests and benchmarks.
+
+Usage::
+
+    server = FakePaypalServer(latency=0.05).start()
+    configure_paypal('sandbox', 'client', 'secret', base_url=server.url)
+    ...
+    server.stop()
+
+Payments are approved by visiting their ``approval_url``, which redirects
+back to the ``return_url`` with the ``paymentId`` and ``PayerID`` parameters
+as PayPal does. ``fail_next`` makes the next requests answer with an error
+to exercise the retry policy.
+"""
+from __future__ import unicode_literals
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import json
+import threading
+import time
+from urllib import urlencode
+import uuid
+
+PAYER_INFO = {'first_name': 'John', 'last_name': 'Doe', 'email': 'john.doe@example.com'}
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=None, headers=None):
+        content = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header(b'Content-Type', b'application/json')
+        self.send_header(b'Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name.encode('utf-8'), value.encode('utf-8'))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _authorized(self):
+        return self.headers.get('Authorization') in ('Bearer %s' % token for token in self.server.fake.tokens)
+
+    def _handle(self, method):
+        fake = self.server.fake
+        body = self._body()
+        if fake.latency:
+            time.sleep(fake.latency)
+        fake.requests.append((method, self.path))
+        if fake.consume_failure():
+            return self._reply(503, {'name': 'SERVICE_UNAVAILABLE'})
+
+        path = self.path.split('?')[0].rstrip('/').split('/')
+        if method == 'POST' and path == ['', 'v1', 'oauth2', 'token']:
+            return self._reply(200, fake.new_token())
+        if path[1:2] == ['approve'] and len(path) == 3:
+            payment = fake.approve(path[2])
+            if payment is None:
+                return self._reply(404, {'name': 'INVALID_RESOURCE_ID'})
+            query = urlencode({'paymentId': payment['id'], 'PayerID': payment['payer']['payer_info']['payer_id']})
+            return self._reply(302, headers={'Location': '%s?%s' % (payment['redirect_urls']['return_url'], query)})
+
+        if path[:4] != ['', 'v1', 'payments', 'payment']:
+            return self._reply(404, {'name': 'NOT_FOUND'})
+        if not self._authorized():
+            return self._reply(401, {'error': 'invalid_token'})
+
+        request_id = self.headers.get('PayPal-Request-Id')
+        if method == 'POST' and len(path) == 4:
+            return self._reply(201, fake.create(json.loads(body), request_id, self._base_url()))
+        if method == 'GET' and len(path) == 5:
+            payment = fake.payments.get(path[4])
+            return self._reply(200, payment) if payment else self._reply(404, {'name': 'INVALID_RESOURCE_ID'})
+        if method == 'POST' and len(path) == 6 and path[5] == 'execute':
+            status, payment = fake.execute(path[4], json.loads(body or b'{}'))
+            return self._reply(status, payment)
+        return self._reply(404, {'name': 'NOT_FOUND'})
+
+    def _base_url(self):
+        return 'http://%s:%s' % self.server.server_address[:2]
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class FakePaypalServer(object):
+    """In memory PayPal payments API served on a local port from a background thread"""
+    def __init__(self, host='127.0.0.1', port=0, latency=0, token_ttl=3600):
+        self.latency = latency
+        self.token_ttl = token_ttl
+        self.tokens = set()
+        self.payments = {}
+        self.requests = []
+        self._request_ids = {}
+        self._failures = 0
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer((host, port), _Handler)
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self._server.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def fail_next(self, count=1):
+        """Answers the next ``count`` requests with a 503 error"""
+        with self._lock:
+            self._failures += count
+
+    def consume_failure(self):
+        with self._lock:
+            if self._failures:
+                self._failures -= 1
+                return True
+            return False
+
+    def new_token(self):
+        token = uuid.uuid4().hex
+        with self._lock:
+            self.tokens.add(token)
+        return {'access_token': token, 'token_type': 'Bearer', 'expires_in': self.token_ttl}
+
+    def create(self, payment, request_id, base_url):
+        with self._lock:
+            if request_id in self._request_ids:
+                return self.payments[self._request_ids[request_id]]
+            payment_id = 'PAY-%s' % uuid.uuid4().hex[:24].upper()
+            payment.update(id=payment_id, state='created',
+                           links=[{'rel': 'approval_url', 'method': 'REDIRECT',
+                                   'href': '%s/approve/%s' % (base_url, payment_id)}])
+            self.payments[payment_id] = payment
+            if request_id is not None:
+                self._request_ids[request_id] = payment_id
+            return payment
+
+    def approve(self, payment_id):
+        with self._lock:
+            payment = self.payments.get(payment_id)
+            if payment is not None:
+                payer_info = dict(PAYER_INFO, payer_id=uuid.uuid4().hex[:13].upper())
+                payment['payer'] = dict(payment['payer'], payer_info=payer_info)
+            return payment
+
+    def expire(self, payment_id):
+        """Makes the payment expire as PayPal does when it's never approved"""
+        with self._lock:
+            self.payments[payment_id]['state'] = 'expired'
+
+    def execute(self, payment_id, data):
+        with self._lock:
+            payment = self.payments.get(payment_id)
+            if payment is None:
+                return 404, {'name': 'INVALID_RESOURCE_ID'}
+            payer_info = payment['payer'].get('payer_info')
+            if payer_info is None or data.get('payer_id') != payer_info['payer_id']:
+                return 400, {'name': 'PAYMENT_NOT_APPROVED_FOR_EXECUTION'}
+            payment['state'] = 'approved'
+            return 200, payment
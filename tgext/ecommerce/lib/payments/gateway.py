@@ -0,0 +1,289 @@
+# coding=utf-8
+from __future__ import unicode_literals
+import datetime
+import logging
+from multiprocessing.pool import ThreadPool
+import random
+import threading
+import time
+import uuid
+import requests
+from requests.adapters import HTTPAdapter
+import tg
+from tg.util import Bunch
+from tgext.ecommerce.lib.exceptions import PaymentGatewayException
+
+log = logging.getLogger('tgext.ecommerce')
+
+
+class PaymentGateway(object):
+    """Base class of the payment backends.
+
+    By default a payment is recorded on the cart without leaving the shop and gets
+    completed once :meth:`reconcile` reports it so, backends talking to a payment
+    provider override ``pay``, ``confirm`` and ``execute``. The calls that talk
+    to the payment provider can also be run on a shared pool of worker threads
+    through :meth:`submit`, so that the request thread is not blocked while it answers.
+    """
+    name = None
+
+    # confirm builds urls with tg.url, which needs the request of the calling thread
+    ASYNC_METHODS = frozenset(['pay', 'execute', 'reconcile'])
+
+    PENDING, COMPLETED, FAILED = 'pending', 'completed', 'failed'
+
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    def pay(self, cart, redirection_url, cancel_url):
+        """Starts the payment of the cart, returns the url where the customer must be redirected"""
+        cart.order_info.payment = {'backend': self.name,
+                                   'id': cart._id,
+                                   'date': datetime.datetime.utcnow()}
+        return redirection_url
+
+    def confirm(self, cart, redirection, data):
+        """Url where the customer lands after approving the payment"""
+        return tg.url(redirection, qualified=True)
+
+    def execute(self, cart, data):
+        """Completes an approved payment, returns a dict with ``result`` and ``payer_info``"""
+        reconciled = self.reconcile(cart.order_info.payment)
+        return dict(result=reconciled.state == self.COMPLETED, payer_info=reconciled.payer_info)
+
+    def reconcile(self, payment):
+        """Brings a payment started by :meth:`pay` to its final state when the gateway allows it.
+
+        :param payment: the ``order_info.payment`` of the cart
+        :returns: a Bunch with the ``state``, one of ``PENDING``, ``COMPLETED`` and ``FAILED``,
+                  and the ``payer_info`` of completed payments
+        """
+        return Bunch(state=self.PENDING, payer_info={})
+
+    @classmethod
+    def pool(cls):
+        if PaymentGateway._pool is None:
+            with PaymentGateway._pool_lock:
+                if PaymentGateway._pool is None:
+                    PaymentGateway._pool = ThreadPool(int(tg.config.get('payments.async_workers', 8)))
+        return PaymentGateway._pool
+
+    def submit(self, method, *args, **kwargs):
+        """Runs ``method``, one of :attr:`ASYNC_METHODS`, in the payments thread pool and returns its ``AsyncResult``"""
+        if method not in self.ASYNC_METHODS:
+            raise ValueError('%s can only run in the request thread' % method)
+        return self.pool().apply_async(getattr(self, method), args, kwargs)
+
+
+class NullPaymentGateway(PaymentGateway):
+    """Accepts every payment without contacting anyone, for free orders and tests"""
+    name = 'null_payment'
+
+    def reconcile(self, payment):
+        return Bunch(state=self.COMPLETED, payer_info={})
+
+
+class HTTPPaymentGateway(PaymentGateway):
+    """Payment backend talking to a remote HTTP API.
+
+    Requests go through a keep-alive connection pool of ``pool_size`` connections
+    per host shared by all the threads, have a connect and
+    a read timeout and are retried on connection errors and on the
+    ``RETRY_STATUSES`` with exponential backoff and full jitter.
+    """
+    RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+    def __init__(self, base_url, timeout=(3.05, 15), retries=3, backoff=0.25, max_backoff=4, pool_size=10):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        # requests sessions are not thread safe, each thread keeps its own
+        # on top of the thread safe connection pool of the shared adapter
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            self._local.session = session
+        return session
+
+    def _sleep_before_retry(self, attempt):
+        time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def request(self, method, path, **kwargs):
+        """Performs a request against the API and returns the response.
+
+        Non idempotent requests must carry an idempotency key understood by the
+        provider, as they are retried like all the others.
+
+        :raises PaymentGatewayException: when the API can't be reached or keeps failing
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        url = self.base_url + path
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries:
+                    raise PaymentGatewayException('%s %s failed: %s' % (method, url, e))
+            else:
+                if response.status_code not in self.RETRY_STATUSES or attempt >= self.retries:
+                    return response
+            log.warn('Retrying %s %s, attempt %s', method, url, attempt + 1)
+            self._sleep_before_retry(attempt)
+            attempt += 1
+
+
+class PaypalGateway(HTTPPaymentGateway):
+    """PayPal REST payments API"""
+    name = 'paypal'
+    URLS = {'sandbox': 'https://api.sandbox.paypal.com',
+            'live': 'https://api.paypal.com'}
+
+    def __init__(self, client_id, client_secret, mode='sandbox', base_url=None, **kwargs):
+        super(PaypalGateway, self).__init__(base_url or self.URLS[mode], **kwargs)
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self._token = None
+        self._token_expiry = 0
+        self._token_lock = threading.Lock()
+
+    def _access_token(self, refresh=False):
+        with self._token_lock:
+            if refresh or self._token is None or self._token_expiry < time.time():
+                response = self.request('POST', '/v1/oauth2/token', auth=(self.client_id, self.client_secret),
+                                        data={'grant_type': 'client_credentials'},
+                                        headers={'Accept': 'application/json'})
+                if response.status_code != 200:
+                    raise PaymentGatewayException('PayPal authentication failed: %s' % response.text)
+                token = response.json()
+                self._token = token['access_token']
+                # Renew a minute early so that a token never expires in flight
+                self._token_expiry = time.time() + int(token.get('expires_in', 0)) - 60
+            return self._token
+
+    def api(self, method, path, payload=None, request_id=None):
+        """Authenticated JSON call, returns the response status and decoded body"""
+        headers = {'Content-Type': 'application/json'}
+        if request_id is not None:
+            headers['PayPal-Request-Id'] = request_id
+
+        refresh = False
+        while True:
+            headers['Authorization'] = 'Bearer %s' % self._access_token(refresh)
+            response = self.request(method, path, json=payload, headers=headers)
+            if response.status_code == 401 and not refresh:
+                refresh = True
+                continue
+            try:
+                body = response.json()
+            except ValueError:
+                body = {}
+            return response.status_code, body
+
+    def pay(self, cart, redirection_url, cancel_url):
+        payment = {
+            "intent": "sale",
+            "payer": {
+                "payment_method": "paypal"
+            },
+            "redirect_urls": {
+                "return_url": redirection_url,
+                "cancel_url": cancel_url
+            },
+            "transactions": [{"item_list": {"items": [{"name": "Order %s" % str(cart._id),
+                                                       "price": cart.order_due,
+                                                       "sku": str(cart._id),
+                                                       "currency": "EUR",
+                                                       "quantity": 1}]},
+                              "amount": {
+                                  "total": cart.order_due,
+                                  "currency": "EUR",
+                              }}]
+        }
+
+        try:
+            status, body = self.api('POST', '/v1/payments/payment', payment, request_id=uuid.uuid4().hex)
+        except PaymentGatewayException as e:
+            status, body = None, unicode(e)
+        if status not in (200, 201):
+            log.error('PayPal payment creation failed for cart %s: %s', cart._id, body)
+            return cancel_url
+
+        cart.order_info.payment = {'backend': self.name,
+                                   'id': body['id'],
+                                   'date': datetime.datetime.utcnow()}
+        for link in body.get('links', []):
+            if link['rel'] == 'approval_url':
+                return link['href']
+
+    def confirm(self, cart, redirection, data):
+        payerId = data['PayerID']
+        return tg.url(redirection, qualified=True, params={'payer_id': payerId})
+
+    def execute(self, cart, data):
+        paymentId = cart.order_info.payment['id']
+        # Executing the same payment twice with the same request id is a no-op for PayPal
+        status, body = self.api('POST', '/v1/payments/payment/%s/execute' % paymentId, dict(data),
+                                request_id='execute-%s' % paymentId)
+        result = status in (200, 201) and body.get('state') == 'approved'
+        payer_info = dict()
+        if result:
+            payer_info = self._payer_info(body)
+        else:
+            log.error('PayPal payment %s execution failed: %s', paymentId, body)
+
+        return dict(result=result, payer_info=payer_info)
+
+    def reconcile(self, payment):
+        body = self.find(payment['id'])
+        state = body.get('state')
+        paypal_payer = body.get('payer', {}).get('payer_info') or {}
+        if state == 'approved':
+            return Bunch(state=self.COMPLETED, payer_info=self._payer_info(body))
+        if state in ('failed', 'canceled', 'expired'):
+            return Bunch(state=self.FAILED, payer_info={})
+        if state == 'created' and paypal_payer.get('payer_id'):
+            # Approved by the customer who never came back to the shop to execute it
+            result = self.execute(Bunch(order_info=Bunch(payment=payment)), {'payer_id': paypal_payer['payer_id']})
+            if result['result']:
+                return Bunch(state=self.COMPLETED, payer_info=result['payer_info'])
+        return Bunch(state=self.PENDING, payer_info={})
+
+    @staticmethod
+    def _payer_info(payment):
+        paypal_payer = payment.get('payer', {}).get('payer_info', {})
+        return dict(first_name=paypal_payer.get('first_name'),
+                    last_name=paypal_payer.get('last_name'),
+                    email=paypal_payer.get('email'))
+
+    def find(self, payment_id):
+        """Current state of a payment as returned by PayPal"""
+        status, body = self.api('GET', '/v1/payments/payment/%s' % payment_id)
+        if status != 200:
+            raise PaymentGatewayException('PayPal payment %s lookup failed: %s' % (payment_id, body))
+        return body
+
+
+gateways = {NullPaymentGateway.name: NullPaymentGateway()}
+
+
+def register_gateway(gateway):
+    gateways[gateway.name] = gateway
+    return gateway
+
+
+def get_gateway(name):
+    try:
+        return gateways[name]
+    except KeyError:
+        raise PaymentGatewayException('Payment gateway %s is not configured' % name)
@@ -1,24 +1,19 @@
 # coding=utf-8
 from __future__ import unicode_literals
+from tgext.ecommerce.lib.payments.gateway import NullPaymentGateway, get_gateway
 
-import tg
-import datetime
-import math
-from tgext.ecommerce.lib.utils import apply_percentage_discount, get_percentage_discount
 
+def gateway():
+    return get_gateway(NullPaymentGateway.name)
 
 
 def pay(cart, redirection_url, cancel_url):
-    cart.order_info.payment = {'backend': 'null_payment',
-                               'id': cart._id,
-                               'date': datetime.datetime.utcnow()}
-    return redirection_url
+    return gateway().pay(cart, redirection_url, cancel_url)
 
 
 def confirm(cart, redirection, data):
-    return tg.url(redirection, qualified=True)
+    return gateway().confirm(cart, redirection, data)
 
 
 def execute(cart, data):
-    return dict(result=dict({'result': 'payed'}), payer_info={})
-
+    return gateway().execute(cart, data)
@@ -4,13 +4,15 @@ from collections import Counter
 import re
 from bson import ObjectId
 import datetime
-from ming import DESCENDING
+from ming import ASCENDING, DESCENDING
+from tgext.ecommerce.lib.cache import shop_cache
+from tgext.ecommerce.lib.category_tree import get_category_tree
 from tgext.ecommerce.lib.exceptions import AlreadyExistingSkuException, AlreadyExistingSlugException, \
     InactiveProductException
+from tgext.ecommerce.lib.order import OrderManager
 from tgext.ecommerce.lib.utils import slugify, internationalise as i_, NoDefault, preferred_language, apply_vat
 from tgext.ecommerce.model import models
-from ming.odm import mapper
-from tg import cache
+import tg
 
 
 class ProductManager(object):
@@ -38,10 +40,12 @@ class ProductManager(object):
         if vat is None:
             vat = apply_vat(price, rate)
 
+        category_id = ObjectId(category_id) if category_id else None
         product = models.Product(type=type,
                                  name=i_(name),
-                                 category_id=ObjectId(category_id) if category_id else None,
+                                 category_id=category_id,
                                  categories_ids=categories_ids,
+                                 categories_path=cls._categories_path(category_id, categories_ids),
                                  description=i_(description),
                                  slug=slug,
                                  details=details,
@@ -96,6 +100,32 @@ class ProductManager(object):
         else:
             return None
 
+    @classmethod
+    def get_details(cls, sku=None, _id=None, slug=None):
+        """Read-only :class:`ProductView` of a product for product pages, ``None`` when it doesn't exist.
+
+        The product is cached until it changes, when the cache expires
+        a single caller reads it again while the others get the expired one.
+        """
+        if _id is not None:
+            field, value = '_id', ObjectId(_id)
+        elif sku is not None:
+            field, value = 'configurations.sku', sku
+        elif slug is not None:
+            field, value = 'slug', slug
+        else:
+            return None
+
+        def _fetch_product():
+            return models.DBSession.impl.db.products.find_one({field: value})
+
+        def _product_tags(product):
+            return models.Product.cache_tags(product['_id'], product.get('categories_path')) if product else None
+
+        product = shop_cache.get_or_create('product_details:%s:%s' % (field, value), _fetch_product,
+                                           tags=_product_tags, ttl=int(tg.config.get('products.cache_ttl', 600)))
+        return models.ProductView(product) if product is not None else None
+
     @classmethod
     def get_many(cls, type=None, query=None, fields=None):  # get_products
         if not query:
@@ -111,19 +141,87 @@ class ProductManager(object):
         q = models.Product.query.find(filter, **q_kwargs)
         return q
 
+    @classmethod
+    def get_in_category_subtree(cls, category_id, type=None, query=None, fields=None,
+                                skip=0, limit=None, sort_direction=ASCENDING):
+        """Active products of a category and of all its subcategories, sorted by ``sort_category_weight``
+
+        :param category_id: the id of the root category of the subtree
+        :param skip: number of products to skip, for paging
+        :param limit: max number of products returned, for paging
+        """
+        if not query:
+            query = dict()
+        query['categories_path'] = ObjectId(category_id)
+        query.setdefault('active', True)
+        q = cls.get_many(type, query, fields).sort([('sort_category_weight', sort_direction)])
+        if skip:
+            q = q.skip(skip)
+        if limit:
+            q = q.limit(limit)
+        return q
+
+    @classmethod
+    def rebuild_categories_path(cls, query=None, batch_size=500):
+        """Recomputes the materialized ``categories_path`` of the products matching ``query``
+
+        Paths and category counters are written every ``batch_size`` products.
+        """
+        if query is None:
+            query = {}
+        updates = 0
+        batch = []
+        for product in models.DBSession.impl.db.products.find(query, fields=cls._COUNTED_FIELDS)\
+                .batch_size(batch_size):
+            batch.append(product)
+            if len(batch) == batch_size:
+                updates += cls._rebuild_categories_path_batch(batch)
+                batch = []
+        if batch:
+            updates += cls._rebuild_categories_path_batch(batch)
+        return updates
+
+    @classmethod
+    def _rebuild_categories_path_batch(cls, products):
+        bulk = models.DBSession.impl.db.products.initialize_unordered_bulk_op()
+        tags = set()
+        deltas = {}
+        for product in products:
+            before = cls._counted_state(product)
+            tags.update(models.Product.cache_tags(product['_id'], product.get('categories_path')))
+            product['categories_path'] = cls._categories_path(product.get('category_id'),
+                                                              product.get('categories_ids'))
+            tags.update(models.Product.cache_tags(product['_id'], product['categories_path']))
+            bulk.find({'_id': product['_id']}).update_one({'$set': {'categories_path': product['categories_path']}})
+            for _id, delta in cls._counters_deltas(before, cls._counted_state(product)).iteritems():
+                deltas.setdefault(_id, Counter()).update(delta)
+        bulk.execute()
+        cls._apply_counters_deltas(deltas)
+        shop_cache.invalidate(*tags)
+        return len(products)
+
     @classmethod
     def get_bestsellers(cls):
+        """Skus of the bestselling products, as last stored by :meth:`refresh_bestsellers`"""
         def _fetch_bestsellers():
-            skus = []
-            for product in cls.get_many('product', {'active': True}).sort([('sold', DESCENDING)]).limit(12).all():
-                skus.append(product.configurations[0].sku)
-            return skus
+            stored = models.Setting.query.find({'setting': 'bestsellers'}).first()
+            if stored is None:
+                return cls.refresh_bestsellers()
+            return stored.value
+
+        return shop_cache.get_or_create('bestsellers', _fetch_bestsellers, tags=['bestsellers'],
+                                        ttl=int(tg.config.get('bestsellers.cache_ttl', 600)))
 
-        bestselling_cache = cache.get_cache('bestselling_products')
-        bestseller = bestselling_cache.get_value(key='bestseller',
-                                                 expiretime=24 * 3600,
-                                                 createfunc=_fetch_bestsellers)
-        return bestseller
+    @classmethod
+    def refresh_bestsellers(cls):
+        """Recomputes the bestselling products and stores them for every process"""
+        skus = []
+        for product in cls.get_many('product', {'active': True}).sort([('sold', DESCENDING)]).limit(12).all():
+            skus.append(product.configurations[0].sku)
+        models.DBSession.impl.db.ecommerce_settings.update({'setting': 'bestsellers'},
+                                                           {'$set': {'value': skus}}, upsert=True)
+        shop_cache.invalidate('bestsellers')
+        return skus
 
     @classmethod
     def edit(cls, product, type=NoDefault, name=NoDefault, category_id=NoDefault, categories_ids=NoDefault,
@@ -145,6 +243,9 @@ class ProductManager(object):
         if categories_ids is not NoDefault:
             product.categories_ids = categories_ids
 
+        if category_id is not NoDefault or categories_ids is not NoDefault:
+            product.categories_path = cls._categories_path(product.category_id, product.categories_ids)
+
         if description is not NoDefault:
             for k, v in i_(description).iteritems():
                 setattr(product.description, k, v)
@@ -281,24 +382,121 @@ class ProductManager(object):
         total_qty = already_bought + amount
 
         quantity_field = 'configurations.%s.qty' % configuration_index
-        result = models.DBSession.impl.update_partial(mapper(models.Product).collection,
-                                                      {'_id': product._id,
-                                                       quantity_field: {'$gte': amount}},
-                                                      {'$inc': {quantity_field: -amount}})
-        bought = result.get('updatedExisting', False)
-
+        updated = models.DBSession.impl.db.products.find_and_modify({'_id': product._id,
+                                                                     quantity_field: {'$gte': amount}},
+                                                                    {'$inc': {quantity_field: -amount}},
+                                                                    fields=cls._COUNTED_FIELDS, new=True)
+        bought = updated is not None
         if bought:
+            cls._track_stock_change(updated, configuration_index, -amount)
             cls._add_to_cart(cart, cls._product_dump(product, configuration_index), total_qty)
 
         return bought
 
+    @classmethod
+    def restock(cls, sku, qty):
+        """Gives back ``qty`` items of the configuration identified by ``sku``"""
+        updated = models.DBSession.impl.db.products.find_and_modify({'configurations.sku': sku},
+                                                                    {'$inc': {'configurations.$.qty': qty}},
+                                                                    fields=cls._COUNTED_FIELDS, new=True)
+        if updated is not None:
+            cls._track_stock_change(updated, cls._config_idx(updated, sku), qty)
+        return updated is not None
+
+    @classmethod
+    def restock_many(cls, quantities, flush_id=None):
+        """Gives back many configurations with a single bulk write
+
+        :param quantities: the quantities to give back indexed by sku
+        :param flush_id: makes the restock idempotent, configurations already
+                         restocked with the same id are skipped
+        """
+        quantities = dict((sku, qty) for sku, qty in quantities.iteritems() if qty)
+        if not quantities:
+            return
+
+        products = models.DBSession.impl.db.products
+        if flush_id is not None:
+            # Already given back by a previous run of the same flush, which accounted their counters
+            for product in products.find({'configurations': {'$elemMatch': {'sku': {'$in': list(quantities)},
+                                                                            'restocked_by': flush_id}}},
+                                         fields=['configurations.sku', 'configurations.restocked_by']):
+                for configuration in product['configurations']:
+                    if configuration.get('restocked_by') == flush_id:
+                        quantities.pop(configuration['sku'], None)
+            if not quantities:
+                return
+
+        bulk = products.initialize_unordered_bulk_op()
+        for sku, qty in quantities.iteritems():
+            if flush_id is None:
+                bulk.find({'configurations.sku': sku}).update_one({'$inc': {'configurations.$.qty': qty}})
+            else:
+                bulk.find({'configurations': {'$elemMatch': {'sku': sku, 'restocked_by': {'$ne': flush_id}}}}
+                          ).update_one({'$inc': {'configurations.$.qty': qty},
+                                        '$set': {'configurations.$.restocked_by': flush_id}})
+        bulk.execute()
+
+        # Concurrent changes in between can make the counters drift until verify_category_counters
+        tags = []
+        for updated in products.find({'configurations.sku': {'$in': list(quantities)}}, fields=cls._COUNTED_FIELDS):
+            after = cls._counted_state(updated)
+            for configuration in updated['configurations']:
+                configuration['qty'] -= quantities.get(configuration['sku'], 0)
+            cls._update_category_counters(cls._counted_state(updated), after)
+            tags.append('product:%s' % updated['_id'])
+        shop_cache.invalidate(*tags)
+
+    @classmethod
+    def get_category_counters(cls):
+        """Product counters of every category indexed by category id.
+
+        ``active`` and ``available`` (active, published and in stock) count the products
+        directly assigned to the category, ``subtree_active`` and ``subtree_available``
+        include the products of all its subcategories. Products changed through the
+        mapper are counted once they get flushed.
+        """
+        return dict((counter._id, counter) for counter in models.CategoryCounter.query.find())
+
+    @classmethod
+    def verify_category_counters(cls):
+        """Recomputes all the category counters from the products, fixing any drift
+
+        Corrections are applied as increments, so concurrent changes aren't lost.
+        Counters that changed while the products were read are left to the next run.
+
+        :returns: the number of corrected counters
+        """
+        snapshot = cls._category_counters_snapshot()
+        expected = {}
+        for product in models.DBSession.impl.db.products.find({}, fields=cls._COUNTED_FIELDS):
+            for _id, deltas in cls._counters_deltas(None, cls._counted_state(product)).iteritems():
+                expected.setdefault(_id, Counter()).update(deltas)
+
+        current = cls._category_counters_snapshot()
+        corrections = {}
+        for _id in set(expected) | set(current):
+            if current.get(_id) != snapshot.get(_id):
+                continue
+            counter, counted = current.get(_id, {}), expected.get(_id, Counter())
+            correction = dict((field, counted[field] - counter.get(field, 0)) for field in cls._COUNTERS)
+            correction = dict((field, delta) for field, delta in correction.iteritems() if delta)
+            if correction:
+                corrections[_id] = correction
+        cls._apply_counters_deltas(corrections)
+        return len(corrections)
+
+    @classmethod
+    def _category_counters_snapshot(cls):
+        return dict((counter.pop('_id'), counter) for counter in models.DBSession.impl.db.category_counters.find())
+
     def get_suggested_for_user(self, user_id, limit=5):  #get_suggested_products_per_user
         """Gives a list of suggested sku products based on the past orders of a user
 
         :param user_id: the user id string to get suggestions for
         :param limit: optional max number of suggestions (default to 5)
         """
-        past_orders = models.Order.query.find({'user_id': user_id})
+        past_orders = OrderManager.get_user_orders(user_id)
         skus = Counter([item.sku for order in past_orders for item in order.items])
         suggested_skus = [t[0] for t in skus.most_common(limit)]
         offers_placeholders = len(suggested_skus) - limit
@@ -310,6 +508,92 @@ class ProductManager(object):
 
         return suggested_skus  # filter just the sku without the frequency
 
+    _COUNTED_FIELDS = ['active', 'published', 'configurations.sku', 'configurations.qty',
+                       'category_id', 'categories_ids', 'categories_path']
+    _COUNTERS = ('active', 'available', 'subtree_active', 'subtree_available')
+
+    @classmethod
+    def _counted_state(cls, product):
+        """What a product (mapped object or raw document) contributes to the category counters"""
+        if not isinstance(product, dict):
+            product = dict(active=product.active, published=product.published,
+                           configurations=product.configurations, category_id=product.category_id,
+                           categories_ids=product.categories_ids, categories_path=product.categories_path)
+
+        active = product.get('active', True) is not False
+        available = active and product.get('published', True) is not False and \
+            any(configuration['qty'] > 0 for configuration in product.get('configurations') or [])
+        direct = set(product.get('categories_ids') or [])
+        if product.get('category_id'):
+            direct.add(product['category_id'])
+        return dict(active=active, available=available, direct=direct,
+                    subtree=set(product.get('categories_path') or []))
+
+    @classmethod
+    def _counters_deltas(cls, before, after):
+        deltas = {}
+        for state, sign in ((before, -1), (after, 1)):
+            if state is None:
+                continue
+            for flag in ('active', 'available'):
+                if not state[flag]:
+                    continue
+                for _id in state['direct']:
+                    deltas.setdefault(_id, Counter())[flag] += sign
+                for _id in state['subtree']:
+                    deltas.setdefault(_id, Counter())['subtree_' + flag] += sign
+        return dict((_id, dict((k, v) for k, v in delta.iteritems() if v))
+                    for _id, delta in deltas.iteritems() if any(delta.itervalues()))
+
+    @classmethod
+    def _update_category_counters(cls, before, after):
+        cls._apply_counters_deltas(cls._counters_deltas(before, after))
+
+    @classmethod
+    def _apply_counters_deltas(cls, deltas):
+        """Increments the category counters with a single bulk write
+
+        :param deltas: the counter increments indexed by category id
+        """
+        bulk = models.DBSession.impl.db.category_counters.initialize_unordered_bulk_op()
+        changed = False
+        for _id, delta in deltas.iteritems():
+            # Changes of different products can cancel out
+            delta = dict((k, v) for k, v in delta.iteritems() if v)
+            if delta:
+                bulk.find({'_id': _id}).upsert().update_one({'$inc': delta})
+                changed = True
+        if changed:
+            bulk.execute()
+
+    @classmethod
+    def _track_stock_change(cls, updated, configuration_index, delta):
+        """Updates the category counters after ``delta`` was added to the quantity of a configuration
+
+        :param updated: the raw product document as it is after the change
+        """
+        after = cls._counted_state(updated)
+        updated['configurations'][configuration_index]['qty'] -= delta
+        before = cls._counted_state(updated)
+        cls._update_category_counters(before, after)
+        updated['configurations'][configuration_index]['qty'] += delta
+        if before['available'] != after['available']:
+            # Cached products only change when they go out of stock or come back
+            shop_cache.invalidate('product:%s' % updated['_id'])
+
+    @classmethod
+    def _categories_path(cls, category_id, categories_ids=None):
+        """Ids of all the categories a product belongs to, including their ancestors"""
+        tree = get_category_tree()
+        path = []
+        for _id in [category_id] + list(categories_ids or []):
+            if not _id:
+                continue
+            for ancestor in tree.path(_id) or [ObjectId(_id)]:
+                if ancestor not in path:
+                    path.append(ancestor)
+        return path
+
     @classmethod
     def _config_idx(cls, product, sku):
         return [i for i, config in enumerate(product['configurations']) if config['sku'] == sku][0]
@@ -329,6 +613,7 @@ class ProductManager(object):
         return dict(
             name=product.name,
             category_name=product.category.name if product.category is not None else '',
+            category_id=product.category_id,
             description=product.description,
             product_details=product.details,
             base_vat=config.get('vat', 0.0),
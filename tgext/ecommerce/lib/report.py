@@ -0,0 +1,154 @@
+# coding=utf-8
+from __future__ import unicode_literals
+import datetime
+from itertools import chain
+import logging
+from multiprocessing.pool import ThreadPool
+import tg
+from tg.util import Bunch
+from tgext.ecommerce.lib.lease import MongoLease
+from tgext.ecommerce.model import models
+
+log = logging.getLogger('tgext.ecommerce')
+
+
+class ReportManager(object):
+    COUNTERS = ('orders', 'units', 'net', 'tax', 'gross', 'shipping', 'discount')
+    ORDER_FIELDS = ['creation_date', 'status', 'items.category_id', 'items.rate', 'items.qty',
+                    'items.net_price', 'items.vat', 'items.gross_price', 'shipping_charges', 'applied_discount',
+                    'checkout.rollup_started']
+
+    @classmethod
+    def sales(cls, start, end, group_by=('day', ), status=None):
+        """Sales totals between ``start`` (included) and ``end`` (excluded) merged from the daily rollups.
+
+        :param group_by: any of ``day``, ``status``, ``category_id`` and ``rate``,
+                         grouping by category or rate splits the orders by their lines,
+                         so the same order is counted once for each category or rate it contains.
+        :param status: a status or a list of statuses to include, all of them by default
+        :returns: a list of Bunch with the group_by fields and the counters in cents
+        """
+        scope = 'lines' if set(group_by) & set(['category_id', 'rate']) else 'orders'
+        query = {'scope': scope, 'day': {'$gte': models.SalesRollup.day_of(start),
+                                         '$lt': models.SalesRollup.day_of(end)}}
+        if status is not None:
+            query['status'] = status if isinstance(status, basestring) else {'$in': list(status)}
+
+        group = dict((counter, {'$sum': '$%s' % counter}) for counter in cls.COUNTERS)
+        group['_id'] = dict((field, '$%s' % field) for field in group_by)
+        result = models.DBSession.impl.db.sales_rollups.aggregate([{'$match': query}, {'$group': group}])
+        rows = []
+        for row in result['result']:
+            values = Bunch(row.pop('_id'))
+            values.update(row)
+            rows.append(values)
+        return sorted(rows, key=lambda r: tuple(r.get(field) for field in group_by))
+
+    @classmethod
+    def rebuild(cls, start, end, workers=4, chunk_days=7):
+        """Brings the rollups between ``start`` and ``end`` back in line with the orders, archived ones included.
+
+        Each day is compared with what its orders add up to and only the difference is
+        applied with ``$inc``, so the increments of checkouts and status changes landing
+        meanwhile are kept. Days with orders changed in the last ``sales_rollups.quiet_period``
+        seconds or with a checkout applying its rollups can't be compared reliably,
+        they are skipped and must be rebuilt again later.
+
+        Rebuilds are serialized through the ``sales_rollups_rebuild`` lease, as two of them
+        running together would apply the same difference twice. The range is split in chunks
+        of ``chunk_days`` days rebuilt in parallel by ``workers`` threads.
+
+        :returns: the number of rollups corrected
+        """
+        lease = MongoLease('sales_rollups_rebuild')
+        if not lease.acquire():
+            log.warn('Sales rollups are already being rebuilt, skipping %s - %s', start, end)
+            return 0
+        lease.keep_alive()
+
+        start, end = models.SalesRollup.day_of(start), models.SalesRollup.day_of(end)
+        chunks = []
+        while start < end:
+            chunk_end = min(start + datetime.timedelta(days=chunk_days), end)
+            chunks.append((start, chunk_end))
+            start = chunk_end
+
+        pool = ThreadPool(workers)
+        try:
+            return sum(pool.map(lambda chunk: cls._rebuild_range(*chunk), chunks))
+        finally:
+            pool.close()
+            lease.release()
+
+    @classmethod
+    def _rebuild_range(cls, start, end):
+        corrected = 0
+        day = start
+        while day < end:
+            corrected += cls._rebuild_day(day)
+            day += datetime.timedelta(days=1)
+        return corrected
+
+    @classmethod
+    def _rebuild_day(cls, day, attempts=3):
+        db = models.DBSession.impl.db
+        end = day + datetime.timedelta(days=1)
+        quiet_period = datetime.timedelta(seconds=int(tg.config.get('sales_rollups.quiet_period', 300)))
+        step_timeout = datetime.timedelta(seconds=int(tg.config.get('orders.checkout_step_timeout', 60)))
+
+        for _ in range(attempts):
+            started = datetime.datetime.utcnow()
+            current = cls._day_rollups(day)
+            expected = {}
+            abandoned = []
+            # Orders whose checkout didn't apply their rollups yet will add them on their own
+            query = {'creation_date': {'$gte': day, '$lt': end}, 'checkout.pending': {'$ne': 'rollup'}}
+            orders = chain(db.orders.find(query, fields=cls.ORDER_FIELDS),
+                           db.orders_archive.find(query, fields=cls.ORDER_FIELDS))
+            for order in orders:
+                rollup_started = order.get('checkout', {}).get('rollup_started')
+                if rollup_started is not None:
+                    if rollup_started > started - step_timeout:
+                        log.warn('A checkout is applying the sales rollups of %s, not rebuilt', day)
+                        return 0
+                    # The checkout died applying them, they get fixed here
+                    abandoned.append((order['_id'], rollup_started))
+                models.SalesRollup.merge(expected, models.SalesRollup.contributions(
+                    order['creation_date'], order['status'], order.get('items', []),
+                    order.get('shipping_charges'), order.get('applied_discount')
+                ))
+
+            if cls._day_rollups(day) != current:
+                # Changed while reading the orders, the two can't be compared
+                continue
+            # Orders are saved before their rollups change, so recent changes might be half applied
+            recent = started - quiet_period
+            if db.orders.find_one({'creation_date': {'$gte': day, '$lt': end},
+                                   '$or': [{'creation_date': {'$gte': recent}},
+                                           {'status_changes.changed_at': {'$gte': recent}}]},
+                                  fields=['_id']) is not None:
+                log.warn('Orders of %s changed recently, sales rollups not rebuilt', day)
+                return 0
+
+            corrections = {}
+            for key in set(expected) | set(current):
+                delta = dict((counter, expected.get(key, {}).get(counter, 0) - current.get(key, {}).get(counter, 0))
+                             for counter in cls.COUNTERS)
+                delta = dict((counter, value) for counter, value in delta.iteritems() if value)
+                if delta:
+                    corrections[key] = delta
+            models.SalesRollup.apply(corrections)
+            for _id, rollup_started in abandoned:
+                db.orders.update({'_id': _id, 'checkout.rollup_started': rollup_started},
+                                 {'$unset': {'checkout.rollup_started': True}})
+            return len(corrections)
+
+        log.warn('Sales rollups of %s keep changing, not rebuilt', day)
+        return 0
+
+    @classmethod
+    def _day_rollups(cls, day):
+        """The counters of the rollups of a day indexed by rollup key"""
+        return dict(((r['day'], r['scope'], r['status'], r.get('category_id'), r.get('rate')),
+                     dict((counter, r.get(counter, 0)) for counter in cls.COUNTERS))
+                    for r in models.DBSession.impl.db.sales_rollups.find({'day': day}))
@@ -0,0 +1,204 @@
+# coding=utf-8
+from __future__ import unicode_literals
+from datetime import datetime, timedelta
+import logging
+import random
+import threading
+import time
+import tg
+from tg.util import Bunch
+from tgext.ecommerce.lib.lease import MongoLease
+from tgext.ecommerce.model import DBSession
+
+log = logging.getLogger('tgext.ecommerce')
+
+
+class Job(object):
+    def __init__(self, name, func, interval, jitter=0.1, deadline=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.deadline = deadline
+        self.next_run = datetime.utcnow()
+
+    def schedule(self, now):
+        """Plans the next run ``interval`` seconds from ``now``, spread by ``jitter`` percent,
+        or at the job deadline when it comes earlier
+        """
+        spread = self.interval * self.jitter
+        self.next_run = now + timedelta(seconds=self.interval + random.uniform(-spread, spread))
+        if self.deadline is not None:
+            deadline = self.deadline()
+            if deadline is not None and deadline < self.next_run:
+                self.next_run = max(deadline, now)
+
+
+class JobRunner(object):
+    """Runs the periodic jobs of the shop in a single process of the whole cluster.
+
+    Every process starts a runner, but only the one holding the scheduler lease
+    (the leader) runs the jobs, the others just try to take the lease over
+    in case the leader dies.
+
+    Run statistics and manual triggers are stored in the ``scheduler`` setting,
+    so they can be read and requested from any process.
+    """
+    SETTING = 'scheduler'
+
+    def __init__(self, tick=None, lease=None):
+        self._tick = tick
+        self.lease = lease or MongoLease('scheduler')
+        self.jobs = {}
+        self.leader = False
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    @property
+    def tick(self):
+        if self._tick is None:
+            self._tick = float(tg.config.get('scheduler.tick', 5))
+        return self._tick
+
+    @property
+    def _settings(self):
+        return DBSession.impl.db.ecommerce_settings
+
+    def register(self, name, func, interval, jitter=0.1, deadline=None):
+        """Runs ``func`` every ``interval`` seconds, spread by ``jitter`` percent of the interval.
+
+        :param deadline: callable returning when the job is needed next, or ``None``,
+                         the job then runs at that time with ``interval`` as the longest wait
+        """
+        self.jobs[name] = Job(name, func, interval, jitter, deadline)
+        return self.jobs[name]
+
+    def wake(self, name, at=None):
+        """Brings the next run of a job forward to ``at``, now by default, on whichever process leads"""
+        job = self.jobs.get(name)
+        if job is None:
+            return
+        now = datetime.utcnow()
+        at = at or now
+        if now < job.next_run <= at:
+            # A run at least as early is already planned
+            return
+
+        job.next_run = at
+        next_run = 'value.%s.next_run' % name
+        self._settings.update({'setting': self.SETTING, '$or': [{next_run: {'$gt': at}}, {next_run: None}]},
+                              {'$set': {next_run: at}})
+        self._wakeup.set()
+
+    def trigger(self, name):
+        """Asks the leader to run a job as soon as possible, whatever its schedule"""
+        if name not in self.jobs:
+            raise KeyError(name)
+        self._settings.update({'setting': self.SETTING}, {'$set': {'value.%s.triggered' % name: True}}, upsert=True)
+        self._wakeup.set()
+
+    def run(self, name):
+        """Runs a job right now in the calling thread, even outside of the leader"""
+        return self._run(self.jobs[name])
+
+    def stats(self):
+        """Run statistics of every job: ``runs``, ``failures``, ``last_run``, ``last_duration``,
+        ``last_error`` and ``next_run``
+        """
+        value = self._stored()
+        return dict((name, Bunch(value.get(name, {}))) for name in self.jobs)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='ecommerce-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        if self.leader:
+            self.lease.release()
+            self.leader = False
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                if self._elect():
+                    self._run_due()
+            except Exception:
+                log.exception('Scheduler iteration failed')
+            self._wakeup.wait(self._sleep_time())
+            self._wakeup.clear()
+
+    def _sleep_time(self):
+        if not self.leader or not self.jobs:
+            return self.tick
+        earliest = min(job.next_run for job in self.jobs.itervalues())
+        until = (earliest - datetime.utcnow()).total_seconds()
+        return max(0, min(self.tick, until))
+
+    def _elect(self):
+        if self.leader and not self.lease.is_mine():
+            log.warn('Scheduler leadership lost')
+            self.leader = False
+        if not self.leader and self.lease.acquire():
+            log.warn('Scheduler leadership taken')
+            self.lease.keep_alive()
+            self.leader = True
+            # Carry on with the schedule of the previous leader
+            value = self._stored()
+            for job in self.jobs.itervalues():
+                job.next_run = value.get(job.name, {}).get('next_run') or datetime.utcnow()
+        return self.leader
+
+    def _stored(self):
+        setting = self._settings.find_one({'setting': self.SETTING}) or {}
+        return setting.get('value') or {}
+
+    def _run_due(self):
+        value = self._stored()
+        for job in self.jobs.itervalues():
+            # Woken by other processes
+            woken = value.get(job.name, {}).get('next_run')
+            if woken is not None and woken < job.next_run:
+                job.next_run = woken
+
+        for job in sorted(self.jobs.itervalues(), key=lambda j: j.next_run):
+            if self._stop.is_set() or not self.lease.is_mine():
+                break
+            triggered = value.get(job.name, {}).get('triggered', False)
+            if triggered or job.next_run <= datetime.utcnow():
+                self._run(job)
+                job.schedule(datetime.utcnow())
+                self._settings.update({'setting': self.SETTING},
+                                      {'$set': {'value.%s.next_run' % job.name: job.next_run}})
+
+    def _run(self, job):
+        started = time.time()
+        error = None
+        result = None
+        try:
+            result = job.func()
+        except Exception as e:
+            log.exception('Job %s failed', job.name)
+            error = '%s: %s' % (e.__class__.__name__, e)
+
+        prefix = 'value.%s.' % job.name
+        update = {'$set': {prefix + 'last_run': datetime.utcnow(),
+                           prefix + 'last_duration': time.time() - started,
+                           prefix + 'last_error': error,
+                           prefix + 'triggered': False},
+                  '$inc': {prefix + 'runs': 1, prefix + 'failures': 1 if error else 0}}
+        self._settings.update({'setting': self.SETTING}, update, upsert=True)
+        return result
+
+
+job_runner = JobRunner()
@@ -1,9 +1,14 @@
 
+from tgext.ecommerce.lib.cache import shop_cache
 from tgext.ecommerce.lib.cart import CartManager
 from tgext.ecommerce.lib.category import CategoryManager
 from tgext.ecommerce.lib.order import OrderManager
 from tgext.ecommerce.lib.payments import paypal, null_payment
+from tgext.ecommerce.lib.payments.gateway import PaymentGateway, get_gateway
 from tgext.ecommerce.lib.product import ProductManager
+from tgext.ecommerce.lib.report import ReportManager
+from tgext.ecommerce.lib.job_queue import job_queue
+from tgext.ecommerce.lib.scheduler import job_runner
 
 
 class ShopManager(object):
@@ -11,13 +16,39 @@ class ShopManager(object):
     product = ProductManager()
     category = CategoryManager()
     order = OrderManager()
+    report = ReportManager()
+    jobs = job_runner
+    queue = job_queue
+    cache = shop_cache
 
-    def pay(self, cart, redirection_url, cancel_url, paymentService=paypal):
-        return paymentService.pay(cart, redirection_url, cancel_url)
+    def enqueue(self, task, *args, **kwargs):
+        """Runs ``task`` in background with the given arguments, see :meth:`JobQueue.enqueue`
+        to control priority, delay, attempts and deduplication
+        """
+        return job_queue.enqueue(task, args=args, kwargs=kwargs)
+
+    @staticmethod
+    def payment_gateway(paymentService):
+        """Resolves a payment backend given as gateway, gateway name or payments module"""
+        if isinstance(paymentService, PaymentGateway):
+            return paymentService
+        if isinstance(paymentService, basestring):
+            return get_gateway(paymentService)
+        return paymentService.gateway()
+
+    def pay(self, cart, redirection_url, cancel_url, paymentService=paypal, asynchronous=False):
+        return self._payment_call(paymentService, 'pay', asynchronous, cart, redirection_url, cancel_url)
 
     def confirm(self, cart, redirection, data, paymentService=paypal):
-        return paymentService.confirm(cart, redirection, data)
+        # Never asynchronous, it only builds the url for the current request
+        return self._payment_call(paymentService, 'confirm', False, cart, redirection, data)
 
-    def execute(self, cart, data, paymentService=paypal):
-        return paymentService.execute(cart, data)
+    def execute(self, cart, data, paymentService=paypal, asynchronous=False):
+        return self._payment_call(paymentService, 'execute', asynchronous, cart, data)
 
+    def _payment_call(self, paymentService, method, asynchronous, *args):
+        """Calls the gateway, when ``asynchronous`` returns an ``AsyncResult`` instead of waiting for it"""
+        gateway = self.payment_gateway(paymentService)
+        if asynchronous:
+            return gateway.submit(method, *args)
+        return getattr(gateway, method)(*args)
@@ -0,0 +1,92 @@
+# coding=utf-8
+from __future__ import unicode_literals
+from collections import OrderedDict
+import threading
+import time
+from bson import ObjectId
+import tg
+from tgext.pluggable import app_model
+
+
+class UserNameResolver(object):
+    """Resolves user ids to display names through a LRU cache shared by the whole process.
+
+    Missing names are fetched with a single ``$in`` query however many ids are asked,
+    ids of users that don't exist are remembered for ``user_names.missing_ttl`` seconds.
+    """
+    def __init__(self, size=None, ttl=None, missing_ttl=None):
+        self._size = size
+        self._ttl = ttl
+        self._missing_ttl = missing_ttl
+        self._names = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = int(tg.config.get('user_names.cache_size', 1024))
+        return self._size
+
+    @property
+    def ttl(self):
+        if self._ttl is None:
+            self._ttl = int(tg.config.get('user_names.cache_ttl', 600))
+        return self._ttl
+
+    @property
+    def missing_ttl(self):
+        if self._missing_ttl is None:
+            self._missing_ttl = int(tg.config.get('user_names.missing_ttl', 60))
+        return self._missing_ttl
+
+    @staticmethod
+    def display_name(user):
+        return '%s %s' % (getattr(user, 'name', user.email_address), getattr(user, 'surname', ''))
+
+    def remember(self, user_id, name):
+        """Caches the name of a user, ``None`` for users that don't exist"""
+        ttl = self.ttl if name is not None else self.missing_ttl
+        with self._lock:
+            self._names.pop(user_id, None)
+            self._names[user_id] = (name, time.time() + ttl)
+            while len(self._names) > self.size:
+                self._names.popitem(last=False)
+
+    def forget(self, user_id):
+        with self._lock:
+            self._names.pop(str(user_id), None)
+
+    def resolve(self, user_id):
+        """Display name of a single user, ``None`` when the user doesn't exist"""
+        return self.resolve_many([user_id]).get(str(user_id))
+
+    def resolve_many(self, user_ids):
+        """Display names of the given users indexed by the string of their id"""
+        now = time.time()
+        names = {}
+        missing = set()
+        with self._lock:
+            for user_id in user_ids:
+                user_id = str(user_id)
+                cached = self._names.get(user_id)
+                if cached is not None and cached[1] > now:
+                    self._names[user_id] = self._names.pop(user_id)
+                    if cached[0] is not None:
+                        names[user_id] = cached[0]
+                else:
+                    missing.add(user_id)
+
+        # Ids that are not ObjectIds can't belong to any user
+        lookup = [ObjectId(user_id) for user_id in missing if ObjectId.is_valid(user_id)]
+        if lookup:
+            for user in app_model.User.query.find({'_id': {'$in': lookup}}):
+                user_id = str(user._id)
+                names[user_id] = self.display_name(user)
+                self.remember(user_id, names[user_id])
+        for user_id in missing:
+            if user_id not in names:
+                self.remember(user_id, None)
+        return names
+
+
+user_names = UserNameResolver()
@@ -1,5 +1,7 @@
+from contextlib import contextmanager
 import os
 import re, unicodedata
+import threading
 import tg
 import gettext
 import math
@@ -43,6 +45,52 @@ def slugify_category(value, models):
     return value
 
 
+def search_tokens(value):
+    """Lowercase ascii words of a text, used for indexed searches"""
+    if not value:
+        return []
+    if not isinstance(value, unicode):
+        value = str(value).decode('utf-8', 'ignore')
+    value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode('ascii').lower()
+    return [token for token in re.split('[^a-z0-9]+', value) if token]
+
+
+def _trigrams(token):
+    return [token[i:i+3] for i in range(len(token) - 2)]
+
+
+def search_terms(values, max_prefix=24):
+    """Terms to store on a document to make it searchable by word prefix and by trigram"""
+    terms = set()
+    for value in values:
+        for token in search_tokens(value):
+            terms.add(token)
+            terms.update(token[:n] for n in range(2, min(len(token), max_prefix) + 1))
+            terms.update(_trigrams(token))
+    return sorted(terms)
+
+
+def search_query(text, field='search_terms'):
+    """Query matching the documents whose ``search_terms`` contain every word of ``text``
+    either as a word prefix or as a substring.
+
+    Words shorter than two characters are ignored, text made only of them matches nothing.
+    """
+    conditions = []
+    for token in search_tokens(text):
+        if len(token) < 2:
+            continue
+        options = [{field: token}]
+        if len(token) > 3:
+            options.append({field: {'$all': _trigrams(token)}})
+        conditions.append({'$or': options})
+    if not conditions:
+        return {'_id': {'$in': []}}
+    if len(conditions) == 1:
+        return conditions[0]
+    return {'$and': conditions}
+
+
 def short_lang(languages_list):
     try:
         return languages_list[0].split("_")[0]
@@ -56,8 +104,55 @@ def internationalise(value):
     return {tg.config.lang: value}
 
 
+_language = threading.local()
+
+
 def preferred_language():
-    return short_lang(tg.i18n.get_lang(all=False))
+    """Language to show contents in.
+
+    Inside a request it's resolved from the request languages only once and
+    kept in the request environ, outside of requests it's the default language
+    of the application. :func:`language_override` takes precedence on both.
+    """
+    language = getattr(_language, 'override', None)
+    if language is not None:
+        return language
+
+    try:
+        environ = tg.request.environ
+    except TypeError:
+        # No request, as in background jobs
+        return tg.config.lang
+
+    language = environ.get('tgext.ecommerce.language')
+    if language is None:
+        language = environ['tgext.ecommerce.language'] = short_lang(tg.i18n.get_lang(all=False))
+    return language
+
+
+@contextmanager
+def language_override(language):
+    """Makes :func:`preferred_language` return ``language`` in the current thread, for jobs and emails::
+
+        with language_override(order.details['language']):
+            send_confirmation(order)
+    """
+    previous = getattr(_language, 'override', None)
+    _language.override = language
+    try:
+        yield
+    finally:
+        _language.override = previous
+
+
+def localized(value, language=None):
+    """Translation of an internationalised value in ``language``, the preferred one by default,
+    falling back to the default language of the application
+    """
+    try:
+        return value[language or preferred_language()]
+    except KeyError:
+        return value.get(tg.config.lang)
 
 
 class with_currency(object):
@@ -5,13 +5,18 @@ from bson import ObjectId
 
 
 class ProductValidator(FancyValidator):
-    def __init__(self, using='_id'):
+    def __init__(self, using='_id', cached=False):
         super(ProductValidator, self).__init__(not_empty=True)
         self.using = using
+        # Product pages that only display the product can get the cached read-only view
+        self.cached = cached
 
     def _convert_to_python(self, value, state):
         kwargs = {self.using: value}
-        product = app_globals.shop.product.get(**kwargs)
+        if self.cached:
+            product = app_globals.shop.product.get_details(**kwargs)
+        else:
+            product = app_globals.shop.product.get(**kwargs)
 
         if product is None:
             raise Invalid('Product not found', value, state)
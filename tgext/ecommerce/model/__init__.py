@@ -8,4 +8,4 @@ DBSession = PluggableSession()
 def init_model(app_session):
     DBSession.configure(app_session)
 
-from models import Category, Product, Cart, Order, Setting
\ No newline at end of file
+from models import Category, CategoryCounter, Product, ProductView, Cart, Order, OrderView, SalesRollup, Setting
\ No newline at end of file
@@ -1,25 +1,76 @@
 from datetime import datetime, timedelta
 from itertools import groupby, imap, chain
 from bson import ObjectId
+import logging
 import math
 from ming.odm.property import ORMProperty
 from ming.odm import FieldProperty, ForeignIdProperty, RelationProperty, MapperExtension
 from ming.odm.declarative import MappedClass
 from ming import schema as s, DESCENDING, ASCENDING
+from pymongo.errors import DuplicateKeyError
 import tg
-from tg import cache
 from tg.caching import cached_property
 from tg.util import Bunch
-from tgext.pluggable import app_model
-from tgext.ecommerce.lib.utils import short_lang, preferred_language, apply_vat, with_currency
+from tgext.ecommerce.lib.utils import localized, apply_vat, with_currency, search_terms
+from tgext.ecommerce.lib.cache import shop_cache
+from tgext.ecommerce.lib.users import user_names
 from tgext.ecommerce.model import DBSession
 import operator
 
+log = logging.getLogger('tgext.ecommerce')
+
+
+class CategoryTreeExt(MapperExtension):
+    def after_insert(self, instance, state, sess):
+        shop_cache.invalidate('categories', 'category:%s' % instance._id)
+
+    def after_update(self, instance, state, sess):
+        shop_cache.invalidate('categories', 'category:%s' % instance._id)
+
+    def after_delete(self, instance, state, sess):
+        shop_cache.invalidate('categories', 'category:%s' % instance._id)
+
+
+class ProductCacheExt(MapperExtension):
+    def after_insert(self, instance, state, sess):
+        shop_cache.invalidate(*Product.cache_tags(instance._id, instance.categories_path))
+
+    def after_update(self, instance, state, sess):
+        # A product moved to other categories must also leave the listings of the previous ones
+        previous = (state.original_document or {}).get('categories_path') or []
+        shop_cache.invalidate(*Product.cache_tags(instance._id, list(instance.categories_path or []) + previous))
+
+    def after_delete(self, instance, state, sess):
+        shop_cache.invalidate(*Product.cache_tags(instance._id, instance.categories_path))
+
+
+class ProductCountersExt(MapperExtension):
+    """Applies the category counter changes of a product once it's saved"""
+    def after_insert(self, instance, state, sess):
+        self._update_counters(instance, state, None)
+
+    def after_update(self, instance, state, sess):
+        from tgext.ecommerce.lib.product import ProductManager
+
+        before = state.extra_state.get('counted')
+        if before is None:
+            before = ProductManager._counted_state(state.original_document or {})
+        self._update_counters(instance, state, before)
+
+    def _update_counters(self, instance, state, before):
+        from tgext.ecommerce.lib.product import ProductManager
+
+        # The original document isn't refreshed by saves, later ones start from what was counted
+        after = ProductManager._counted_state(instance)
+        ProductManager._update_category_counters(before, after)
+        state.extra_state['counted'] = after
+
 
 class Category(MappedClass):
     class __mongometa__:
         session = DBSession
         name = 'categories'
+        extensions = [CategoryTreeExt]
 
     _id = FieldProperty(s.ObjectId)
     name = FieldProperty(s.Anything, required=True)
@@ -35,7 +86,7 @@ class Category(MappedClass):
 
     @property
     def i18n_name(self):
-        return self.name.get(preferred_language(), self.name.get(tg.config.lang))
+        return localized(self.name)
 
     @property
     def name_with_ancestors(self):
@@ -46,7 +97,7 @@ class Category(MappedClass):
 
     @classmethod
     def i18n_ancestor_name(cls, ancestor):
-        return ancestor.name.get(preferred_language(), ancestor.name.get(tg.config.lang))
+        return localized(ancestor.name)
 
     @classmethod
     def previous(cls, category):
@@ -61,6 +112,18 @@ class Category(MappedClass):
             .sort([('sort_weight', ASCENDING)]).limit(2).all()
 
 
+class CategoryCounter(MappedClass):
+    class __mongometa__:
+        session = DBSession
+        name = 'category_counters'
+
+    _id = FieldProperty(s.ObjectId)
+    active = FieldProperty(s.Int, if_missing=0)
+    available = FieldProperty(s.Int, if_missing=0)
+    subtree_active = FieldProperty(s.Int, if_missing=0)
+    subtree_available = FieldProperty(s.Int, if_missing=0)
+
+
 class Product(MappedClass):
     class __mongometa__:
         session = DBSession
@@ -75,7 +138,9 @@ class Product(MappedClass):
                    ('type', 'active', 'sort_weight'),
                    ('type', 'active', ('sort_category_weight', -1)),
                    ('type', 'active', 'sort_category_weight'),
+                   ('categories_path', 'active', 'sort_category_weight'),
                    ('type', 'published', 'active', ('sold', -1))]
+        extensions = [ProductCacheExt, ProductCountersExt]
 
     _id = FieldProperty(s.ObjectId)
     name = FieldProperty(s.Anything, required=True)
@@ -84,6 +149,7 @@ class Product(MappedClass):
     category = RelationProperty(Category, via='category_id')
     categories_ids = ForeignIdProperty(Category, uselist=True)
     categories = RelationProperty(Category, via='categories_ids')
+    categories_path = FieldProperty([s.ObjectId])
     description = FieldProperty(s.Anything, if_missing='')
     slug = FieldProperty(s.String, required=True)
     details = FieldProperty(s.Anything, if_missing={})
@@ -103,6 +169,7 @@ class Product(MappedClass):
         'rate': s.Float(if_missing=0.0),
         'vat': s.Float(required=True),
         'details': s.Anything(if_missing={}),
+        'restocked_by': s.String(),
     }])
 
     def min_price_configuration(self, min_qty_getter=1):
@@ -126,11 +193,11 @@ class Product(MappedClass):
 
     @property
     def i18n_name(self):
-        return self.name.get(preferred_language(), self.name.get(tg.config.lang))
+        return localized(self.name)
 
     @property
     def i18n_description(self):
-        return self.description.get(preferred_language(), self.description.get(tg.config.lang))
+        return localized(self.description)
 
     @property
     def available(self):
@@ -144,7 +211,7 @@ class Product(MappedClass):
         return False
 
     def i18n_configuration_variety(self, configuration):
-        return configuration.variety.get(preferred_language(), configuration.variety.get(tg.config.lang))
+        return localized(configuration.variety)
 
     def configuration_gross_price(self, configuration):
         return configuration.price + configuration.vat
@@ -169,14 +236,35 @@ class Product(MappedClass):
         return cls.query.find({'sort_category_weight': {'$gt': product.sort_category_weight}}).\
                          sort([('sort_category_weight', ASCENDING)]).limit(2).all()
 
+    @classmethod
+    def cache_tags(cls, _id, categories_path=None):
+        """Cache tags invalidated when the product changes"""
+        return ['product:%s' % _id] + ['category:%s' % c for c in categories_path or []]
+
     @classmethod
     def increase_sold(cls, sku, qty):
         DBSession.update(cls, {'configurations.sku': sku}, {'$inc': {'sold': qty}})
 
+    @classmethod
+    def increase_sold_many(cls, sold):
+        """Increases the sold counter of many products with a single bulk write
+
+        :param sold: a dictionary of sold quantities indexed by sku
+        """
+        if not sold:
+            return
+        bulk = DBSession.impl.db.products.initialize_unordered_bulk_op()
+        for sku, qty in sold.iteritems():
+            bulk.find({'configurations.sku': sku}).update_one({'$inc': {'sold': qty}})
+        bulk.execute()
+
 class CartTtlExt(MapperExtension):
 
     _cart_ttl = None
 
+    #: callables notified with the expiration of every saved cart
+    expiration_listeners = []
+
     @classmethod
     def cart_expiration(cls):
         if cls._cart_ttl is None:
@@ -186,6 +274,20 @@ class CartTtlExt(MapperExtension):
     def before_update(self, instance, state, sess):
         instance.expires_at = self.cart_expiration()
 
+    def after_insert(self, instance, state, sess):
+        self._notify(instance.expires_at)
+
+    def after_update(self, instance, state, sess):
+        self._notify(instance.expires_at)
+
+    @classmethod
+    def _notify(cls, expires_at):
+        for listener in cls.expiration_listeners:
+            try:
+                listener(expires_at)
+            except Exception:
+                log.exception('Cart expiration listener failed')
+
 
 class Cart(MappedClass):
     class __mongometa__:
@@ -281,41 +383,63 @@ class Cart(MappedClass):
 
 class OrderStatusExt(MapperExtension):
     def before_insert(self, instance, state, sess):
+        self.prepare(instance)
+
+    @classmethod
+    def prepare(cls, instance):
+        """Fills the initial status change, customer name, search terms and summary of a new order"""
         status = instance.status or 'created'
-        self._change_status(instance, status)
-        self._store_user_name(instance)
+        cls._change_status(instance, status)
+        cls._store_user_name(instance)
+        instance.summary = Order.summary_of(instance)
+
+    def after_insert(self, instance, state, sess):
+        SalesRollup.apply(SalesRollup.contributions(instance.creation_date, instance.status or 'created', instance.items,
+                                                    instance.shipping_charges, instance.applied_discount))
 
     def before_update(self, instance, state, sess):
-        if instance.status != self._prev_status(instance):
+        prev_status = self._prev_status(instance)
+        if instance.status != prev_status:
             self._change_status(instance, instance.status)
+            state.extra_state['rollups_move'] = (prev_status, instance.status)
+
+    def after_update(self, instance, state, sess):
+        # Moved once the order is saved, rollup rebuilds rely on orders changing before their rollups
+        move = state.extra_state.pop('rollups_move', None)
+        if move is not None:
+            SalesRollup.move(instance.creation_date, move[0], move[1], instance.items,
+                             instance.shipping_charges, instance.applied_discount)
 
-    def _change_status(self, instance, status):
+    @classmethod
+    def _change_status(cls, instance, status):
         try:
             identity = tg.request.identity['user']
         except:
             identity = Bunch(name='Automatic', surname='Change', email_address='')
-        changed_by = '%s %s' % (getattr(identity, 'name', identity.email_address), getattr(identity, 'surname', ''))\
-            if identity else (None, None)
+        changed_by = user_names.display_name(identity) if identity else (None, None)
         instance.status_changes.append({'status': status, 'changed_by': changed_by, 'changed_at': datetime.utcnow()})
 
-    def _prev_status(self, instance):
+    @classmethod
+    def _prev_status(cls, instance):
         return instance.status_changes[-1]['status']
 
-    def _store_user_name(self, instance):
-        user_id = instance.user_id
-        user_obj = app_model.User.query.get(_id=ObjectId(user_id))
-        user = '%s %s' % (getattr(user_obj, 'name', user_obj.email_address), getattr(user_obj, 'surname', ''))
-        instance.user = user
+    @classmethod
+    def _store_user_name(cls, instance):
+        instance.user = user_names.resolve(instance.user_id)
+        instance.search_terms = Order.search_terms_of(instance)
 
 
 class Order(MappedClass):
     class __mongometa__:
         session = DBSession
         name = 'orders'
-        indexes = [('user_id', ),
+        indexes = [(('user_id', ), ('creation_date', -1)),
                    ('status_changes.changed_at', ),
                    (('user', ), ('status_changes.changed_at', )),
                    (('status', ), ('status_changes.changed_at', )),
+                   (('status', ), ('creation_date', -1)),
+                   (('search_terms', ), ('creation_date', -1)),
+                   (('items.sku', ), ('creation_date', -1)),
                    ('creation_date', )
                    ]
         extensions = [OrderStatusExt]
@@ -361,6 +485,7 @@ class Order(MappedClass):
     items = FieldProperty([{
         'name': s.Anything(required=True),
         'category_name': s.Anything(if_missing={}),
+        'category_id': s.ObjectId(),
         'variety': s.Anything(required=True),
         'qty': s.Int(required=True),
         'sku': s.String(required=True),
@@ -385,12 +510,47 @@ class Order(MappedClass):
     due = FieldProperty(s.Float, if_missing=0.0)
     discounts = FieldProperty(s.Anything, if_missing=[])
     applied_discount = FieldProperty(s.Float, if_missing=0)
+    vat_rates_breakdown = FieldProperty([{
+        'rate': s.Float(),
+        'amount': s.Int()
+    }])
     status = FieldProperty(s.String, required=True)
     notes = FieldProperty(s.String, if_missing='')
     message = FieldProperty(s.String, if_missing='')
     payment_type = FieldProperty(s.String, if_missing='')
     details = FieldProperty(s.Anything, if_missing={})
     status_changes = FieldProperty(s.Anything, if_missing=[])
+    search_terms = FieldProperty([s.String])
+    payment = FieldProperty(s.Anything, if_missing={})
+    summary = FieldProperty({
+        'item_count': s.Int(if_missing=0),
+        'thumbnail': s.String()
+    })
+    checkout = FieldProperty({
+        'completed': s.Bool(if_missing=False),
+        'attempts': s.Int(if_missing=0),
+        'pending': [s.String],
+        'rollup_started': s.DateTime
+    })
+    sold_counted = FieldProperty(s.Bool, if_missing=False)
+
+    @classmethod
+    def summary_of(cls, order):
+        """Number of items and photo of the first one, all the order history needs to show about the items"""
+        thumbnail = None
+        for item in order.items or []:
+            photos = (item.get('details') or {}).get('product_photos')
+            if photos:
+                thumbnail = photos[0]['url']
+                break
+        return {'item_count': sum(item['qty'] for item in order.items or []), 'thumbnail': thumbnail}
+
+    @classmethod
+    def search_terms_of(cls, order):
+        """Search terms of the customer name, payer name and email and order id"""
+        payer_info = order.payer_info or {}
+        return search_terms([order.user, payer_info.get('first_name'), payer_info.get('last_name'),
+                             payer_info.get('email'), order._id])
 
     @property
     def formatted_currencies(self):
@@ -402,36 +562,50 @@ class Order(MappedClass):
 
     @property
     def net_per_vat_rate(self):
-        def _item_discount_fraction(item, total):
-            discount_chunk = self.applied_discount / total
-            return int(item.gross_price * discount_chunk * 100)
+        if self.vat_rates_breakdown:
+            mapping = dict((b['rate'], b['amount']) for b in self.vat_rates_breakdown)
+        else:
+            mapping = self.compute_vat_rates_breakdown(self.items, self.applied_discount,
+                                                       self.gross_total, self.currencies)
+
+        # Convert everything back to floats for visualization
+        return dict((k, with_currency.cur2float(v)) for k, v in mapping.iteritems())
+
+    @classmethod
+    def compute_vat_rates_breakdown(cls, items, applied_discount, gross_total, currencies=None):
+        """Amount paid for each VAT rate in cents, with the discount spread over the items.
+
+        Works both with mapped objects and raw documents.
+        """
+        def _item_discount_fraction(item):
+            if not gross_total:
+                return 0
+            discount_chunk = applied_discount / gross_total
+            return int(item['gross_price'] * discount_chunk * 100)
 
         mapping = {}
 
-        sorted_items = sorted(self.items, key=lambda i: i['rate'])
+        sorted_items = sorted(items, key=lambda i: i['rate'])
         for k, g in groupby(sorted_items, key=lambda i: i['rate']):
-            mapping[k] = sum(imap(lambda i: (with_currency.float2cur(i.gross_price) + _item_discount_fraction(i, self.gross_total)) * i.qty, g))
+            mapping[k] = sum(imap(lambda i: (with_currency.float2cur(i['gross_price']) + _item_discount_fraction(i)) * i['qty'], g))
 
-
-        if self.currencies.due:
+        currencies = currencies or {}
+        if currencies.get('due') and sorted_items:
             # If we have currency values available, fix the rounding error
             current_total = sum(mapping.itervalues())
-            expected_total = self.currencies.due - self.currencies.shipping_charges
+            expected_total = currencies['due'] - (currencies.get('shipping_charges') or 0)
             delta = expected_total - current_total
             mapping[sorted_items[-1]['rate']] += delta
 
-
-        # Convert everything back to floats for visualization
-        for k, g in mapping.iteritems():
-            mapping[k] = with_currency.cur2float(g)
-
         return mapping
 
+    @classmethod
+    def vat_rates_breakdown_from(cls, mapping):
+        return [{'rate': rate, 'amount': amount} for rate, amount in sorted(mapping.iteritems())]
+
     @property
     def billed_by_name(self):
-        user_obj = app_model.User.query.get(_id=ObjectId(self.billed_by))
-        user = '%s %s' % (user_obj.name, user_obj.surname)
-        return user
+        return user_names.resolve(self.billed_by) or ''
 
     @property
     def bill_country(self):
@@ -442,19 +616,218 @@ class Order(MappedClass):
 
     @classmethod
     def all_the_vats(cls):
-        def aggregate_vats():
-            vat_for_status = DBSession.impl.db.orders.aggregate([{'$project': {'items': 1, 'status': 1}},
-                                                                 {'$unwind': '$items'},
-                                                                 {'$group': {'_id': '$status',
-                                                                             'vat_rates': {'$addToSet': '$items.rate'}}}])
-            return sorted(set(chain(*[v['vat_rates'] for v in vat_for_status['result']])))
-        vat_cache = cache.get_cache('all_the_vats')
-        cachedvalue = vat_cache.get_value(
-            key='42',
-            createfunc=aggregate_vats,
-            expiretime=3600*24*30  # one month
-        )
-        return cachedvalue
+        """Every VAT rate ever used by an order, read from the ``vat_rates`` setting.
+
+        The rates are cached until new ones are registered by any process.
+        """
+        def _fetch_vat_rates():
+            registry = DBSession.impl.db.ecommerce_settings.find_one({'setting': 'vat_rates'})
+            if registry is None:
+                cls.rebuild_vat_rates()
+                registry = DBSession.impl.db.ecommerce_settings.find_one({'setting': 'vat_rates'})
+            return sorted(registry['value']['rates']) if registry else []
+
+        return shop_cache.get_or_create('vat_rates', _fetch_vat_rates, tags=['vat_rates'])
+
+    @classmethod
+    def register_vat_rates(cls, rates):
+        """Adds the given rates to the ``vat_rates`` setting, only writing when some of them are new"""
+        rates = sorted(set(rates))
+        if not rates:
+            return
+        result = DBSession.impl.db.ecommerce_settings.update({'setting': 'vat_rates',
+                                                              'value.rates': {'$not': {'$all': rates}}},
+                                                             {'$addToSet': {'value.rates': {'$each': rates}}})
+        if result.get('updatedExisting', False):
+            shop_cache.invalidate('vat_rates')
+
+    @classmethod
+    def rebuild_vat_rates(cls):
+        """Collects the VAT rates of all the orders in the ``vat_rates`` setting"""
+        vat_for_status = DBSession.impl.db.orders.aggregate([{'$project': {'items': 1, 'status': 1}},
+                                                             {'$unwind': '$items'},
+                                                             {'$group': {'_id': '$status',
+                                                                         'vat_rates': {'$addToSet': '$items.rate'}}}])
+        rates = sorted(set(chain(*[v['vat_rates'] for v in vat_for_status['result']])))
+        update = {'$addToSet': {'value.rates': {'$each': rates}}}
+        try:
+            DBSession.impl.db.ecommerce_settings.update({'setting': 'vat_rates'}, update, upsert=True)
+        except DuplicateKeyError:
+            # Created meanwhile by another process, adding the rates is idempotent
+            DBSession.impl.db.ecommerce_settings.update({'setting': 'vat_rates'}, update)
+        shop_cache.invalidate('vat_rates')
+
+
+class SalesRollup(MappedClass):
+    """Sales totals of a day for an order status.
+
+    Rollups with ``scope`` *orders* hold the totals of whole orders, while rollups
+    with ``scope`` *lines* split the order lines by category and VAT rate.
+    All the amounts are in cents.
+    """
+    class __mongometa__:
+        session = DBSession
+        name = 'sales_rollups'
+        unique_indexes = [('day', 'scope', 'status', 'category_id', 'rate')]
+
+    _id = FieldProperty(s.ObjectId)
+    day = FieldProperty(s.DateTime, required=True)
+    scope = FieldProperty(s.String, required=True)
+    status = FieldProperty(s.String, required=True)
+    category_id = FieldProperty(s.ObjectId)
+    rate = FieldProperty(s.Float)
+    orders = FieldProperty(s.Int, if_missing=0)
+    units = FieldProperty(s.Int, if_missing=0)
+    net = FieldProperty(s.Int, if_missing=0)
+    tax = FieldProperty(s.Int, if_missing=0)
+    gross = FieldProperty(s.Int, if_missing=0)
+    shipping = FieldProperty(s.Int, if_missing=0)
+    discount = FieldProperty(s.Int, if_missing=0)
+
+    @classmethod
+    def day_of(cls, when):
+        return datetime(when.year, when.month, when.day)
+
+    @classmethod
+    def contributions(cls, creation_date, status, items, shipping_charges=0.0, applied_discount=0.0, sign=1):
+        """What an order adds to the rollups as a ``{rollup key: {counter: value}}`` dictionary"""
+        day = cls.day_of(creation_date)
+        order_key = (day, 'orders', status, None, None)
+        result = {order_key: {'orders': sign,
+                              'shipping': sign * with_currency.float2cur(shipping_charges or 0),
+                              'discount': sign * with_currency.float2cur(applied_discount or 0)}}
+        for item in items:
+            counters = {'units': item['qty'],
+                        'net': with_currency.float2cur(item['net_price']) * item['qty'],
+                        'tax': with_currency.float2cur(item['vat']) * item['qty'],
+                        'gross': with_currency.float2cur(item['gross_price']) * item['qty']}
+            line_key = (day, 'lines', status, item.get('category_id'), item.get('rate'))
+            result.setdefault(line_key, {'orders': sign})
+            for key in (order_key, line_key):
+                for counter, value in counters.iteritems():
+                    result[key][counter] = result[key].get(counter, 0) + sign * value
+        return result
+
+    @classmethod
+    def move(cls, creation_date, from_status, to_status, items, shipping_charges=0.0, applied_discount=0.0):
+        """Moves an order from the rollups of a status to the ones of another status"""
+        contributions = cls.contributions(creation_date, from_status, items, shipping_charges, applied_discount, -1)
+        contributions.update(cls.contributions(creation_date, to_status, items, shipping_charges, applied_discount))
+        cls.apply(contributions)
+
+    @classmethod
+    def merge(cls, contributions, other):
+        for key, counters in other.iteritems():
+            merged = contributions.setdefault(key, {})
+            for counter, value in counters.iteritems():
+                merged[counter] = merged.get(counter, 0) + value
+        return contributions
+
+    @classmethod
+    def apply(cls, contributions):
+        if not contributions:
+            return
+        bulk = DBSession.impl.db.sales_rollups.initialize_unordered_bulk_op()
+        for (day, scope, status, category_id, rate), counters in contributions.iteritems():
+            bulk.find({'day': day, 'scope': scope, 'status': status,
+                       'category_id': category_id, 'rate': rate}).upsert().update_one({'$inc': counters})
+        bulk.execute()
+
+
+def _bunchify(value):
+    if isinstance(value, dict):
+        return Bunch((k, _bunchify(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [_bunchify(v) for v in value]
+    return value
+
+
+class OrderView(Bunch):
+    """Read-only order built from a raw, possibly projected, order document.
+
+    Provides the same display properties of :class:`Order` without the
+    cost of mapping and validating the whole document.
+    """
+    LIST_FIELDS = ['user', 'creation_date', 'status', 'status_changes', 'currencies', 'vat_rates_breakdown',
+                   'items.rate', 'items.gross_price', 'items.qty', 'items.details.weight',
+                   'applied_discount', 'gross_total', 'shipping_charges', 'payment_type', 'notes', 'message',
+                   'bill', 'billed', 'billed_date', 'billed_by', 'bill_info.country', 'shipment_info.country',
+                   'details.tracking_number', 'details.tracking_info']
+    HISTORY_FIELDS = ['creation_date', 'status', 'total', 'currencies', 'summary']
+    SKU_FIELDS = ['user_id', 'user', 'creation_date', 'status', 'currencies', 'items.$']
+
+    def __init__(self, document):
+        super(OrderView, self).__init__(_bunchify(document))
+        for field in ('details', 'bill_info', 'shipment_info', 'currencies', 'summary'):
+            self.setdefault(field, Bunch())
+        for field in ('items', 'status_changes', 'vat_rates_breakdown'):
+            self.setdefault(field, [])
+        for item in self.items:
+            item.setdefault('details', Bunch())
+
+    formatted_currencies = Order.formatted_currencies
+    net_per_vat_rate = Order.net_per_vat_rate
+    billed_by_name = Order.billed_by_name
+    bill_country = Order.bill_country
+    compute_vat_rates_breakdown = Order.__dict__['compute_vat_rates_breakdown']
+
+    @property
+    def items(self):
+        # Shadows dict.items to behave like Order
+        return self['items']
+
+    @property
+    def weight(self):
+        return sum([item.details.get('weight', 0) * item.qty for item in self.items])
+
+    @property
+    def thumbnail(self):
+        thumbnail = self.summary.get('thumbnail')
+        return tg.url(thumbnail) if thumbnail else '//placehold.it/300x300'
+
+    def list_columns(self):
+        """JSON friendly values of the columns of the orders listing"""
+        last_change = self.status_changes[-1] if self.status_changes else Bunch()
+        return dict(_id=str(self._id),
+                    user=self.get('user'),
+                    changed_at=last_change.get('changed_at') and last_change.changed_at.isoformat(),
+                    changed_by=last_change.get('changed_by'),
+                    due=self.formatted_currencies.get('due') if self.currencies.get('due') else None,
+                    net_per_vat_rate=[[rate, amount] for rate, amount in sorted(self.net_per_vat_rate.iteritems())]
+                        if self.currencies.get('due') else [],
+                    shipping_charges=self.get('shipping_charges'),
+                    bill_country=self.bill_country,
+                    weight=self.weight,
+                    status=self.get('status'),
+                    payment_type=self.get('payment_type') or '',
+                    notes=bool(self.get('notes')),
+                    message=bool(self.get('message')),
+                    bill=self.get('bill', False),
+                    billed=self.get('billed', False),
+                    billed_date=self.get('billed_date') and self.billed_date.isoformat(),
+                    billed_by=self.billed_by_name if self.get('billed_by') else None)
+
+
+class ProductView(Bunch):
+    """Read-only product built from a raw product document, as cached by the product manager.
+
+    Provides the same display properties of :class:`Product`.
+    """
+    def __init__(self, document):
+        super(ProductView, self).__init__(_bunchify(document))
+        for field in ('name', 'description', 'details'):
+            self.setdefault(field, Bunch())
+        self.setdefault('configurations', [])
+        self.setdefault('active', True)
+        self.setdefault('published', True)
+
+    thumbnail = Product.thumbnail
+    i18n_name = Product.i18n_name
+    i18n_description = Product.i18n_description
+    available = Product.available
+    min_price_configuration = Product.__dict__['min_price_configuration']
+    i18n_configuration_variety = Product.__dict__['i18n_configuration_variety']
+    configuration_gross_price = Product.__dict__['configuration_gross_price']
 
 
 class Setting(MappedClass):
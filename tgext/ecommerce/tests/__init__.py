@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 from unittest import TestCase
 from ming import create_datastore, Session
 from ming.odm import ThreadLocalODMSession
+from tgext.ecommerce.lib.cache import shop_cache
 from tgext.ecommerce.model import init_model, DBSession
 
 
@@ -16,4 +17,12 @@ class RootTest(TestCase):
         from tgext.ecommerce.model import models
         DBSession.remove(models.Product)
         DBSession.remove(models.Category)
-        DBSession.remove(models.Cart)
\ No newline at end of file
+        DBSession.remove(models.Cart)
+        DBSession.remove(models.CategoryCounter)
+        DBSession.remove(models.Order)
+        DBSession.remove(models.SalesRollup)
+        DBSession.remove(models.Setting)
+        DBSession.impl.db.orders_archive.remove({})
+        DBSession.impl.db.ecommerce_jobs.remove({})
+        DBSession.impl.db.ecommerce_cache.remove({})
+        shop_cache.clear_local()
\ No newline at end of file
@@ -0,0 +1,170 @@
+# coding=utf-8
+from __future__ import unicode_literals
+from tgext.ecommerce.lib.cache import NOVALUE
+from tgext.ecommerce.tests import RootTest
+
+
+class TestShopCache(RootTest):
+    def _processes(self):
+        from tgext.ecommerce.lib.cache import ShopCache
+
+        return ShopCache(ttl=60, poll_interval=0), ShopCache(ttl=60, poll_interval=0)
+
+    def test_shared_between_processes(self):
+        first, second = self._processes()
+        self.assertIs(first.get('key'), NOVALUE)
+        first.set('key', [1, 2], tags=['product:1'])
+        self.assertEqual(second.get('key'), [1, 2])
+
+    def test_invalidation_reaches_every_process(self):
+        first, second = self._processes()
+        first.set('product', 'cached', tags=['product:1', 'category:1'])
+        first.set('other', 'cached', tags=['product:2'])
+        self.assertEqual(second.get('product'), 'cached')
+
+        invalidated = []
+        first.subscribe('category:1', invalidated.append)
+        second.invalidate('category:1')
+        self.assertIs(second.get('product'), NOVALUE)
+        self.assertIs(first.get('product'), NOVALUE)
+        self.assertEqual(first.get('other'), 'cached')
+        self.assertEqual(invalidated, ['category:1'])
+
+    def test_local_only_entries(self):
+        first, second = self._processes()
+        tree = object()
+        first.set('tree', tree, tags=['categories'], shared=False)
+        self.assertIs(first.get('tree'), tree)
+        self.assertIs(second.get('tree'), NOVALUE)
+        second.invalidate('categories')
+        self.assertIs(first.get('tree'), NOVALUE)
+
+    def test_values_invalidated_while_computed_are_not_stored(self):
+        first, second = self._processes()
+
+        def compute():
+            second.invalidate('orders')
+            return 'stale'
+
+        self.assertEqual(first.get_or_create('orders', compute, tags=['orders']), 'stale')
+        self.assertIs(first.get('orders'), NOVALUE)
+        self.assertEqual(first.get_or_create('orders', lambda: 'fresh', tags=['orders']), 'fresh')
+        self.assertEqual(second.get('orders'), 'fresh')
+
+    def test_single_flight(self):
+        import threading
+        import time
+
+        first, second = self._processes()
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'computed'
+
+        def lookup(cache):
+            results.append(cache.get_or_create('slow', compute, tags=['products']))
+
+        threads = [threading.Thread(target=lookup, args=(cache, )) for cache in [first, second] * 3]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['computed'] * 6)
+
+    def test_stale_while_revalidate(self):
+        import threading
+        import time
+
+        first, second = self._processes()
+        first.set('key', 'old', ttl=0.1, grace=60)
+        time.sleep(0.2)
+        self.assertIs(first.get('key'), NOVALUE)
+
+        computing = threading.Event()
+
+        def compute():
+            computing.set()
+            time.sleep(0.3)
+            return 'new'
+
+        # Another process is refreshing it meanwhile
+        refresh = threading.Thread(target=second.get_or_create, args=('key', compute))
+        refresh.start()
+        computing.wait(5)
+        self.assertEqual(first.get_or_create('key', lambda: 'other'), 'old')
+        refresh.join()
+        self.assertEqual(first.get_or_create('key', lambda: 'newer'), 'new')
+
+    def test_waiters_take_over_when_nothing_is_stored(self):
+        import threading
+        import time
+        from tgext.ecommerce.lib.cache import ShopCache
+
+        first, second = ShopCache(ttl=60, poll_interval=0), ShopCache(ttl=60, poll_interval=0, lock_timeout=10)
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return None
+
+        def lookup(cache):
+            # Like a missing product, nothing gets stored
+            results.append(cache.get_or_create('missing', compute, tags=lambda value: None))
+
+        started = time.time()
+        threads = [threading.Thread(target=lookup, args=(cache, )) for cache in (first, second)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [None, None])
+        self.assertEqual(len(calls), 2)
+        self.assertLess(time.time() - started, 5)
+
+    def test_early_refresh(self):
+        first, second = self._processes()
+        first.set('key', 'old', ttl=60, delta=10 ** 6)
+        self.assertEqual(second.get_or_create('key', lambda: 'new', beta=0), 'old')
+        self.assertEqual(second.get_or_create('key', lambda: 'new'), 'new')
+
+    def test_product_details(self):
+        from tgext.ecommerce.lib.product import ProductManager
+        from tgext.ecommerce.model import DBSession, Product
+
+        product = Product(type='product', name={'it': 'prosciutto'}, slug='product-prosciutto-0',
+                          configurations=[{'sku': '12345', 'variety': {'it': 'crudo'}, 'qty': 1,
+                                           'initial_quantity': 1, 'price': 10.0, 'vat': 2.2}])
+        DBSession.flush_all()
+        self.assertEqual(ProductManager.get_details(slug='product-prosciutto-0').name, {'it': 'prosciutto'})
+
+        DBSession.impl.db.products.update({'_id': product._id}, {'$set': {'name.it': 'cotto'}})
+        self.assertEqual(ProductManager.get_details(slug='product-prosciutto-0').name, {'it': 'prosciutto'})
+        product.name = {'it': 'speck'}
+        DBSession.flush_all()
+        self.assertEqual(ProductManager.get_details(slug='product-prosciutto-0').name, {'it': 'speck'})
+        self.assertIsNone(ProductManager.get_details(slug='missing'))
+
+    def test_moved_product_leaves_previous_categories(self):
+        from bson import ObjectId
+        from tgext.ecommerce.lib.cache import shop_cache
+        from tgext.ecommerce.model import DBSession, Product
+
+        previous, current = ObjectId(), ObjectId()
+        product = Product(type='product', name={'it': 'prosciutto'}, slug='product-prosciutto-0',
+                          categories_path=[previous],
+                          configurations=[{'sku': '12345', 'variety': {'it': 'crudo'}, 'qty': 1,
+                                           'initial_quantity': 1, 'price': 10.0, 'vat': 2.2}])
+        DBSession.flush_all()
+        DBSession.close_all()
+        shop_cache.set('listing', ['prosciutto'], tags=['category:%s' % previous])
+
+        product = Product.query.get(_id=product._id)
+        product.categories_path = [current]
+        DBSession.flush_all()
+        self.assertIs(shop_cache.get('listing'), NOVALUE)
@@ -0,0 +1,97 @@
+# coding=utf-8
+from __future__ import unicode_literals
+from tgext.ecommerce.tests import RootTest
+
+
+class TestCategory(RootTest):
+    @classmethod
+    def setUpClass(cls):
+        from tgext.ecommerce.lib import category
+
+        cls.old_i_ = category.i_
+        category.i_ = lambda name: {'it': name}
+
+    @classmethod
+    def tearDownClass(cls):
+        from tgext.ecommerce.lib import category
+
+        category.i_ = cls.old_i_
+
+    def _create_tree(self, sm):
+        food = sm.category.create('food')
+        meat = sm.category.create('meat', parent=food)
+        ham = sm.category.create('ham', parent=meat)
+        drinks = sm.category.create('drinks')
+        return food, meat, ham, drinks
+
+    def test_category_tree(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+
+        sm = ShopManager()
+        food, meat, ham, drinks = self._create_tree(sm)
+
+        tree = sm.category.tree()
+        self.assertEqual(len(tree), 4)
+        self.assertEqual(set(tree.roots()), set([food._id, drinks._id]))
+        self.assertEqual(tree.children(food._id), [meat._id])
+        self.assertEqual(tree.descendants(food._id), frozenset([meat._id, ham._id]))
+        self.assertEqual(tree.subtree(meat._id), frozenset([meat._id, ham._id]))
+        self.assertEqual(tree.path(ham._id), [food._id, meat._id, ham._id])
+        self.assertEqual(tree.depth(ham._id), 2)
+        self.assertEqual(tree.name(ham._id, language='it'), 'ham')
+
+    def test_category_tree_invalidation(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+
+        sm = ShopManager()
+        food, meat, ham, drinks = self._create_tree(sm)
+        self.assertEqual(sm.category.tree().descendants(drinks._id), frozenset())
+
+        juice = sm.category.create('juice', parent=drinks)
+        self.assertEqual(sm.category.tree().descendants(drinks._id), frozenset([juice._id]))
+
+        sm.category.edit(meat._id, 'meat', drinks)
+        tree = sm.category.tree()
+        self.assertEqual(tree.path(ham._id), [drinks._id, meat._id, ham._id])
+        self.assertEqual(tree.descendants(food._id), frozenset())
+
+    def test_edit_rewrites_subtree_ancestors(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+        from tgext.ecommerce.model import models
+
+        sm = ShopManager()
+        food, meat, ham, drinks = self._create_tree(sm)
+        sm.category.edit(food._id, 'groceries', None)
+        models.DBSession.clear()
+
+        ham = sm.category.get(_id=ham._id)
+        self.assertEqual([a._id for a in ham.ancestors], [food._id, meat._id])
+        self.assertEqual(ham.ancestors[0].name, {'it': 'groceries'})
+
+    def test_moving_a_category_updates_counters(self):
+        import datetime
+        from tgext.ecommerce.lib import product
+        from tgext.ecommerce.lib.shop import ShopManager
+        from tgext.ecommerce.model import models
+
+        sm = ShopManager()
+        food, meat, ham, drinks = self._create_tree(sm)
+        old_i_ = product.i_
+        product.i_ = lambda name: {'it': name}
+        try:
+            for sku in ('12345', '67890'):
+                sm.product.create(type='product', sku=sku, name='test product', category_id=ham._id,
+                                  description='', price=50, vat=0.22, qty=20, initial_quantity=20,
+                                  variety='test variety', active=True, valid_from=datetime.datetime.utcnow(),
+                                  valid_to=datetime.datetime.utcnow(), published=True)
+        finally:
+            product.i_ = old_i_
+        models.DBSession.flush_all()
+
+        sm.category.edit(meat._id, 'meat', drinks)
+        models.DBSession.clear()
+        counters = sm.product.get_category_counters()
+        self.assertEqual(counters[food._id].subtree_active, 0)
+        self.assertEqual(counters[drinks._id].subtree_active, 2)
+        self.assertEqual(counters[meat._id].subtree_available, 2)
+        self.assertEqual(counters[ham._id].active, 2)
@@ -0,0 +1,64 @@
+# coding=utf-8
+from __future__ import unicode_literals
+import datetime
+from tgext.ecommerce.tests import RootTest
+
+
+class TestJobQueue(RootTest):
+    def setUp(self):
+        from tgext.ecommerce.lib.job_queue import JobQueue
+
+        super(TestJobQueue, self).setUp()
+        self.queue = JobQueue()
+        self.calls = []
+
+        @self.queue.task()
+        def record(value):
+            self.calls.append(value)
+
+        @self.queue.task(max_attempts=2)
+        def broken():
+            raise ValueError('broken')
+
+    def test_priorities(self):
+        self.queue.enqueue('record', args=['low'])
+        self.queue.enqueue('record', args=['high'], priority=10)
+        self.queue.enqueue('record', args=['later'], delay=3600)
+
+        while self.queue.work('worker'):
+            pass
+        self.assertEqual(self.calls, ['high', 'low'])
+        self.assertEqual(self.queue.counts(), {'done': 2, 'queued': 1})
+
+    def test_retries(self):
+        from tgext.ecommerce.model import DBSession
+
+        job_id = self.queue.enqueue('broken')
+        self.assertTrue(self.queue.work('worker'))
+        job = DBSession.impl.db.ecommerce_jobs.find_one({'_id': job_id})
+        self.assertEqual((job['status'], job['attempts']), ('queued', 1))
+        self.assertTrue(job['last_error'].startswith('ValueError'))
+
+        # Skip the backoff
+        DBSession.impl.db.ecommerce_jobs.update({'_id': job_id}, {'$set': {'visible_at': datetime.datetime.utcnow()}})
+        self.assertTrue(self.queue.work('worker'))
+        self.assertEqual(DBSession.impl.db.ecommerce_jobs.find_one({'_id': job_id})['status'], 'failed')
+
+    def test_visibility_timeout(self):
+        from tgext.ecommerce.model import DBSession
+
+        job_id = self.queue.enqueue('record', args=['once'])
+        stale = self.queue.claim('dead worker')
+        self.assertIsNone(self.queue.claim('worker'))
+
+        DBSession.impl.db.ecommerce_jobs.update({'_id': job_id}, {'$set': {'visible_at': datetime.datetime.utcnow()}})
+        self.assertTrue(self.queue.work('worker'))
+        # The dead worker lost its claim and can't record the outcome anymore
+        self.queue.execute(stale)
+        job = DBSession.impl.db.ecommerce_jobs.find_one({'_id': job_id})
+        self.assertEqual((job['status'], job['attempts'], job['claimed_by']), ('done', 2, 'worker'))
+
+    def test_deduplication(self):
+        first = self.queue.enqueue('record', args=['once'], key='record-once')
+        self.assertEqual(self.queue.enqueue('record', args=['once'], key='record-once'), first)
+        self.assertEqual(self.queue.counts(), {'queued': 1})
@@ -0,0 +1,63 @@
+# coding=utf-8
+from __future__ import unicode_literals
+import datetime
+from tgext.ecommerce.tests import RootTest
+
+
+class TestLease(RootTest):
+    def _expire(self, name):
+        from tgext.ecommerce.model import DBSession
+
+        DBSession.impl.db.ecommerce_settings.update({'setting': name},
+                                                    {'$set': {'value.expires_at': datetime.datetime(2000, 1, 1)}})
+
+    def test_exclusive(self):
+        from tgext.ecommerce.lib.lease import MongoLease
+
+        first, second = MongoLease('test_lease', ttl=60), MongoLease('test_lease', ttl=60)
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        self.assertTrue(first.renew())
+        self.assertTrue(first.is_mine())
+
+        self.assertTrue(first.release())
+        self.assertIsNone(first.holder())
+        self.assertTrue(second.acquire())
+
+    def test_takeover_after_expiry(self):
+        from tgext.ecommerce.lib.exceptions import LeaseLostException
+        from tgext.ecommerce.lib.lease import MongoLease
+
+        first, second = MongoLease('test_lease', ttl=60), MongoLease('test_lease', ttl=60)
+        self.assertTrue(first.acquire())
+        self._expire('test_lease')
+        self.assertIsNone(first.holder())
+
+        self.assertTrue(second.acquire())
+        self.assertEqual(second.fence, first.fence + 1)
+        self.assertFalse(first.renew())
+        self.assertFalse(first.release())
+        self.assertRaises(LeaseLostException, first.ensure_held)
+        second.ensure_held()
+
+    def test_legacy_pid_lock(self):
+        from tgext.ecommerce.lib.lease import MongoLease
+        from tgext.ecommerce.model import DBSession
+
+        DBSession.impl.db.ecommerce_settings.insert({'setting': 'test_lease', 'value': 1234})
+        self.assertTrue(MongoLease('test_lease', ttl=60).acquire())
+
+    def test_cart_lock_lapses(self):
+        from tgext.ecommerce.lib.async_jobs import lock_carts, unlock_carts, cart_locked_by_me
+        from tgext.ecommerce.lib.exceptions import CartLockedException
+        from tgext.ecommerce.lib.shop import ShopManager
+
+        sm = ShopManager()
+        self.assertTrue(lock_carts())
+        self.assertTrue(cart_locked_by_me())
+        self.assertRaises(CartLockedException, sm.cart.get, 'egg')
+
+        self._expire('cart_locked')
+        self.assertIsNone(sm.cart.get('egg'))
+        self.assertFalse(cart_locked_by_me())
+        unlock_carts()
@@ -0,0 +1,321 @@
+# coding=utf-8
+from __future__ import unicode_literals
+import datetime
+from bson import ObjectId
+from tg.util import Bunch
+from tgext.ecommerce.tests import RootTest
+
+
+class TestOrder(RootTest):
+    def _insert_order(self, creation_date, status='created', **fields):
+        from tgext.ecommerce.model import DBSession
+
+        order = dict(_id=ObjectId(), user_id=str(ObjectId()), user='John Doe', status=status,
+                     creation_date=creation_date, payment_date=creation_date,
+                     status_changes=[{'status': status, 'changed_by': 'John Doe', 'changed_at': creation_date}],
+                     items=[{'sku': '12345', 'qty': 2, 'rate': 0.22, 'net_price': 10.0, 'vat': 2.2,
+                             'gross_price': 12.2, 'details': {'weight': 100}},
+                            {'sku': '67890', 'qty': 1, 'rate': 0.04, 'net_price': 10.0, 'vat': 0.4,
+                             'gross_price': 10.4, 'details': {}}],
+                     applied_discount=0.0, gross_total=34.8, shipping_charges=5.0,
+                     currencies={'due': 3980, 'shipping_charges': 500, 'applied_discount': 0})
+        order.update(fields)
+        DBSession.impl.db.orders.insert(order)
+        return order
+
+    def test_order_view(self):
+        from tgext.ecommerce.model import OrderView
+
+        order = OrderView(self._insert_order(datetime.datetime(2014, 5, 10)))
+        self.assertEqual(order.net_per_vat_rate, {0.22: 24.4, 0.04: 10.4})
+        self.assertEqual(order.weight, 200)
+        self.assertEqual(order.list_columns()['due'], '39.80')
+
+    def test_orders_listing(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+
+        sm = ShopManager()
+        self._insert_order(datetime.datetime(2014, 5, 10, 10))
+        self._insert_order(datetime.datetime(2014, 5, 10, 12))
+        self._insert_order(datetime.datetime(2014, 5, 11, 9), status='shipped')
+
+        listing = sm.order.get_listing(page=1, items_per_page=2)
+        self.assertEqual((listing.total, listing.pages), (3, 2))
+        self.assertEqual([(date, count) for date, count, _ in listing.days],
+                         [(datetime.date(2014, 5, 11), 1), (datetime.date(2014, 5, 10), 1)])
+
+        listing = sm.order.get_listing({'status': 'created'}, page=1, items_per_page=2)
+        self.assertEqual([(date, count) for date, count, _ in listing.days], [(datetime.date(2014, 5, 10), 2)])
+
+    def test_user_history(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+        from tgext.ecommerce.model import DBSession
+
+        sm = ShopManager()
+        user_id = str(ObjectId())
+        for day in (1, 2, 3):
+            self._insert_order(datetime.datetime(2014, 5, day), user_id=user_id,
+                               summary={'item_count': day, 'thumbnail': None})
+        archived = self._insert_order(datetime.datetime(2012, 1, 1), user_id=user_id)
+        DBSession.impl.db.orders.remove({'_id': archived['_id']})
+        DBSession.impl.db.orders_archive.insert(archived)
+        self._insert_order(datetime.datetime(2014, 5, 4))
+
+        history = sm.order.get_user_history(user_id, page=1, items_per_page=3)
+        self.assertEqual((history.total, history.pages), (4, 2))
+        self.assertEqual([order.summary.item_count for order in history.orders], [3, 2, 1])
+        self.assertEqual(history.orders[0].items, [])
+
+        history = sm.order.get_user_history(user_id, page=2, items_per_page=3)
+        self.assertEqual([order._id for order in history.orders], [archived['_id']])
+
+    def test_archive_orders(self):
+        from tgext.ecommerce.lib.async_jobs import archive_orders
+        from tgext.ecommerce.lib.shop import ShopManager
+        from tgext.ecommerce.model import DBSession
+
+        sm = ShopManager()
+        user_id = str(ObjectId())
+        old = self._insert_order(datetime.datetime(2012, 1, 1), user_id=user_id)
+        recent = self._insert_order(datetime.datetime.utcnow(), user_id=user_id)
+
+        self.assertEqual(archive_orders(older_than_days=30), 1)
+        self.assertEqual(archive_orders(older_than_days=30), 0)
+        self.assertEqual([order._id for order in sm.order.get_user_orders(user_id)], [recent['_id'], old['_id']])
+        self.assertEqual([order._id for order in sm.order.get_user_orders(user_id).sort('creation_date', 1)],
+                         [old['_id'], recent['_id']])
+        self.assertEqual([order._id for order in sm.order.get_user_orders(user_id).sort('creation_date', -1)
+                                                                                 .skip(1).limit(1)], [old['_id']])
+        self.assertEqual(sm.order.get_user_orders(user_id).count(), 2)
+        self.assertEqual(DBSession.impl.db.orders_archive.find_one({'_id': old['_id']})['items'], old['items'])
+
+    def test_find_by_sku(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+        from tgext.ecommerce.model import DBSession
+
+        sm = ShopManager()
+        self._insert_order(datetime.datetime(2014, 5, 10))
+        self._insert_order(datetime.datetime(2014, 5, 11), status='shipped')
+        self._insert_order(datetime.datetime(2014, 5, 12), items=[{'sku': '67890', 'qty': 1, 'rate': 0.04,
+                                                                   'net_price': 10.0, 'vat': 0.4, 'gross_price': 10.4}])
+
+        self.assertEqual(sm.order.find_by_sku('12345', count_only=True), 2)
+        self.assertEqual(sm.order.find_by_sku('12345', status='shipped', count_only=True), 1)
+        self.assertEqual(sm.order.find_by_sku('67890', count_only=True,
+                                              date_range=(datetime.datetime(2014, 5, 11), None)), 2)
+
+        result = sm.order.find_by_sku('12345', page=1, items_per_page=1)
+        self.assertEqual((result.total, result.pages), (2, 2))
+        self.assertEqual(result.orders[0].creation_date, datetime.datetime(2014, 5, 11))
+        self.assertEqual([item.sku for item in result.orders[0].items], ['12345'])
+
+        archived = self._insert_order(datetime.datetime(2013, 5, 10))
+        DBSession.impl.db.orders_archive.insert(DBSession.impl.db.orders.find_one({'_id': archived['_id']}))
+        DBSession.impl.db.orders.remove({'_id': archived['_id']})
+        self.assertEqual(sm.order.find_by_sku('12345', count_only=True), 3)
+        result = sm.order.find_by_sku('12345', page=3, items_per_page=1)
+        self.assertEqual((result.total, result.pages), (3, 3))
+        self.assertEqual([order._id for order in result.orders], [archived['_id']])
+
+    def test_vat_rates_registry(self):
+        from tgext.ecommerce.model import DBSession, Order
+
+        settings = DBSession.impl.db.ecommerce_settings
+        self._insert_order(datetime.datetime(2014, 5, 10))
+        # Built from the orders the first time
+        self.assertEqual(Order.all_the_vats(), [0.04, 0.22])
+        self.assertEqual(sorted(settings.find_one({'setting': 'vat_rates'})['value']['rates']), [0.04, 0.22])
+
+        Order.register_vat_rates([0.22, 0.1])
+        self.assertEqual(Order.all_the_vats(), [0.04, 0.1, 0.22])
+        Order.register_vat_rates([0.22])
+        self.assertEqual(Order.all_the_vats(), [0.04, 0.1, 0.22])
+
+        Order.rebuild_vat_rates()
+        self.assertEqual(Order.all_the_vats(), [0.04, 0.1, 0.22])
+        self.assertEqual(settings.find({'setting': 'vat_rates'}).count(), 1)
+
+    def test_customer_search(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+        from tgext.ecommerce.lib.utils import search_query
+        from tgext.ecommerce.model import Order
+
+        sm = ShopManager()
+        for name, email in (('Mario Rossi', 'mario.rossi@example.com'), ('Luigi Verdi', 'lverdi@example.com')):
+            doc = dict(_id=ObjectId(), user=name, payer_info={'email': email})
+            doc['search_terms'] = Order.search_terms_of(Bunch(doc))
+            self._insert_order(datetime.datetime(2014, 5, 10), **doc)
+
+        for text, expected in (('mar', 1), ('ROSSI', 1), ('verdi', 1), ('lver', 1), ('ssi', 1),
+                               ('example.com', 2), ('mario verdi', 0), ('a', 0)):
+            listing = sm.order.get_listing(search_query(text))
+            self.assertEqual(listing.total, expected, text)
+
+    def test_sales_report(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+
+        sm = ShopManager()
+        self._insert_order(datetime.datetime(2014, 5, 10, 10))
+        self._insert_order(datetime.datetime(2014, 5, 10, 12), status='shipped')
+        self._insert_order(datetime.datetime(2014, 5, 11, 9))
+        sm.report.rebuild(datetime.datetime(2014, 5, 1), datetime.datetime(2014, 6, 1), workers=2, chunk_days=1)
+
+        start, end = datetime.datetime(2014, 5, 10), datetime.datetime(2014, 5, 12)
+        by_status = sm.report.sales(start, end, group_by=('status', ))
+        self.assertEqual([(r.status, r.orders, r.gross) for r in by_status],
+                         [('created', 2, 6960), ('shipped', 1, 3480)])
+
+        by_rate = sm.report.sales(start, end, group_by=('rate', ), status='created')
+        self.assertEqual([(r.rate, r.units, r.tax) for r in by_rate], [(0.04, 2, 80), (0.22, 4, 880)])
+
+    def test_csv_export(self):
+        import csv
+        from tgext.ecommerce.lib.shop import ShopManager
+
+        sm = ShopManager()
+        self._insert_order(datetime.datetime(2014, 5, 10, 10))
+        self._insert_order(datetime.datetime(2014, 5, 11, 10))
+
+        content = b''.join(sm.order.export('csv', batch_size=1))
+        rows = list(csv.DictReader(content.splitlines()))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual((rows[0]['sku'], rows[0]['line_gross'], rows[0]['rate_total'], rows[0]['rate_vat']),
+                         ('12345', '24.40', '24.40', '4.40'))
+
+    def test_export_includes_archived_orders(self):
+        import csv
+        from tgext.ecommerce.lib.async_jobs import archive_orders
+        from tgext.ecommerce.lib.shop import ShopManager
+
+        sm = ShopManager()
+        old = self._insert_order(datetime.datetime(2012, 1, 1))
+        recent = self._insert_order(datetime.datetime.utcnow())
+        self.assertEqual(archive_orders(older_than_days=30), 1)
+
+        rows = list(csv.DictReader(b''.join(sm.order.export('csv')).splitlines()))
+        self.assertEqual([row['order'] for row in rows], [str(old['_id'])] * 2 + [str(recent['_id'])] * 2)
+
+
+class TestCheckout(RootTest):
+    @classmethod
+    def setUpClass(cls):
+        from tgext.ecommerce.lib import product
+        from tgext.ecommerce.lib import category
+        from tgext.ecommerce.lib.users import user_names
+
+        cls.old_i_ = product.i_
+        product.i_ = lambda name: {'it': name}
+        category.i_ = lambda name: {'it': name}
+        # No users in the tests
+        user_names.resolve_many = lambda user_ids: {}
+
+    @classmethod
+    def tearDownClass(cls):
+        from tgext.ecommerce.lib import product
+        from tgext.ecommerce.lib import category
+        from tgext.ecommerce.lib.users import user_names
+
+        product.i_ = cls.old_i_
+        category.i_ = cls.old_i_
+        del user_names.resolve_many
+
+    def _paid_cart(self, sm):
+        cat = sm.category.create('ham')
+        product = sm.product.create(type='product', sku='12345', name='test product', category_id=cat._id,
+                                    description='', price=50, rate=0.22, vat=11, qty=20, initial_quantity=20,
+                                    variety='test variety', active=True, valid_from=datetime.datetime.utcnow(),
+                                    valid_to=datetime.datetime.utcnow(), published=True)
+        cart = sm.cart.create_or_get(str(ObjectId()))
+        sm.product.buy(cart, product, 0, 2)
+        return cart
+
+    def _checkout_totals(self):
+        from tgext.ecommerce.model import DBSession, Order
+
+        db = DBSession.impl.db
+        rollups = db.sales_rollups.find_one({'scope': 'orders'})
+        return dict(orders=Order.query.find().count(),
+                    rolled_up=rollups['orders'], units=rollups['units'],
+                    jobs=db.ecommerce_jobs.find({'task': 'increase_sold'}).count(),
+                    vat_rates=Order.all_the_vats())
+
+    def test_create_twice(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+        from tgext.ecommerce.model import DBSession
+
+        sm = ShopManager()
+        cart = self._paid_cart(sm)
+        order = sm.order.create(cart, status='paid')
+        self.assertTrue(order.checkout.completed)
+        expected = dict(orders=1, rolled_up=1, units=2, jobs=1, vat_rates=[0.22])
+        self.assertEqual(self._checkout_totals(), expected)
+
+        DBSession.close_all()
+        again = sm.order.create(cart, status='paid')
+        self.assertEqual(again._id, order._id)
+        self.assertEqual(again.checkout.attempts, 2)
+        self.assertEqual(self._checkout_totals(), expected)
+        self.assertIsNone(DBSession.impl.db.carts.find_one({'_id': cart._id}))
+
+    def test_retry_completes_interrupted_checkout(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+        from tgext.ecommerce.model import DBSession
+
+        sm = ShopManager()
+        cart = self._paid_cart(sm)
+        order = sm.order.create(cart, status='paid')
+
+        # Died long ago after applying the rollups, before recording it
+        day = datetime.datetime(2014, 5, 10)
+        DBSession.impl.db.orders.update({'_id': order._id},
+                                        {'$set': {'checkout.completed': False, 'checkout.pending': ['sold', 'vat'],
+                                                  'checkout.rollup_started': day, 'creation_date': day,
+                                                  'status_changes.0.changed_at': day}})
+        DBSession.impl.db.sales_rollups.update({}, {'$set': {'day': day}}, multi=True)
+        DBSession.close_all()
+        again = sm.order.create(cart, status='paid')
+        self.assertTrue(again.checkout.completed)
+        self.assertEqual(again.checkout.pending, [])
+        self.assertEqual(self._checkout_totals(), dict(orders=1, rolled_up=1, units=2, jobs=1, vat_rates=[0.22]))
+
+    def test_rebuild_keeps_live_increments(self):
+        from tgext.ecommerce.lib.report import ReportManager
+        from tgext.ecommerce.model import DBSession, SalesRollup
+
+        day = datetime.datetime(2014, 5, 10)
+        DBSession.impl.db.orders.insert({'_id': ObjectId(), 'user_id': str(ObjectId()), 'status': 'created',
+                                         'creation_date': day, 'payment_date': day,
+                                         'status_changes': [{'status': 'created', 'changed_at': day}],
+                                         'items': [{'sku': '12345', 'qty': 2, 'rate': 0.22, 'net_price': 10.0,
+                                                    'vat': 2.2, 'gross_price': 12.2}],
+                                         'shipping_charges': 5.0, 'applied_discount': 0.0})
+        # Drifted by one order, then repaired by the difference
+        SalesRollup.apply({(day, 'orders', 'created', None, None): {'orders': 2, 'units': 1}})
+        self.assertEqual(ReportManager.rebuild(day, day + datetime.timedelta(days=1), workers=1), 2)
+        self.assertEqual(ReportManager.rebuild(day, day + datetime.timedelta(days=1), workers=1), 0)
+        rollup = DBSession.impl.db.sales_rollups.find_one({'scope': 'orders'})
+        self.assertEqual((rollup['orders'], rollup['units'], rollup['gross']), (1, 2, 2440))
+
+        # Days taking orders are left alone, their orders might still be changing the rollups
+        now = datetime.datetime.utcnow()
+        DBSession.impl.db.orders.insert({'_id': ObjectId(), 'user_id': str(ObjectId()), 'status': 'created',
+                                         'creation_date': now, 'payment_date': now,
+                                         'status_changes': [{'status': 'created', 'changed_at': now}], 'items': []})
+        today = SalesRollup.day_of(now)
+        self.assertEqual(ReportManager.rebuild(today, today + datetime.timedelta(days=1), workers=1), 0)
+        self.assertIsNone(DBSession.impl.db.sales_rollups.find_one({'day': today}))
+
+    def test_increase_sold_once(self):
+        from tgext.ecommerce.lib.async_jobs import increase_sold
+        from tgext.ecommerce.lib.shop import ShopManager
+        from tgext.ecommerce.model import DBSession
+
+        sm = ShopManager()
+        cart = self._paid_cart(sm)
+        order = sm.order.create(cart, status='paid')
+
+        # A job retried after a failure runs again
+        increase_sold(order._id)
+        increase_sold(order._id)
+        product = DBSession.impl.db.products.find_one({'configurations.sku': '12345'})
+        self.assertEqual(product['sold'], 2)
@@ -0,0 +1,142 @@
+# coding=utf-8
+from __future__ import unicode_literals
+import datetime
+from unittest import TestCase
+from bson import ObjectId
+import requests
+from tg.util import Bunch
+from tgext.ecommerce.tests import RootTest
+
+
+class TestPaypalGateway(TestCase):
+    def setUp(self):
+        from tgext.ecommerce.lib.payments.fake_paypal import FakePaypalServer
+        from tgext.ecommerce.lib.payments.paypal import configure_paypal
+
+        self.server = FakePaypalServer().start()
+        self.gateway = configure_paypal('sandbox', 'client', 'secret', base_url=self.server.url,
+                                        retries=2, backoff=0.01)
+        self.cart = Bunch(_id=ObjectId(), order_due='12.50', order_info=Bunch())
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _approve(self, approval_url):
+        response = requests.get(approval_url, allow_redirects=False)
+        return dict(requests.utils.urlparse(response.headers['Location']).query.split('&')[i].split('=')
+                    for i in range(2))
+
+    def test_pay_and_execute(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+
+        sm = ShopManager()
+        approval_url = sm.pay(self.cart, 'http://shop/confirm', 'http://shop/cancel')
+        self.assertEqual(self.cart.order_info.payment['backend'], 'paypal')
+
+        params = self._approve(approval_url)
+        self.assertEqual(params['paymentId'], self.cart.order_info.payment['id'])
+
+        result = sm.execute(self.cart, {'payer_id': params['PayerID']})
+        self.assertTrue(result['result'])
+        self.assertEqual(result['payer_info']['email'], 'john.doe@example.com')
+
+    def test_retries_transient_failures(self):
+        self.server.fail_next(2)
+        approval_url = self.gateway.pay(self.cart, 'http://shop/confirm', 'http://shop/cancel')
+        self.assertNotEqual(approval_url, 'http://shop/cancel')
+        self.assertEqual(len(self.server.payments), 1)
+
+    def test_gives_up_after_retries(self):
+        self.server.fail_next(10)
+        self.assertEqual(self.gateway.pay(self.cart, 'http://shop/confirm', 'http://shop/cancel'),
+                         'http://shop/cancel')
+
+    def test_asynchronous_execution(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+
+        sm = ShopManager()
+        result = sm.pay(self.cart, 'http://shop/confirm', 'http://shop/cancel', asynchronous=True)
+        self.assertTrue(result.get(timeout=10).startswith(self.server.url))
+        self.assertRaises(ValueError, self.gateway.submit, 'confirm', self.cart, 'http://shop/confirm', {})
+
+    def test_null_payment(self):
+        from tgext.ecommerce.lib.payments import null_payment
+        from tgext.ecommerce.lib.shop import ShopManager
+
+        sm = ShopManager()
+        self.assertEqual(sm.pay(self.cart, 'http://shop/confirm', 'http://shop/cancel', null_payment),
+                         'http://shop/confirm')
+        self.assertEqual(self.cart.order_info.payment['backend'], 'null_payment')
+        self.assertEqual(null_payment.execute(self.cart, {}), dict(result=True, payer_info={}))
+
+
+class TestPaymentReconciliation(RootTest):
+    @classmethod
+    def setUpClass(cls):
+        from tgext.ecommerce.lib import product
+        from tgext.ecommerce.lib import category
+        from tgext.ecommerce.lib.users import user_names
+
+        cls.old_i_ = product.i_
+        product.i_ = lambda name: {'it': name}
+        category.i_ = lambda name: {'it': name}
+        # No users in the tests
+        user_names.resolve_many = lambda user_ids: {}
+
+    @classmethod
+    def tearDownClass(cls):
+        from tgext.ecommerce.lib import product
+        from tgext.ecommerce.lib import category
+        from tgext.ecommerce.lib.users import user_names
+
+        product.i_ = cls.old_i_
+        category.i_ = cls.old_i_
+        del user_names.resolve_many
+
+    def setUp(self):
+        from tgext.ecommerce.lib.payments.fake_paypal import FakePaypalServer
+        from tgext.ecommerce.lib.payments.paypal import configure_paypal
+
+        super(TestPaymentReconciliation, self).setUp()
+        self.server = FakePaypalServer().start()
+        configure_paypal('sandbox', 'client', 'secret', base_url=self.server.url, backoff=0.01)
+
+    def tearDown(self):
+        self.server.stop()
+        super(TestPaymentReconciliation, self).tearDown()
+
+    def _cart_paying(self, sm, user_id, sku):
+        from tgext.ecommerce.model import DBSession
+
+        cat = sm.category.create('ham')
+        product = sm.product.create(type='product', sku=sku, name='test product', category_id=cat._id,
+                                    description='', price=50, vat=0.22, qty=20, initial_quantity=20,
+                                    variety='test variety', active=True, valid_from=datetime.datetime.utcnow(),
+                                    valid_to=datetime.datetime.utcnow(), published=True)
+        cart = sm.cart.create_or_get(user_id)
+        sm.product.buy(cart, product, 0, 2)
+        sm.pay(cart, 'http://shop/confirm', 'http://shop/cancel')
+        cart.order_info.payment['date'] = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        DBSession.flush_all()
+        DBSession.close_all()
+        return cart.order_info.payment['id']
+
+    def test_reconcile_payments(self):
+        from tgext.ecommerce.lib.async_jobs import reconcile_payments
+        from tgext.ecommerce.lib.shop import ShopManager
+        from tgext.ecommerce.model import Cart, Order
+
+        sm = ShopManager()
+        approved_user, expired_user, pending_user = str(ObjectId()), str(ObjectId()), str(ObjectId())
+        approved = self._cart_paying(sm, approved_user, '12345')
+        expired = self._cart_paying(sm, expired_user, '67890')
+        self._cart_paying(sm, pending_user, '13579')
+        self.server.approve(approved)
+        self.server.expire(expired)
+
+        self.assertEqual(reconcile_payments(workers=2), 2)
+        self.assertEqual(self.server.payments[approved]['state'], 'approved')
+        self.assertEqual([o.user_id for o in Order.query.find()], [approved_user])
+        self.assertEqual([c.user_id for c in Cart.query.find()], [pending_user])
+        self.assertEqual(sm.product.get('67890').configurations[0]['qty'], 20)
+        self.assertEqual(sm.product.get('12345').configurations[0]['qty'], 18)
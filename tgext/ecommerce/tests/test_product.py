@@ -2,6 +2,7 @@
 from __future__ import unicode_literals
 import datetime
 from time import sleep
+from tgext.ecommerce.lib.exceptions import LeaseLostException
 from tgext.ecommerce.tests import RootTest
 
 
@@ -124,6 +125,63 @@ class TestShop(RootTest):
         cart = sm.cart.get('egg')
         self.assertIsNone(cart)
 
+    def test_clear_all_carts_resumes(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+        from tgext.ecommerce.lib.async_jobs import clear_all_carts
+        from tgext.ecommerce.model import models
+
+        sm = ShopManager()
+        pr = self._create_product(sm, '12345')
+        for user in ('egg', 'spam', 'bacon'):
+            sm.product.buy(sm.cart.create_or_get(user), pr, 0, 2)
+        models.DBSession.flush_all()
+        models.DBSession.close_all()
+
+        # A previous run removed the first cart and died before giving back its items
+        first = models.DBSession.impl.db.carts.find().sort('_id', 1).limit(1)[0]
+        models.DBSession.impl.db.carts.remove({'_id': first['_id']})
+        models.DBSession.impl.db.ecommerce_settings.insert({'setting': 'carts_clear_checkpoint',
+                                                           'value': {'last_id': first['_id'],
+                                                                     'pending': [['12345', 2]]}})
+
+        self.assertEqual(clear_all_carts(batch_size=1), 2)
+        self.assertEqual(sm.product.get('12345').configurations[0]['qty'], 20)
+        self.assertEqual(models.DBSession.impl.db.carts.count(), 0)
+        self.assertIsNone(models.DBSession.impl.db.ecommerce_settings.find_one({'setting': 'carts_clear_checkpoint'}))
+
+    def test_clear_all_carts_completes_interrupted_flush(self):
+        from tg.util import Bunch
+        from tgext.ecommerce.lib.shop import ShopManager
+        from tgext.ecommerce.lib.async_jobs import clear_all_carts
+        from tgext.ecommerce.model import models
+
+        sm = ShopManager()
+        self._create_product(sm, '12345')
+        self._create_product(sm, '67890')
+        for user, sku in (('egg', '12345'), ('spam', '67890')):
+            sm.product.buy(sm.cart.create_or_get(user), sm.product.get(sku), 0, 2)
+        models.DBSession.flush_all()
+        models.DBSession.close_all()
+
+        # A previous run removed the carts and died halfway through giving back their items
+        db = models.DBSession.impl.db
+        last_id = db.carts.find().sort('_id', -1).limit(1)[0]['_id']
+        db.carts.remove({})
+        db.products.update({'configurations.sku': '12345'},
+                           {'$inc': {'configurations.$.qty': 2}, '$set': {'configurations.$.restocked_by': 'flush'}})
+        db.ecommerce_settings.insert({'setting': 'carts_clear_checkpoint',
+                                      'value': {'last_id': last_id, 'pending': [], 'fence': 1,
+                                                'flushing': {'id': 'flush',
+                                                             'quantities': [['12345', 2], ['67890', 2]]}}})
+
+        stale_lease = Bunch(fence=0, ensure_held=lambda: None)
+        self.assertRaises(LeaseLostException, clear_all_carts, stale_lease)
+
+        self.assertEqual(clear_all_carts(Bunch(fence=2, ensure_held=lambda: None)), 0)
+        self.assertEqual(sm.product.get('12345').configurations[0]['qty'], 20)
+        self.assertEqual(sm.product.get('67890').configurations[0]['qty'], 20)
+        self.assertIsNone(db.ecommerce_settings.find_one({'setting': 'carts_clear_checkpoint'}))
+
     def test_delete_item_from_cart(self):
         from tgext.ecommerce.lib.shop import ShopManager
         from tgext.ecommerce.model import models
@@ -194,3 +252,75 @@ class TestShop(RootTest):
 
         products = sm.product.search('lorem', language='it').count()
         self.assertEqual(products, 1)
+
+    def test_get_in_category_subtree(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+        from tgext.ecommerce.model import models
+
+        sm = ShopManager()
+        pr = self._create_product(sm, '12345', published=True)
+        food = sm.category.create('food')
+        sm.category.edit(pr.category_id, 'ham', food)
+        models.DBSession.flush_all()
+        models.DBSession.close_all()
+
+        products = sm.product.get_in_category_subtree(food._id)
+        self.assertEqual([p.configurations[0].sku for p in products], ['12345'])
+        self.assertEqual(sm.product.get_in_category_subtree(pr.category_id).count(), 1)
+
+    def test_category_counters(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+        from tgext.ecommerce.model import models
+
+        sm = ShopManager()
+        pr = self._create_product(sm, '12345', published=True)
+        counters = sm.product.get_category_counters()[pr.category_id]
+        self.assertEqual((counters.active, counters.available), (1, 1))
+
+        sm.product.buy(sm.cart.create_or_get('egg'), pr, 0, 20)
+        models.DBSession.flush_all()
+        models.DBSession.close_all()
+        counters = sm.product.get_category_counters()[pr.category_id]
+        self.assertEqual((counters.subtree_active, counters.subtree_available), (1, 0))
+
+        models.DBSession.remove(models.CategoryCounter)
+        self.assertEqual(sm.product.verify_category_counters(), 1)
+        self.assertEqual(sm.product.verify_category_counters(), 0)
+        counters = sm.product.get_category_counters()[pr.category_id]
+        self.assertEqual((counters.active, counters.available), (1, 0))
+
+    def test_category_counters_follow_flushes(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+        from tgext.ecommerce.model import models
+
+        sm = ShopManager()
+        pr = self._create_product(sm, '12345', published=True)
+        category_id = pr.category_id
+        sm.product.edit_configuration(pr, 0, qty=0)
+        models.DBSession.close_all()
+        self.assertEqual(sm.product.get_category_counters()[category_id].available, 1)
+
+        pr = sm.product.get('12345')
+        sm.product.publish(pr, False)
+        models.DBSession.flush_all()
+        sm.product.delete(pr)
+        models.DBSession.flush_all()
+        models.DBSession.close_all()
+        counters = sm.product.get_category_counters()[category_id]
+        self.assertEqual((counters.active, counters.available, counters.subtree_active), (0, 0, 0))
+        self.assertEqual(sm.product.verify_category_counters(), 0)
+
+    def test_restock_many_skips_restocked_counters(self):
+        from tgext.ecommerce.lib.shop import ShopManager
+        from tgext.ecommerce.model import models
+
+        sm = ShopManager()
+        pr = self._create_product(sm, '12345', published=True)
+        sm.product.buy(sm.cart.create_or_get('egg'), pr, 0, 20)
+        models.DBSession.flush_all()
+        models.DBSession.close_all()
+        sm.product.restock_many({'12345': 2}, flush_id='flush')
+        sm.product.restock_many({'12345': 2}, flush_id='flush')
+
+        self.assertEqual(sm.product.get('12345').configurations[0]['qty'], 2)
+        self.assertEqual(sm.product.get_category_counters()[pr.category_id].available, 1)
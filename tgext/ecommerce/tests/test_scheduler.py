@@ -0,0 +1,83 @@
+# coding=utf-8
+from __future__ import unicode_literals
+import time
+from tgext.ecommerce.tests import RootTest
+
+
+class TestJobRunner(RootTest):
+    def _wait(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.05)
+        return condition()
+
+    def test_single_leader(self):
+        from tgext.ecommerce.lib.lease import MongoLease
+        from tgext.ecommerce.lib.scheduler import JobRunner
+
+        runs = []
+        runners = [JobRunner(tick=0.05, lease=MongoLease('test_scheduler', ttl=60)) for _ in range(3)]
+        for i, runner in enumerate(runners):
+            runner.register('job', lambda i=i: runs.append(i), interval=3600)
+            runner.start()
+        try:
+            self.assertTrue(self._wait(lambda: len(runs) > 0))
+            time.sleep(0.3)
+            self.assertEqual(len(runs), 1)
+            self.assertEqual(len([runner for runner in runners if runner.leader]), 1)
+        finally:
+            for runner in runners:
+                runner.stop()
+
+    def test_trigger_and_stats(self):
+        from tgext.ecommerce.lib.lease import MongoLease
+        from tgext.ecommerce.lib.scheduler import JobRunner
+
+        runs = []
+        runner = JobRunner(tick=0.05, lease=MongoLease('test_scheduler', ttl=60))
+        runner.register('job', lambda: runs.append(1), interval=3600)
+        runner.register('broken', lambda: 1 / 0, interval=3600)
+        runner.start()
+        try:
+            self.assertTrue(self._wait(lambda: len(runs) == 1))
+            runner.trigger('job')
+            self.assertTrue(self._wait(lambda: len(runs) == 2))
+        finally:
+            runner.stop()
+
+        stats = runner.stats()
+        self.assertEqual(stats['job'].runs, 2)
+        self.assertEqual((stats['broken'].runs, stats['broken'].failures), (1, 1))
+        self.assertTrue(stats['broken'].last_error.startswith('ZeroDivisionError'))
+
+    def test_manual_run(self):
+        from tgext.ecommerce.lib.scheduler import JobRunner
+
+        runner = JobRunner()
+        runner.register('job', lambda: 42, interval=3600)
+        self.assertEqual(runner.run('job'), 42)
+        self.assertEqual(runner.stats()['job'].runs, 1)
+
+    def test_deadline_and_wake(self):
+        import datetime
+        from tgext.ecommerce.lib.lease import MongoLease
+        from tgext.ecommerce.lib.scheduler import JobRunner
+
+        runs = []
+        deadline = lambda: datetime.datetime.utcnow() + datetime.timedelta(seconds=0.2) if len(runs) < 2 else None
+        leader = JobRunner(tick=0.05, lease=MongoLease('test_scheduler', ttl=60))
+        leader.register('job', lambda: runs.append(1), interval=3600, deadline=deadline)
+        leader.start()
+        try:
+            # Runs at once, then at the deadline, then waits for the interval
+            self.assertTrue(self._wait(lambda: len(runs) == 2))
+            time.sleep(0.4)
+            self.assertEqual(len(runs), 2)
+
+            other = JobRunner(tick=0.05, lease=MongoLease('test_scheduler', ttl=60))
+            other.register('job', lambda: runs.append(1), interval=3600)
+            other.wake('job', datetime.datetime.utcnow() + datetime.timedelta(seconds=0.1))
+            self.assertTrue(self._wait(lambda: len(runs) == 3))
+            self.assertTrue(leader.jobs['job'].next_run > datetime.datetime.utcnow() + datetime.timedelta(hours=0.9))
+        finally:
+            leader.stop()
@@ -0,0 +1,68 @@
+# coding=utf-8
+from __future__ import unicode_literals
+from unittest import TestCase
+from bson import ObjectId
+from tg.util import Bunch
+
+
+class TestUserNameResolver(TestCase):
+    def setUp(self):
+        from tgext.ecommerce.lib import users
+
+        self.users = dict((str(_id), Bunch(_id=_id, name=name, surname='Rossi', email_address='%s@example.com' % name))
+                          for _id, name in ((ObjectId(), 'Mario'), (ObjectId(), 'Maria'), (ObjectId(), 'Marco')))
+        self.queries = []
+        self.old_app_model = users.app_model
+        users.app_model = Bunch(User=Bunch(query=Bunch(find=self._find)))
+
+    def tearDown(self):
+        from tgext.ecommerce.lib import users
+
+        users.app_model = self.old_app_model
+
+    def _find(self, query):
+        ids = [str(_id) for _id in query['_id']['$in']]
+        self.queries.append(sorted(ids))
+        return [self.users[_id] for _id in ids if _id in self.users]
+
+    def test_batched_lookup(self):
+        from tgext.ecommerce.lib.users import UserNameResolver
+
+        resolver = UserNameResolver(size=10, ttl=60, missing_ttl=60)
+        ids = list(self.users)
+        names = resolver.resolve_many(ids + ['not-an-id'])
+        self.assertEqual(names, dict((_id, '%s Rossi' % user.name) for _id, user in self.users.items()))
+        self.assertEqual(self.queries, [sorted(ids)])
+
+        self.assertEqual(resolver.resolve(ids[0]), names[ids[0]])
+        self.assertEqual(len(self.queries), 1)
+
+    def test_missing_users_are_remembered(self):
+        from tgext.ecommerce.lib.users import UserNameResolver
+
+        resolver = UserNameResolver(size=10, ttl=60, missing_ttl=60)
+        missing = str(ObjectId())
+        self.assertIsNone(resolver.resolve(missing))
+        self.assertIsNone(resolver.resolve(missing))
+        self.assertEqual(self.queries, [[missing]])
+
+        resolver = UserNameResolver(size=10, ttl=60, missing_ttl=0)
+        resolver.resolve(missing)
+        resolver.resolve(missing)
+        self.assertEqual(len(self.queries), 3)
+
+    def test_least_recently_used_are_dropped(self):
+        from tgext.ecommerce.lib.users import UserNameResolver
+
+        resolver = UserNameResolver(size=2, ttl=60, missing_ttl=60)
+        first, second, third = list(self.users)
+        resolver.resolve(first)
+        resolver.resolve(second)
+        resolver.resolve(first)
+        resolver.resolve(third)
+        self.assertEqual(len(self.queries), 3)
+
+        resolver.resolve(first)
+        self.assertEqual(len(self.queries), 3)
+        resolver.resolve(second)
+        self.assertEqual(self.queries[-1], [second])
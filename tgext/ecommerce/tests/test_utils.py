@@ -0,0 +1,48 @@
+# coding=utf-8
+from __future__ import unicode_literals
+from unittest import TestCase
+import tg
+
+
+class TestPreferredLanguage(TestCase):
+    def setUp(self):
+        self.default_lang = tg.config.get('lang')
+        tg.config['lang'] = 'en'
+
+    def tearDown(self):
+        tg.config['lang'] = self.default_lang
+
+    def test_default_outside_of_requests(self):
+        from tgext.ecommerce.lib.utils import preferred_language
+
+        self.assertEqual(preferred_language(), 'en')
+
+    def test_language_override(self):
+        from tgext.ecommerce.lib.utils import language_override, preferred_language
+
+        with language_override('it'):
+            self.assertEqual(preferred_language(), 'it')
+            with language_override('fr'):
+                self.assertEqual(preferred_language(), 'fr')
+            self.assertEqual(preferred_language(), 'it')
+        self.assertEqual(preferred_language(), 'en')
+
+    def test_localized(self):
+        from tgext.ecommerce.lib.utils import language_override, localized
+
+        name = {'en': 'ham', 'it': 'prosciutto'}
+        self.assertEqual(localized(name), 'ham')
+        self.assertEqual(localized(name, 'it'), 'prosciutto')
+        with language_override('it'):
+            self.assertEqual(localized(name), 'prosciutto')
+        with language_override('de'):
+            self.assertEqual(localized(name), 'ham')
+
+
+class TestSearchQuery(TestCase):
+    def test_short_words_match_nothing(self):
+        from tgext.ecommerce.lib.utils import search_query
+
+        self.assertEqual(search_query('a b'), {'_id': {'$in': []}})
+        self.assertEqual(search_query(''), {'_id': {'$in': []}})
+        self.assertEqual(search_query('a mar'), {'$or': [{'search_terms': 'mar'}]})